@@ -0,0 +1,86 @@
+# Compares the vectorized vocalization detector with the previous per-frame
+# Python loop on a synthetic long uint8 spectrogram band.
+#
+# Usage: python benchmarks/benchmark_auto_detect_vocalizations.py [--duration-hours 1]
+
+import time
+import argparse
+from typing import Union
+import numpy as np
+from isa.auto_detect_vocalizations import _auto_detect_vocalizations
+
+
+def _auto_detect_vocalizations_loop(spectrogram: np.array, *, sampling_frequency: float):
+    # the implementation before the vectorized detector
+    threshold_pct = 99.8
+    threshold = np.percentile(spectrogram, threshold_pct)
+    spectrogram = np.copy(spectrogram)
+    spectrogram[spectrogram < threshold] = 0
+
+    vocalizations = []
+    max_gap = 20
+    min_size = 10
+    voc_ind = 0
+    a = np.max(spectrogram, axis=1)
+    vocalization_start_frame: Union[int, None] = None
+    vocalization_last_active_frame: Union[int, None] = None
+    for i in range(len(a)):
+        if a[i] > 0:
+            if vocalization_start_frame is None:
+                vocalization_start_frame = i
+            vocalization_last_active_frame = i
+        else:
+            if vocalization_last_active_frame is not None:
+                if i - vocalization_last_active_frame >= max_gap:
+                    if vocalization_last_active_frame - vocalization_start_frame >= min_size:
+                        vocalizations.append(
+                            {'vocalizationId': f'auto-{voc_ind}', 'startFrame': vocalization_start_frame, 'endFrame': vocalization_last_active_frame + 1, 'labels': ['auto']}
+                        )
+                        voc_ind = voc_ind + 1
+                    vocalization_start_frame = None
+                    vocalization_last_active_frame = None
+    return vocalizations
+
+def _generate_spectrogram_band(*, num_frames: int, num_frequencies: int, seed: int=0, block_num_frames: int=100000):
+    # generated in blocks, so that only the uint8 array is held in memory
+    rng = np.random.default_rng(seed)
+    x = np.empty((num_frames, num_frequencies), dtype=np.uint8)
+    for i1 in range(0, num_frames, block_num_frames):
+        i2 = min(i1 + block_num_frames, num_frames)
+        x[i1:i2] = np.minimum(rng.exponential(8, size=(i2 - i1, num_frequencies)), 255)
+    # calls of 20-200 frames every ~1000 frames
+    starts = np.cumsum(rng.integers(200, 2000, size=num_frames // 200))
+    starts = starts[starts < num_frames]
+    for i1 in starts:
+        i2 = min(i1 + int(rng.integers(20, 200)), num_frames)
+        f1 = int(rng.integers(0, num_frequencies))
+        x[i1:i2, f1:f1 + 5] = np.minimum(x[i1:i2, f1:f1 + 5] + rng.uniform(50, 200), 255)
+    return x
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration-hours', type=float, default=1)
+    parser.add_argument('--sr-spectrogram', type=float, default=976.5625)
+    parser.add_argument('--num-frequencies', type=int, default=100)
+    args = parser.parse_args()
+
+    num_frames = int(args.duration_hours * 3600 * args.sr_spectrogram)
+    print(f'Generating {num_frames} x {args.num_frequencies} spectrogram band')
+    x = _generate_spectrogram_band(num_frames=num_frames, num_frequencies=args.num_frequencies)
+
+    timer = time.time()
+    v1 = _auto_detect_vocalizations_loop(x, sampling_frequency=args.sr_spectrogram)
+    elapsed_loop = time.time() - timer
+    print(f'Python loop: {elapsed_loop:.3f} sec ({len(v1)} vocalizations)')
+
+    timer = time.time()
+    v2 = _auto_detect_vocalizations(x, sampling_frequency=args.sr_spectrogram)
+    elapsed_vectorized = time.time() - timer
+    print(f'Vectorized: {elapsed_vectorized:.3f} sec ({len(v2)} vocalizations)')
+    print(f'Speedup: {elapsed_loop / elapsed_vectorized:.2f}x')
+
+    assert v1 == v2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+# Times the stages of isa init / isa update and the IsaService queries on
+# synthetic sessions of increasing duration, and records the peak memory of
+# each stage. The results are written as JSON and can be compared with the
+# results of an earlier run (for example of the main branch):
+#
+# python benchmarks/benchmark_pipeline.py --durations 30,120 --output baseline.json
+# python benchmarks/benchmark_pipeline.py --durations 30,120 --output results.json --baseline baseline.json
+#
+# Each stage runs in a forked process, so that its peak resident memory
+# (VmHWM, reset at the start of the stage) can be measured on its own and the
+# caches of one stage do not affect the next one.
+
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import argparse
+import platform
+import tempfile
+import multiprocessing
+import numpy as np
+
+
+def _generate_session(
+    dirname: str, *,
+    duration_sec: float,
+    sr_hz: int,
+    num_channels: int,
+    audio_format: str,
+    video_fps: float,
+    video_width: int,
+    video_height: int,
+    seed: int=0
+):
+    # noise with a 50 ms tone burst every 2 seconds, written in blocks so that
+    # long recordings do not have to fit in memory
+    os.makedirs(dirname)
+    rng = np.random.default_rng(seed)
+    num_samples = int(duration_sec * sr_hz)
+    block_num_samples = sr_hz * 10
+    burst_num_samples = int(0.05 * sr_hz)
+    burst = np.sin(np.arange(burst_num_samples) * 2 * np.pi * (sr_hz / 3) / sr_hz)
+    def generate_block(i1: int, i2: int):
+        x = rng.normal(size=(i2 - i1, num_channels)) * 0.01
+        for s in range((i1 // (2 * sr_hz)) * 2 * sr_hz + sr_hz // 3, i2, 2 * sr_hz):
+            j1 = max(s, i1)
+            j2 = min(s + burst_num_samples, i2)
+            if j2 > j1:
+                x[j1 - i1:j2 - i1, :] += burst[j1 - s:j2 - s, None]
+        return x
+    if audio_format == 'h5':
+        import h5py
+        with h5py.File(f'{dirname}/audio.h5', 'w') as f:
+            datasets = [f.create_dataset(f'ai_channels/ai{c}', shape=(num_samples,), dtype=np.float64) for c in range(num_channels)]
+            for i1 in range(0, num_samples, block_num_samples):
+                i2 = min(i1 + block_num_samples, num_samples)
+                x = generate_block(i1, i2)
+                for c in range(num_channels):
+                    datasets[c][i1:i2] = x[:, c]
+            f.create_dataset('config', data=json.dumps({'microphone_sample_rate': sr_hz}).encode('utf-8'))
+    elif audio_format == 'wav':
+        # 16-bit PCM
+        data_num_bytes = num_samples * num_channels * 2
+        with open(f'{dirname}/audio.wav', 'wb') as f:
+            f.write(b'RIFF' + struct.pack('<I', 36 + data_num_bytes) + b'WAVE')
+            f.write(b'fmt ' + struct.pack('<IHHIIHH', 16, 1, num_channels, sr_hz, sr_hz * num_channels * 2, num_channels * 2, 16))
+            f.write(b'data' + struct.pack('<I', data_num_bytes))
+            for i1 in range(0, num_samples, block_num_samples):
+                i2 = min(i1 + block_num_samples, num_samples)
+                x = generate_block(i1, i2)
+                f.write(np.clip(x * 3000, -32768, 32767).astype('<i2').tobytes())
+    else:
+        raise Exception(f'Unexpected audio format: {audio_format}')
+
+    import cv2
+    w = cv2.VideoWriter(f'{dirname}/video.avi', cv2.VideoWriter_fourcc(*'MJPG'), video_fps, (video_width, video_height))
+    yy, xx = np.mgrid[0:video_height, 0:video_width]
+    for i in range(int(duration_sec * video_fps)):
+        frame = ((xx + yy + i * 4) % 256).astype(np.uint8)
+        w.write(np.stack([frame, frame, frame], axis=2))
+    w.release()
+
+def _get_proc_status_kb(key: str):
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(f'{key}:'):
+                return int(line.split()[1])
+    return None
+
+def _run_in_child(func, conn):
+    try:
+        try:
+            # reset the peak resident memory (VmHWM) to the current value
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+        rss_start_kb = _get_proc_status_kb('VmRSS')
+        timer = time.perf_counter()
+        extra = func()
+        elapsed = time.perf_counter() - timer
+        hwm_kb = _get_proc_status_kb('VmHWM')
+        result = {'elapsed_sec': elapsed}
+        if rss_start_kb is not None and hwm_kb is not None:
+            result['peak_memory_mb'] = max(0, hwm_kb - rss_start_kb) / 1024
+        if isinstance(extra, dict):
+            result.update(extra)
+        conn.send(result)
+    except Exception as e:
+        conn.send({'error': f'{type(e).__name__}: {e}'})
+    finally:
+        conn.close()
+
+def _measure(func):
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe()
+    p = ctx.Process(target=_run_in_child, args=(func, child_conn))
+    p.start()
+    result = parent_conn.recv()
+    p.join()
+    return result
+
+def _time_query(query: dict, *, num_warm: int=10):
+    # the first (cold) call and the mean of the following (warm) calls
+    from isa.RtcsharePlugin import IsaService
+    timer = time.perf_counter()
+    IsaService.handle_query(query, dir='')
+    cold = time.perf_counter() - timer
+    timer = time.perf_counter()
+    for _ in range(num_warm):
+        IsaService.handle_query(query, dir='')
+    warm = (time.perf_counter() - timer) / num_warm
+    return {'cold_sec': cold, 'warm_sec': warm}
+
+def _benchmark_scale(project_dir: str, *, scale: str, args):
+    import zarr
+    from isa.init import _initialize_or_update_session_dir
+    from isa.create_spectrograms import create_spectrograms, _auto_detect_spectrogram_maxval
+    from isa._spectrogram_pyramid import downsample_spectrogram_using_max
+    from isa.auto_detect_vocalizations import auto_detect_vocalizations, _auto_detect_vocalizations
+    from isa._video_proxy import _create_video_proxy, _get_video_proxy_opts
+    from isa._project_config import _set_project_config_value, _get_session_config_file
+    from isa._annotations_store import _get_annotations
+    from isa._similarity_index import _get_similarity_index_opts, _get_fingerprint_params, _update_session_fingerprints
+
+    session = 'session1'
+    os.chdir(project_dir)
+    _set_project_config_value('sessions', [session])
+    results = {}
+    def run(stage: str, func):
+        r = _measure(func)
+        results[stage] = r
+        if 'error' in r:
+            raise Exception(f'{scale} {stage}: {r["error"]}')
+        peak = f', peak {r["peak_memory_mb"]:.1f} MB' if 'peak_memory_mb' in r else ''
+        print(f'  {stage}: {r["elapsed_sec"]:.3f} sec{peak}')
+
+    # the stages that write files run in the child, their outputs are used
+    # by the next stages
+    run('init_session', lambda: _initialize_or_update_session_dir(session))
+    run('create_spectrograms', lambda: create_spectrograms(session, streaming=False))
+    run('create_spectrograms_streaming', lambda: create_spectrograms(session, streaming=True))
+    run('auto_detect_vocalizations', lambda: auto_detect_vocalizations(session, f'./{session}/annotations.json'))
+    run('create_video_proxy', lambda: _create_video_proxy(f'./{session}/video.avi', f'./{session}/video_proxy.bin', opts=_get_video_proxy_opts(None)))
+    fingerprint_params = _get_fingerprint_params(_get_session_config_file(session).to_dict(), opts=_get_similarity_index_opts(None), spectrograms_key={}, version=1)
+    run('update_session_fingerprints', lambda: _update_session_fingerprints(session, params=fingerprint_params))
+
+    root_group = zarr.open(f'./{session}/spectrogram_for_gui.zarr', mode='r')
+    spectrogram_for_gui = root_group['spectrogram'][:]
+    sr_spectrogram = root_group.attrs['spectrogram_sr_hz']
+    spectrogram_channel_0 = zarr.open(f'./{session}/spectrograms.zarr', mode='r')['spectrograms'][0]
+    run('downsample_spectrogram_using_max', lambda: downsample_spectrogram_using_max(spectrogram_for_gui, ds_factor=3))
+    run('_auto_detect_spectrogram_maxval', lambda: _auto_detect_spectrogram_maxval(spectrogram_channel_0, sr_spectrogram=sr_spectrogram))
+    run('_auto_detect_vocalizations', lambda: _auto_detect_vocalizations(spectrogram_for_gui, sampling_frequency=sr_spectrogram))
+
+    os.environ['RTCSHARE_DIR'] = project_dir
+    session_path = f'rtcshare://{session}'
+    duration_sec = spectrogram_for_gui.shape[0] / sr_spectrogram
+    t1 = duration_sec / 2
+    run('query_get_spectrogram_tile_10s', lambda: _time_query({'type': 'get_spectrogram_tile', 'session_path': session_path, 't1_sec': t1, 't2_sec': t1 + 10, 'target_width': 1000}))
+    run('query_get_spectrogram_tile_full', lambda: _time_query({'type': 'get_spectrogram_tile', 'session_path': session_path, 't1_sec': 0, 't2_sec': duration_sec, 'target_width': 1000}))
+    run('query_get_spectrogram_tile_full_200_bins', lambda: _time_query({'type': 'get_spectrogram_tile', 'session_path': session_path, 't1_sec': 0, 't2_sec': duration_sec, 'target_width': 1000, 'target_height': 200}))
+    run('query_get_spectrogram_stats', lambda: _time_query({'type': 'get_spectrogram_stats', 'session_path': session_path, 'f1_hz': 20000, 'f2_hz': 60000}))
+    run('query_get_vocalizations_in_window', lambda: _time_query({'type': 'get_vocalizations_in_window', 'session_path': session_path, 'start_frame': int(t1 * sr_spectrogram), 'end_frame': int((t1 + 10) * sr_spectrogram)}))
+    run('query_get_audio_clip_500ms', lambda: _time_query({'type': 'get_audio_clip', 'session_path': session_path, 'start_sec': t1, 'end_sec': t1 + 0.5}))
+    run('query_get_video_proxy_frames', lambda: _time_query({'type': 'get_video_proxy_frames', 'session_path': session_path, 'start_frame': int(t1 * args.video_fps), 'end_frame': int(t1 * args.video_fps) + 20}))
+    vocalizations = _get_annotations(f'./{session}/annotations.json')['vocalizations']
+    if len(vocalizations) > 0:
+        run('query_find_similar_vocalizations', lambda: _time_query({'type': 'find_similar_vocalizations', 'project_path': 'rtcshare://', 'session': session, 'vocalization_id': vocalizations[0]['vocalizationId'], 'k': 20}))
+    run('query_patch_annotations', lambda: _time_query({'type': 'patch_annotations', 'session_path': session_path, 'ops': [{'op': 'add', 'vocalization': {'vocalizationId': 'benchmark', 'startFrame': 0, 'endFrame': 10, 'labels': ['benchmark']}}, {'op': 'delete', 'vocalizationId': 'benchmark'}]}))
+    return results
+
+def _compare_with_baseline(results: dict, baseline: dict, *, tolerance: float):
+    # returns the (scale, stage, metric) entries that are slower or use more
+    # memory than the baseline by more than the tolerance
+    regressions = []
+    print('')
+    print(f'{"scale":<12} {"stage":<36} {"metric":<16} {"baseline":>10} {"current":>10} {"ratio":>7}')
+    for scale, stages in results['results'].items():
+        for stage, r in stages.items():
+            b = baseline.get('results', {}).get(scale, {}).get(stage, None)
+            if b is None:
+                continue
+            for metric in ['elapsed_sec', 'cold_sec', 'warm_sec', 'peak_memory_mb']:
+                if metric not in r or metric not in b or b[metric] <= 0:
+                    continue
+                ratio = r[metric] / b[metric]
+                flag = ''
+                # ignore differences that are too small to be measured reliably
+                min_value = 1 if metric == 'peak_memory_mb' else 0.001
+                if ratio > 1 + tolerance and r[metric] - b[metric] > min_value:
+                    flag = ' *'
+                    regressions.append((scale, stage, metric))
+                print(f'{scale:<12} {stage:<36} {metric:<16} {b[metric]:>10.4g} {r[metric]:>10.4g} {ratio:>7.2f}{flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--durations', type=str, default='30,120', help='Comma-separated session durations in seconds (at least 30)')
+    parser.add_argument('--sr-hz', type=int, default=125000)
+    parser.add_argument('--num-channels', type=int, default=4)
+    parser.add_argument('--audio-format', type=str, default='h5', choices=['h5', 'wav'])
+    parser.add_argument('--video-fps', type=float, default=30)
+    parser.add_argument('--video-width', type=int, default=320)
+    parser.add_argument('--video-height', type=int, default=240)
+    parser.add_argument('--output', type=str, default='benchmark_pipeline_results.json')
+    parser.add_argument('--baseline', type=str, default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown compared with the baseline')
+    args = parser.parse_args()
+
+    import isa
+    results = {
+        'metadata': {
+            'isa_version': isa.__version__,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args)
+        },
+        'results': {}
+    }
+    output_fname = os.path.abspath(args.output)
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for duration_sec in [float(d) for d in args.durations.split(',')]:
+            scale = f'{duration_sec:g}s'
+            project_dir = f'{tmpdir}/{scale}'
+            os.makedirs(project_dir)
+            print(f'{scale}: generating session ({args.num_channels} channels at {args.sr_hz} Hz, {args.audio_format})')
+            _generate_session(
+                f'{project_dir}/session1',
+                duration_sec=duration_sec,
+                sr_hz=args.sr_hz,
+                num_channels=args.num_channels,
+                audio_format=args.audio_format,
+                video_fps=args.video_fps,
+                video_width=args.video_width,
+                video_height=args.video_height
+            )
+            results['results'][scale] = _benchmark_scale(project_dir, scale=scale, args=args)
+            os.chdir(cwd)
+            shutil.rmtree(project_dir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+    with open(output_fname, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f'Wrote {output_fname}')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = _compare_with_baseline(results, baseline, tolerance=args.tolerance)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} regressions compared with {args.baseline}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
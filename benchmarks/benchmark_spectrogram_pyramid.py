@@ -0,0 +1,79 @@
+# Build time and on-disk size of the spectrogram_ds{N} pyramid for a
+# synthetic uint8 spectrogram, for several compressors, reducers and numbers
+# of threads.
+#
+# Usage: python benchmarks/benchmark_spectrogram_pyramid.py [--duration-hours 1]
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import zarr
+from isa._spectrogram_pyramid import _get_spectrogram_pyramid_opts, _create_spectrogram_array, _build_spectrogram_pyramid
+
+
+def _get_dir_size(path: str):
+    total = 0
+    for root, _, fnames in os.walk(path):
+        for fname in fnames:
+            total += os.path.getsize(os.path.join(root, fname))
+    return total
+
+def _generate_spectrogram(*, num_frames: int, num_frequencies: int, seed: int=0, block_num_frames: int=100000):
+    # mostly low values with sparse bright calls, like the scaled spectrogram_for_gui
+    # (generated in blocks, so that only the uint8 array is held in memory)
+    rng = np.random.default_rng(seed)
+    x = np.empty((num_frames, num_frequencies), dtype=np.uint8)
+    for i1 in range(0, num_frames, block_num_frames):
+        i2 = min(i1 + block_num_frames, num_frames)
+        x[i1:i2] = np.minimum(rng.exponential(6, size=(i2 - i1, num_frequencies)), 255)
+    starts = rng.integers(0, num_frames, size=num_frames // 1000)
+    for i1 in starts:
+        f1 = int(rng.integers(0, num_frequencies))
+        x[i1:i1 + 100, f1:f1 + 10] = np.minimum(x[i1:i1 + 100, f1:f1 + 10] + rng.uniform(50, 250), 255)
+    return x
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration-hours', type=float, default=1)
+    parser.add_argument('--sr-spectrogram', type=float, default=976.5625)
+    parser.add_argument('--num-frequencies', type=int, default=257)
+    args = parser.parse_args()
+
+    num_frames = int(args.duration_hours * 3600 * args.sr_spectrogram)
+    print(f'Generating {num_frames} x {args.num_frequencies} uint8 spectrogram')
+    x = _generate_spectrogram(num_frames=num_frames, num_frequencies=args.num_frequencies)
+
+    configs = [
+        {'num_threads': 1},
+        {'num_threads': 8},
+        {'num_threads': 8, 'compressor': {'id': 'blosc', 'cname': 'lz4', 'clevel': 5, 'shuffle': 'bitshuffle'}},
+        {'num_threads': 8, 'compressor': {'id': 'blosc', 'cname': 'zstd', 'clevel': 3, 'shuffle': 'shuffle'}},
+        {'num_threads': 8, 'compressor': {'id': 'blosc', 'cname': 'zstd', 'clevel': 5, 'shuffle': 'bitshuffle'}},
+        {'num_threads': 8, 'compressor': {'id': 'zstd', 'level': 5}},
+        {'num_threads': 8, 'chunk_num_frames': 4096, 'compressor': {'id': 'blosc', 'cname': 'zstd', 'clevel': 5, 'shuffle': 'bitshuffle'}},
+        {'num_threads': 8, 'reducer': 'mean'}
+    ]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for config in configs:
+            pyramid_opts = _get_spectrogram_pyramid_opts(config)
+            path = f'{tmpdir}/spectrogram_for_gui.zarr'
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            root_group = zarr.open(path, mode='w')
+            timer = time.time()
+            _create_spectrogram_array(root_group, 'spectrogram', shape=x.shape, pyramid_opts=pyramid_opts, data=x)
+            elapsed_level_0 = time.time() - timer
+            _build_spectrogram_pyramid(root_group, pyramid_opts=pyramid_opts)
+            elapsed_total = time.time() - timer
+            size_mb = _get_dir_size(path) / 1e6
+            print(f'{config}: level 0 {elapsed_level_0:.2f} sec, pyramid {elapsed_total - elapsed_level_0:.2f} sec, {size_mb:.1f} MB (raw {x.nbytes / 1e6:.1f} MB)')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# Import time and loaded modules of "import isa", "isa --help" and the
+# rtcshare plugin, each in a fresh interpreter. Fails if one of them loads a
+# heavy dependency or takes longer than --max-sec.
+#
+# Usage: python benchmarks/benchmark_startup.py [--max-sec 1]
+
+import sys
+import json
+import argparse
+import subprocess
+
+
+_heavy_modules = ['cv2', 'h5py', 'zarr', 'numcodecs', 'scipy', 'pandas', 'matplotlib', 'numpy']
+
+_cases = {
+    'import isa': 'import isa',
+    'isa --help': 'from isa.cli import cli\ntry:\n    cli(["--help"])\nexcept SystemExit:\n    pass',
+    'rtcshare plugin': 'import isa\nisa.RtcsharePlugin'
+}
+
+def _run_case(code: str):
+    script = '\n'.join([
+        'import sys, time, json, io, contextlib',
+        'timer = time.time()',
+        'with contextlib.redirect_stdout(io.StringIO()):',
+        *['    ' + line for line in code.split('\n')],
+        'elapsed = time.time() - timer',
+        'print(json.dumps({"elapsed_sec": elapsed, "modules": list(sys.modules.keys())}))'
+    ])
+    output = subprocess.check_output([sys.executable, '-c', script])
+    return json.loads(output.decode('utf-8').strip().split('\n')[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-sec', type=float, default=1)
+    parser.add_argument('--num-runs', type=int, default=3)
+    args = parser.parse_args()
+
+    failed = False
+    for name, code in _cases.items():
+        results = [_run_case(code) for _ in range(args.num_runs)]
+        elapsed = min(r['elapsed_sec'] for r in results)
+        modules = results[0]['modules']
+        heavy = [m for m in _heavy_modules if m in modules]
+        print(f'{name}: {elapsed:.3f} sec, {len(modules)} modules, heavy: {heavy}')
+        if len(heavy) > 0 or elapsed > args.max_sec:
+            failed = True
+    if failed:
+        raise Exception('Startup regression')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Compares the batched STFT backend (isa._stft) with the previous per-channel
+# matplotlib specgram path on synthetic 4-channel audio.
+#
+# Usage: python benchmarks/benchmark_stft.py [--duration-sec 60]
+
+import time
+import argparse
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.pyplot import specgram
+from isa._stft import _stft_psd
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration-sec', type=float, default=60)
+    parser.add_argument('--sr-hz', type=float, default=250000)
+    parser.add_argument('--num-channels', type=int, default=4)
+    args = parser.parse_args()
+
+    sr_hz = args.sr_hz
+    num_samples = int(args.duration_sec * sr_hz)
+    print(f'Generating {args.num_channels} channels x {num_samples} samples at {sr_hz} Hz')
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(num_samples, args.num_channels))
+
+    timer = time.time()
+    spectrograms = []
+    for channel_ind in range(X.shape[1]):
+        s, frequencies_1, times_1, im = specgram(X[:, channel_ind], NFFT=512, noverlap=256, Fs=sr_hz)
+        spectrograms.append(s.T)
+    spectrogram_sum_1 = sum(spectrograms)
+    elapsed_specgram = time.time() - timer
+    print(f'matplotlib specgram: {elapsed_specgram:.3f} sec')
+
+    timer = time.time()
+    spectrograms_2, spectrogram_sum_2, frequencies_2, times_2 = _stft_psd(X, sr_hz=sr_hz, nfft=512, noverlap=256)
+    elapsed_stft = time.time() - timer
+    print(f'isa._stft: {elapsed_stft:.3f} sec')
+    print(f'Speedup: {elapsed_specgram / elapsed_stft:.2f}x')
+
+    # identical to specgram (see also check_stft_parity.py)
+    assert np.array_equal(frequencies_1, frequencies_2)
+    assert np.array_equal(times_1, times_2)
+    for channel_ind in range(X.shape[1]):
+        assert np.array_equal(spectrograms[channel_ind], spectrograms_2[channel_ind])
+    assert np.array_equal(spectrogram_sum_1, spectrogram_sum_2)
+    print('Identical to specgram')
+
+if __name__ == '__main__':
+    main()
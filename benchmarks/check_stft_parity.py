@@ -0,0 +1,43 @@
+# Checks that isa._stft gives exactly (bit for bit) the spectrograms of the
+# per-channel matplotlib specgram path that it replaced, and their sum over
+# channels, for several sample types, lengths, batch sizes and sampling rates.
+#
+# Usage: python benchmarks/check_stft_parity.py
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.pyplot import specgram
+from isa._stft import _stft_psd
+
+
+def _check(X: np.ndarray, *, sr_hz, nfft: int=512, noverlap: int=256, batch_num_frames: int=4096):
+    spectrograms_1 = []
+    for channel_ind in range(X.shape[1]):
+        s, frequencies_1, times_1, im = specgram(X[:, channel_ind], NFFT=nfft, noverlap=noverlap, Fs=sr_hz)
+        spectrograms_1.append(s.T)
+    spectrogram_sum_1 = sum(spectrograms_1)
+    spectrograms_2, spectrogram_sum_2, frequencies_2, times_2 = _stft_psd(X, sr_hz=sr_hz, nfft=nfft, noverlap=noverlap, batch_num_frames=batch_num_frames)
+    label = f'{X.shape[1]} x {X.shape[0]} {X.dtype}, sr_hz={sr_hz!r}, nfft={nfft}, noverlap={noverlap}, batch_num_frames={batch_num_frames}'
+    assert np.array_equal(frequencies_1, frequencies_2), label
+    assert np.array_equal(times_1, times_2), label
+    for channel_ind in range(X.shape[1]):
+        assert np.array_equal(spectrograms_1[channel_ind], spectrograms_2[channel_ind]), f'channel {channel_ind}: {label}'
+    assert np.array_equal(spectrogram_sum_1, spectrogram_sum_2), f'sum: {label}'
+    print(f'OK: {label}')
+
+def main():
+    rng = np.random.default_rng(0)
+    num_samples = 20 * 125000
+    X = rng.normal(size=(num_samples, 4))
+    _check(X, sr_hz=125000)
+    _check(X, sr_hz=125000.0)
+    _check(X[:100003], sr_hz=250000, batch_num_frames=100)
+    _check(X[:100000].astype(np.float32), sr_hz=125000)
+    _check((X[:100000] * 3000).astype(np.int16), sr_hz=125000)
+    _check(X[:100000, :1], sr_hz=44100, nfft=256, noverlap=128)
+    _check(X[:100000, :2], sr_hz=44100, nfft=255, noverlap=100)
+
+
+if __name__ == '__main__':
+    main()
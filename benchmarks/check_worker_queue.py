@@ -0,0 +1,114 @@
+# Runs several isa worker processes on a temporary project, kills one of
+# them while it holds a lease and checks that every session is processed to
+# completion exactly once and never by two workers at the same time. The
+# update of a session is replaced by a sleep that records when each worker
+# started and finished it, so that only the queue is exercised.
+#
+# Usage: python benchmarks/check_worker_queue.py [--num-workers 4] [--num-sessions 12]
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+
+
+_worker_script = '''
+import os, sys, json, time
+import isa.worker
+# isa.worker is also the name of the worker function in isa
+worker_module = sys.modules['isa.worker']
+def fake_update(session, *, opts):
+    def log(event):
+        with open('events.jsonl', 'a') as f:
+            f.write(json.dumps({'session': session, 'pid': os.getpid(), 'event': event, 't': time.time()}) + '\\n')
+    log('start')
+    time.sleep(float(sys.argv[2]))
+    log('end')
+    return {'session': session, 'success': True, 'error': None, 'elapsed_sec': 0, 'log_fname': '', 'profile_events': []}
+worker_module._update_session_dir_with_log = fake_update
+worker_module.worker(lease_sec=float(sys.argv[1]), poll_sec=0.1)
+'''
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--num-sessions', type=int, default=12)
+    parser.add_argument('--lease-sec', type=float, default=2)
+    parser.add_argument('--session-sec', type=float, default=1)
+    args = parser.parse_args()
+
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as project_dir:
+        sessions = [f'session{i}' for i in range(args.num_sessions)]
+        with open(f'{project_dir}/isa-project.yaml', 'w') as f:
+            f.write('sessions:\n' + ''.join([f'- {s}\n' for s in sessions]))
+        env = {**os.environ, 'PYTHONPATH': package_dir + os.pathsep + os.environ.get('PYTHONPATH', '')}
+        def start_worker():
+            return subprocess.Popen(
+                [sys.executable, '-c', _worker_script, str(args.lease_sec), str(args.session_sec)],
+                cwd=project_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        workers = [start_worker() for _ in range(args.num_workers)]
+
+        # kill the first worker that starts a session, while it holds the lease
+        events_fname = f'{project_dir}/events.jsonl'
+        killed_pid = None
+        while killed_pid is None:
+            time.sleep(0.05)
+            if all(w.poll() is not None for w in workers):
+                raise Exception('All the workers exited before starting a session')
+            for e in _load_events(events_fname):
+                if e['event'] == 'start':
+                    killed_pid = e['pid']
+                    break
+        killed = [w for w in workers if w.pid == killed_pid][0]
+        killed.send_signal(signal.SIGKILL)
+        killed.wait()
+        print(f'Killed worker {killed_pid}')
+
+        for w in workers:
+            if w is not killed:
+                if w.wait(timeout=args.num_sessions * (args.session_sec + args.lease_sec) * 2 + 30) != 0:
+                    raise Exception(f'Worker {w.pid} failed')
+
+        events = _load_events(events_fname)
+        intervals = {s: [] for s in sessions}
+        starts = {}
+        for e in events:
+            if e['event'] == 'start':
+                starts[(e['session'], e['pid'])] = e['t']
+            else:
+                intervals[e['session']].append((starts.pop((e['session'], e['pid'])), e['t'], e['pid']))
+        killed_sessions = [s for (s, pid) in starts.keys()]
+        if [pid for (s, pid) in starts.keys()] != [killed_pid]:
+            raise Exception(f'Unexpected unfinished sessions: {starts}')
+        for s in sessions:
+            if len(intervals[s]) != 1:
+                raise Exception(f'{s} was processed {len(intervals[s])} times: {intervals[s]}')
+            with open(f'{project_dir}/.isa-queue/{s}.status.json', 'r') as f:
+                status = json.load(f)
+            if status['state'] != 'done':
+                raise Exception(f'{s} is {status["state"]}')
+            expected_attempts = 2 if s in killed_sessions else 1
+            if status['attempts'] != expected_attempts:
+                raise Exception(f'{s} has {status["attempts"]} attempts, expected {expected_attempts}')
+        # the killed worker may have been processing the session when it was taken over
+        for s in killed_sessions:
+            t1, t2, pid = intervals[s][0]
+            if t1 < starts[(s, killed_pid)] + args.lease_sec:
+                raise Exception(f'{s} was taken over before its lease expired')
+        print(f'OK: {len(sessions)} sessions processed exactly once by {args.num_workers} workers ({killed_sessions[0]} taken over after the worker was killed)')
+
+def _load_events(fname: str):
+    if not os.path.exists(fname):
+        return []
+    with open(fname, 'r') as f:
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+
+if __name__ == '__main__':
+    main()
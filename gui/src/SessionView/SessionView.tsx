@@ -16,7 +16,7 @@ type Props = {
 
 const SessionView: FunctionComponent<Props> = ({width, height}) => {
     const [video, setVideo] = useState<{uri: string, width: number, height: number, samplingFrequency: number, numFrames: number}>()
-	const [spectrogram, setSpectrogram] = useState<{uri: string, samplingFrequency: number, durationSec: number, numFrequencies: number}>()
+	const [spectrogram, setSpectrogram] = useState<{uri: string, samplingFrequency: number, durationSec: number, numFrequencies: number, frequencyDsFactors: number[]}>()
     useEffect(() => {
         (async () => {
             const a = await getFileData('$dir/isa-session.yaml', () => {}, {responseType: 'text'})
@@ -28,11 +28,21 @@ const SessionView: FunctionComponent<Props> = ({width, height}) => {
                 samplingFrequency: isaSession.video_fps,
 				numFrames: isaSession.video_num_frames
             })
+			let frequencyDsFactors = [1]
+			try {
+				// written with the spectrogram pyramid (not there for older sessions)
+				const zattrs = JSON.parse(await getFileData('$dir/spectrogram_for_gui.zarr/.zattrs', () => {}, {responseType: 'text'}))
+				if (zattrs.pyramid) frequencyDsFactors = zattrs.pyramid.frequency_ds_factors
+			}
+			catch(err) {
+				console.warn('Unable to load the spectrogram pyramid info', err)
+			}
 			setSpectrogram({
 				uri: `$dir/spectrogram_for_gui.zarr`,
 				samplingFrequency: isaSession.spectrogram_sr_hz,
 				durationSec: isaSession.audio_duration_sec,
-				numFrequencies: isaSession.spectrogram_num_frequencies
+				numFrequencies: isaSession.spectrogram_num_frequencies,
+				frequencyDsFactors
 			})
         })()
     }, [])
@@ -59,6 +69,7 @@ type ChildProps = {
         samplingFrequency: number
 		durationSec: number
 		numFrequencies: number
+		frequencyDsFactors: number[]
     }
     video?: {
         uri: string,
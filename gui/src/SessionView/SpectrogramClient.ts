@@ -4,9 +4,10 @@ const chunkSize = 10000
 
 class SpectrogramClient {
     #onDataRecievedCallbacks: (() => void)[] = []
-    #chunks: {[dsFactor: number]: {[chunkIndex: number]: Uint8Array}} = {}
+    #chunks: {[levelCode: string]: {[chunkIndex: number]: Uint8Array}} = {}
     #fetchingChunks = new Set<string>()
-    constructor(private uri: string, public samplingFrequency: number, public durationSec: number, public numFrequencies: number) {
+    // frequencyDsFactors are the frequency downsampling factors of the pyramid levels (see the pyramid attribute of the zarr group)
+    constructor(private uri: string, public samplingFrequency: number, public durationSec: number, public numFrequencies: number, public frequencyDsFactors: number[] = [1]) {
 
     }
     onDataRecieved(cb: () => void) {
@@ -15,26 +16,40 @@ class SpectrogramClient {
     public get numTimepoints() {
         return Math.ceil(this.durationSec * this.samplingFrequency)
     }
-    getValue(dsFactor: number, t: number, f: number) {
+    numFrequenciesForLevel(frequencyDsFactor: number) {
+        return Math.ceil(this.numFrequencies / frequencyDsFactor)
+    }
+    chooseFrequencyDsFactor(targetHeight: number) {
+        // the largest downsampling factor that keeps at least targetHeight frequency bins
+        let factor = 1
+        for (const m of this.frequencyDsFactors) {
+            if ((m > factor) && (this.numFrequenciesForLevel(m) >= targetHeight)) factor = m
+        }
+        return factor
+    }
+    getValue(dsFactor: number, t: number, f: number, frequencyDsFactor: number = 1) {
+        const levelCode = `${dsFactor}-${frequencyDsFactor}`
         const chunkIndex = Math.floor(t / chunkSize)
-        const chunk = (this.#chunks[dsFactor] || {})[chunkIndex]
+        const chunk = (this.#chunks[levelCode] || {})[chunkIndex]
         if (!chunk) {
-            this._fetchChunk(dsFactor, chunkIndex) // initiate fetching of the chunk
+            this._fetchChunk(dsFactor, frequencyDsFactor, chunkIndex) // initiate fetching of the chunk
             return NaN
         }
         const i = Math.floor(t) % chunkSize
-        return chunk[i * this.numFrequencies + f]
+        return chunk[i * this.numFrequenciesForLevel(frequencyDsFactor) + f]
     }
-    async _fetchChunk(dsFactor: number, i: number) {
-        const code = `${dsFactor}-${i}`
+    async _fetchChunk(dsFactor: number, frequencyDsFactor: number, i: number) {
+        const levelCode = `${dsFactor}-${frequencyDsFactor}`
+        const code = `${levelCode}-${i}`
         if (this.#fetchingChunks.has(code)) return
         this.#fetchingChunks.add(code)
+        const timeLevelName = dsFactor === 1 ? '/spectrogram' : `/spectrogram_ds${dsFactor}`
         const {result, binaryPayload} = await serviceQuery(
             'zarr',
             {
                 type: 'get_array_chunk',
                 path: this.uri,
-                name: dsFactor === 1 ? '/spectrogram' : `/spectrogram_ds${dsFactor}`,
+                name: frequencyDsFactor === 1 ? timeLevelName : `${timeLevelName}_fds${frequencyDsFactor}`,
                 slices: [
                     {
                         start: i * chunkSize,
@@ -43,7 +58,7 @@ class SpectrogramClient {
                     },
                     {
                         start: 0,
-                        stop: this.numFrequencies,
+                        stop: this.numFrequenciesForLevel(frequencyDsFactor),
                         step: 1
                     }
                 ]
@@ -53,8 +68,8 @@ class SpectrogramClient {
         if (result.dtype !== 'uint8') {
             throw Error(`Unexpected data type for spectrogram zarr array: ${result.dataType}`)
         }
-        if (!this.#chunks[dsFactor]) this.#chunks[dsFactor] = {}
-        this.#chunks[dsFactor][i] = new Uint8Array(binaryPayload)
+        if (!this.#chunks[levelCode]) this.#chunks[levelCode] = {}
+        this.#chunks[levelCode][i] = new Uint8Array(binaryPayload)
         this.#onDataRecievedCallbacks.forEach(cb => {cb()})
     }
 }
@@ -11,6 +11,7 @@ type Props ={
 		samplingFrequency: number
 		durationSec: number
 		numFrequencies: number
+		frequencyDsFactors?: number[]
 	}
 }
 
@@ -23,7 +24,7 @@ const SpectrogramWidget: FunctionComponent<Props> = ({width, height, spectrogram
 	const [refreshCode, setRefreshCode] = useState(0)
 	useEffect(() => {
 		if (!spectrogram) return
-		const spectrogramClient = new SpectrogramClient(spectrogram.uri, spectrogram.samplingFrequency, spectrogram.durationSec, spectrogram.numFrequencies)
+		const spectrogramClient = new SpectrogramClient(spectrogram.uri, spectrogram.samplingFrequency, spectrogram.durationSec, spectrogram.numFrequencies, spectrogram.frequencyDsFactors)
 		setSpectrogramClient(spectrogramClient)
 	}, [spectrogram])
 	if (!spectrogramClient) return <div>Loading spectrogram client</div>
@@ -70,6 +71,8 @@ const SpectrogramWidgetChild: FunctionComponent<ChildProps> = ({width, height, s
 		let i1 = Math.floor(visibleStartTimeSec * samplingFrequency) - 1
 		let i2 = Math.floor(visibleEndTimeSec * samplingFrequency) + 1
 		const downsampleFactor = determinePower3DownsampleFactor(i2 - i1, panelWidth)
+		// the image is drawn with a height of panelHeight - 100 (see paintPanel)
+		const frequencyDownsampleFactor = spectrogramClient.chooseFrequencyDsFactor(panelHeight - 100)
 
 		const i1_ds = Math.floor(i1 / downsampleFactor)
 		const i2_ds = Math.ceil(i2 / downsampleFactor)
@@ -79,10 +82,10 @@ const SpectrogramWidgetChild: FunctionComponent<ChildProps> = ({width, height, s
 		
 		let imageData: ImageData | undefined = undefined
 		const data: number[] = []
-		const nF = spectrogramClient.numFrequencies
+		const nF = spectrogramClient.numFrequenciesForLevel(frequencyDownsampleFactor)
 		for (let ff = 0; ff < nF; ff++) {
 			for (let it = 0; it < nT_ds; it++) {
-				const val = spectrogramClient.getValue(downsampleFactor, i1_ds + it, nF - 1 - ff)
+				const val = spectrogramClient.getValue(downsampleFactor, i1_ds + it, nF - 1 - ff, frequencyDownsampleFactor)
 				const c = colorForSpectrogramValue(val)
 				data.push(...c)
 			}
@@ -91,7 +94,7 @@ const SpectrogramWidgetChild: FunctionComponent<ChildProps> = ({width, height, s
 		imageData = new ImageData(clampedData, nT_ds, nF)
 		
 		return {imageData, i1, i2}
-    }, [spectrogramClient, samplingFrequency, visibleStartTimeSec, visibleEndTimeSec, nTimepoints, panelWidth, refreshCode])
+    }, [spectrogramClient, samplingFrequency, visibleStartTimeSec, visibleEndTimeSec, nTimepoints, panelWidth, panelHeight, refreshCode])
 
 	const paintPanel = useCallback((context: CanvasRenderingContext2D, props: PanelProps) => {
 		if (!imageDataInfo) return
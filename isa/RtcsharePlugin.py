@@ -1,6 +1,6 @@
 from typing import Tuple, Union
 import os
-import json
+from ._annotations_store import _AnnotationsVersionConflict, _get_annotations, _set_annotations, _patch_annotations
 
 
 class RtcsharePlugin:
@@ -12,17 +12,173 @@ class IsaService:
         # todo: authenticate user
         type0 = query['type']
         if type0 == 'set_annotations':
-            session_path = query['session_path']
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
             annotations = query['annotations']
-            if session_path.startswith('$dir'):
-                session_path = f'{dir}/{session_path[len("$dir"):]}'
-            if not session_path.startswith('rtcshare://'):
-                raise Exception(f'Invalid session path: {session_path}')
-            session_relpath = session_path[len('rtcshare://'):]
-            session_fullpath = os.path.join(os.environ['RTCSHARE_DIR'], session_relpath)
-            annotations_fname = f'{session_fullpath}/annotations.json'
-            with open(annotations_fname, 'w') as f:
-                json.dump(annotations, f)
-            return {'success': True}, b''
+            try:
+                version = _set_annotations(_get_annotations_fname(session_fullpath, query), annotations, expected_version=query.get('expected_version', None))
+            except _AnnotationsVersionConflict as e:
+                return {'success': False, 'error': str(e), 'version': e.version}, b''
+            return {'success': True, 'version': version}, b''
+        elif type0 == 'patch_annotations':
+            # add, update or delete individual vocalizations, see _patch_annotations
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
+            try:
+                version = _patch_annotations(_get_annotations_fname(session_fullpath, query), query['ops'], expected_version=query.get('expected_version', None))
+            except _AnnotationsVersionConflict as e:
+                return {'success': False, 'error': str(e), 'version': e.version}, b''
+            return {'success': True, 'version': version}, b''
+        elif type0 == 'get_annotations':
+            # including the edits that are not yet compacted into annotations.json
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
+            annotations = _get_annotations(_get_annotations_fname(session_fullpath, query))
+            return {'success': True, 'annotations': annotations, 'version': annotations['version']}, b''
+        elif type0 == 'get_vocalizations_in_window':
+            # the vocalizations overlapping [start_frame, end_frame) sorted by
+            # start frame, optionally only those with one of the labels
+            from ._vocalization_index import _get_vocalizations_in_window
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
+            result = _get_vocalizations_in_window(
+                _get_annotations_fname(session_fullpath, query),
+                start_frame=query['start_frame'],
+                end_frame=query['end_frame'],
+                labels=query.get('labels', None),
+                offset=query.get('offset', 0),
+                limit=query.get('limit', 1000)
+            )
+            return {'success': True, **result}, b''
+        elif type0 == 'get_vocalization_counts':
+            # the number of vocalizations overlapping [start_frame, end_frame) per label
+            from ._vocalization_index import _get_vocalization_counts
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
+            result = _get_vocalization_counts(
+                _get_annotations_fname(session_fullpath, query),
+                start_frame=query['start_frame'],
+                end_frame=query['end_frame']
+            )
+            return {'success': True, **result}, b''
+        elif type0 == 'get_spectrogram_tile':
+            # the coarsest pyramid level with at least target_width frames
+            # in the time range (and target_height frequency bins in the
+            # frequency range if given), as uint8 (frames x frequencies)
+            from ._spectrogram_tiles import _get_spectrogram_tile
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
+            info, tile = _get_spectrogram_tile(
+                f'{session_fullpath}/spectrogram_for_gui.zarr',
+                t1_sec=query['t1_sec'],
+                t2_sec=query['t2_sec'],
+                target_width=query['target_width'],
+                f1_hz=query.get('f1_hz', None),
+                f2_hz=query.get('f2_hz', None),
+                target_height=query.get('target_height', None)
+            )
+            return {'success': True, 'tile': info}, tile.tobytes()
+        elif type0 == 'get_spectrogram_stats':
+            # per-chunk maxima and means, histogram, percentiles and default
+            # contrast limits of a frequency band (the whole spectrogram by default)
+            from ._spectrogram_stats import _get_spectrogram_stats_summary
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
+            stats = _get_spectrogram_stats_summary(
+                f'{session_fullpath}/spectrogram_for_gui.zarr',
+                f1_hz=query.get('f1_hz', None),
+                f2_hz=query.get('f2_hz', None)
+            )
+            if stats is None:
+                return {'success': False, 'error': 'No spectrogram statistics, run isa update'}, b''
+            return {'success': True, 'stats': stats}, b''
+        elif type0 == 'get_audio_clip':
+            # the raw audio of a time window (start_sec, end_sec) or of a
+            # window of spectrogram frames (start_frame, end_frame, such as
+            # those of a vocalization), optionally bandpass filtered and
+            # decimated, as float32 samples (Nsamples x Nchannels) or a WAV file
+            from ._audio_clips import _get_audio_clip
+            from ._project_config import _get_config_file
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
+            if 'start_frame' in query:
+                sr_spectrogram = _get_config_file(f'{session_fullpath}/isa-session.yaml').get('spectrogram_sr_hz')
+                start_sec = query['start_frame'] / sr_spectrogram
+                end_sec = query['end_frame'] / sr_spectrogram
+            else:
+                start_sec = query['start_sec']
+                end_sec = query['end_sec']
+            info, data = _get_audio_clip(
+                session_fullpath,
+                start_sec=start_sec,
+                end_sec=end_sec,
+                channels=query.get('channels', None),
+                decimate=query.get('decimate', 1),
+                bandpass=query.get('bandpass', None),
+                format=query.get('format', 'raw')
+            )
+            return {'success': True, 'clip': info}, data
+        elif type0 == 'get_video_proxy_frames':
+            # the jpeg frames [start_frame, end_frame) written by isa update,
+            # frame i is payload[frameOffsets[i]:frameOffsets[i + 1]]
+            from ._video_proxy import _get_video_proxy_reader
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
+            reader = _get_video_proxy_reader(f'{session_fullpath}/video_proxy.bin')
+            data, frame_offsets, start_frame, end_frame = reader.get_frames(query['start_frame'], query['end_frame'])
+            return {
+                'success': True,
+                'info': reader.info,
+                'startFrame': start_frame,
+                'endFrame': end_frame,
+                'frameOffsets': frame_offsets
+            }, data
+        elif type0 == 'start_detection':
+            # runs vocalization detection in the background and writes the
+            # result to proposals/<proposal_name>.json of the session, which
+            # the annotation queries read with the proposal parameter
+            from ._detection_jobs import _start_detection_job
+            session_fullpath = _get_session_fullpath(query['session_path'], dir=dir)
+            job_id = _start_detection_job(
+                session_fullpath,
+                threshold_pct=query.get('threshold_pct', 99.8),
+                max_gap=query.get('max_gap', 20),
+                min_size=query.get('min_size', 10),
+                freq_range=query.get('freq_range', None),
+                proposal_name=query.get('proposal_name', None)
+            )
+            return {'success': True, 'jobId': job_id}, b''
+        elif type0 == 'job_status':
+            from ._detection_jobs import _get_detection_job_status
+            return {'success': True, 'job': _get_detection_job_status(query['job_id'])}, b''
+        elif type0 == 'cancel_job':
+            from ._detection_jobs import _cancel_detection_job
+            return {'success': True, 'job': _cancel_detection_job(query['job_id'])}, b''
+        elif type0 == 'get_project_index':
+            # the sessions of the project with their main metadata
+            from ._project_config import _get_project_index
+            project_fullpath = _get_session_fullpath(query['project_path'], dir=dir)
+            return {'success': True, 'sessions': _get_project_index(project_fullpath)}, b''
+        elif type0 == 'find_similar_vocalizations':
+            # the k vocalizations of all the sessions of the project that are
+            # most similar to a vocalization of one of them, by fingerprint
+            # (approximate for large projects unless exact is set)
+            from ._similarity_index import _find_similar_vocalizations
+            project_fullpath = _get_session_fullpath(query['project_path'], dir=dir)
+            result = _find_similar_vocalizations(
+                project_fullpath,
+                session=query['session'],
+                vocalization_id=query['vocalization_id'],
+                k=query.get('k', 20),
+                exact=query.get('exact', False)
+            )
+            return {'success': True, **result}, b''
         else:
             raise Exception(f'Unexpected query type: {type0}')
+
+def _get_annotations_fname(session_fullpath: str, query: dict):
+    # annotations.json, or a proposal of a detection job
+    proposal_name = query.get('proposal', None)
+    if proposal_name is None:
+        return f'{session_fullpath}/annotations.json'
+    from ._detection_jobs import _get_proposal_fname
+    return _get_proposal_fname(session_fullpath, proposal_name)
+
+def _get_session_fullpath(session_path: str, *, dir: str):
+    if session_path.startswith('$dir'):
+        session_path = f'{dir}/{session_path[len("$dir"):]}'
+    if not session_path.startswith('rtcshare://'):
+        raise Exception(f'Invalid session path: {session_path}')
+    session_relpath = session_path[len('rtcshare://'):]
+    return os.path.join(os.environ['RTCSHARE_DIR'], session_relpath)
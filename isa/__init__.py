@@ -1,7 +1,31 @@
+import sys
+import types
 from .version import __version__
 
-from .init import init
-from .add import add
-from .update import update
+# The commands and the rtcshare plugin are imported on first use, so that
+# "isa --help" and the rtcshare service do not load h5py, zarr, cv2, ...
+_lazy_attributes = {
+    'init': 'init',
+    'add': 'add',
+    'update': 'update',
+    'worker': 'worker',
+    'export': 'export',
+    'RtcsharePlugin': 'RtcsharePlugin'
+}
 
-from .RtcsharePlugin import RtcsharePlugin
\ No newline at end of file
+def __getattr__(name: str):
+    if name not in _lazy_attributes:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    import importlib
+    importlib.import_module(f'.{_lazy_attributes[name]}', __name__)
+    return globals()[name]
+
+class _IsaModule(types.ModuleType):
+    def __setattr__(self, name: str, value):
+        # importing a submodule sets the attribute of the same name to the
+        # module, keep the function (or class) of the submodule instead
+        if name in _lazy_attributes and isinstance(value, types.ModuleType):
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _IsaModule
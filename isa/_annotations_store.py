@@ -0,0 +1,192 @@
+from typing import Union, List
+import os
+import json
+import threading
+from contextlib import contextmanager
+from ._project_config import _lock_file, _get_lock_fname
+
+
+# annotations.json is the compacted state. Edits are appended to
+# annotations.journal.jsonl, one line per patch ({"version": v, "ops": [...]}),
+# and folded into annotations.json once the journal grows large enough. The
+# "version" of annotations.json is the version of the last patch it contains,
+# so journal lines that are already in it (after an interrupted compaction)
+# are skipped when the state is loaded.
+_max_journal_num_ops = 1000
+_max_journal_num_bytes = 4 * 1024 * 1024
+
+class _AnnotationsVersionConflict(Exception):
+    def __init__(self, *, expected_version: int, version: int):
+        super().__init__(f'Annotations have been modified: expected version {expected_version}, found version {version}')
+        self.expected_version = expected_version
+        self.version = version
+
+class _AnnotationsState:
+    def __init__(self, annotations: dict):
+        self.version = int(annotations.get('version', 0))
+        self.other_fields = {k: v for k, v in annotations.items() if k not in ['vocalizations', 'version']}
+        # insertion ordered, so that the order of the vocalizations is kept
+        self.vocalizations = {v['vocalizationId']: v for v in annotations.get('vocalizations', [])}
+        self.journal_num_ops = 0
+        self.journal_num_bytes = 0
+        self.mtimes = None
+        # the _VocalizationIndex of the current vocalizations
+        self.index = None
+    def to_dict(self):
+        return {
+            **self.other_fields,
+            'version': self.version,
+            'vocalizations': list(self.vocalizations.values())
+        }
+    def apply_patch(self, ops: List[dict]):
+        # validate all operations before applying any of them
+        ids = set(self.vocalizations.keys())
+        self.index = None
+        for op in ops:
+            type0 = op['op']
+            if type0 == 'add':
+                vocalization_id = op['vocalization']['vocalizationId']
+                if vocalization_id in ids:
+                    raise Exception(f'Vocalization already exists: {vocalization_id}')
+                ids.add(vocalization_id)
+            elif type0 in ['update', 'delete']:
+                vocalization_id = op['vocalizationId']
+                if vocalization_id not in ids:
+                    raise Exception(f'Vocalization not found: {vocalization_id}')
+                if type0 == 'delete':
+                    ids.remove(vocalization_id)
+                elif op['vocalization'].get('vocalizationId', vocalization_id) != vocalization_id:
+                    raise Exception(f'Cannot change the id of vocalization {vocalization_id}')
+            else:
+                raise Exception(f'Unexpected annotations operation: {type0}')
+        self.index = None
+        for op in ops:
+            type0 = op['op']
+            if type0 == 'add':
+                v = op['vocalization']
+                self.vocalizations[v['vocalizationId']] = v
+            elif type0 == 'update':
+                self.vocalizations[op['vocalizationId']] = {**self.vocalizations[op['vocalizationId']], **op['vocalization']}
+            elif type0 == 'delete':
+                del self.vocalizations[op['vocalizationId']]
+
+# per-process cache of the state of each annotations.json, valid as long as
+# the files have not been modified by another process
+_annotations_states = {}
+_annotations_lock = threading.Lock()
+
+def _get_journal_fname(annotations_json_fname: str):
+    return annotations_json_fname[:-len('.json')] + '.journal.jsonl'
+
+@contextmanager
+def _lock_annotations(annotations_json_fname: str):
+    # thread lock for this process, file lock for other processes
+    with _annotations_lock:
+        with _lock_file(_get_lock_fname(annotations_json_fname)):
+            yield
+
+def _get_mtimes(annotations_json_fname: str):
+    result = []
+    for fname in [annotations_json_fname, _get_journal_fname(annotations_json_fname)]:
+        try:
+            st = os.stat(fname)
+            result.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            result.append(None)
+    return result
+
+def _load_annotations_state(annotations_json_fname: str):
+    state = _annotations_states.get(annotations_json_fname, None)
+    mtimes = _get_mtimes(annotations_json_fname)
+    if state is not None and state.mtimes == mtimes:
+        return state
+    if os.path.exists(annotations_json_fname):
+        with open(annotations_json_fname, 'r') as f:
+            state = _AnnotationsState(json.load(f))
+    else:
+        state = _AnnotationsState({'vocalizations': []})
+    journal_fname = _get_journal_fname(annotations_json_fname)
+    if os.path.exists(journal_fname):
+        with open(journal_fname, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # incomplete last line of an interrupted write
+                    break
+                if entry['version'] <= state.version:
+                    continue
+                state.apply_patch(entry['ops'])
+                state.version = entry['version']
+                state.journal_num_ops += len(entry['ops'])
+                state.journal_num_bytes += len(line)
+    state.mtimes = mtimes
+    _annotations_states[annotations_json_fname] = state
+    return state
+
+def _check_version(state: _AnnotationsState, expected_version: Union[int, None]):
+    if expected_version is not None and expected_version != state.version:
+        raise _AnnotationsVersionConflict(expected_version=expected_version, version=state.version)
+
+def _write_annotations_json(annotations_json_fname: str, state: _AnnotationsState):
+    tmp_fname = f'{annotations_json_fname}.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(state.to_dict(), f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, annotations_json_fname)
+    journal_fname = _get_journal_fname(annotations_json_fname)
+    if os.path.exists(journal_fname):
+        os.remove(journal_fname)
+    state.journal_num_ops = 0
+    state.journal_num_bytes = 0
+    state.mtimes = _get_mtimes(annotations_json_fname)
+
+def _get_annotations(annotations_json_fname: str):
+    with _lock_annotations(annotations_json_fname):
+        return _load_annotations_state(annotations_json_fname).to_dict()
+
+def _set_annotations(annotations_json_fname: str, annotations: dict, *, expected_version: Union[int, None]=None):
+    # replaces all the annotations
+    with _lock_annotations(annotations_json_fname):
+        state = _load_annotations_state(annotations_json_fname)
+        _check_version(state, expected_version)
+        new_state = _AnnotationsState(annotations)
+        new_state.version = state.version + 1
+        _write_annotations_json(annotations_json_fname, new_state)
+        _annotations_states[annotations_json_fname] = new_state
+        return new_state.version
+
+def _patch_annotations(annotations_json_fname: str, ops: List[dict], *, expected_version: Union[int, None]=None):
+    # ops are {"op": "add", "vocalization": {...}},
+    # {"op": "update", "vocalizationId": ..., "vocalization": {fields to set}}
+    # and {"op": "delete", "vocalizationId": ...}
+    with _lock_annotations(annotations_json_fname):
+        state = _load_annotations_state(annotations_json_fname)
+        _check_version(state, expected_version)
+        line = json.dumps({'version': state.version + 1, 'ops': ops}) + '\n'
+        state.apply_patch(ops)
+        state.version += 1
+        try:
+            with open(_get_journal_fname(annotations_json_fname), 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            # the cached state is ahead of the files
+            del _annotations_states[annotations_json_fname]
+            raise
+        state.journal_num_ops += len(ops)
+        state.journal_num_bytes += len(line)
+        state.mtimes = _get_mtimes(annotations_json_fname)
+        if state.journal_num_ops >= _max_journal_num_ops or state.journal_num_bytes >= _max_journal_num_bytes:
+            _write_annotations_json(annotations_json_fname, state)
+        return state.version
+
+def _compact_annotations(annotations_json_fname: str):
+    # folds the journal into annotations.json
+    with _lock_annotations(annotations_json_fname):
+        if not os.path.exists(_get_journal_fname(annotations_json_fname)):
+            return
+        state = _load_annotations_state(annotations_json_fname)
+        _write_annotations_json(annotations_json_fname, state)
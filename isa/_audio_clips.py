@@ -0,0 +1,136 @@
+from typing import Union, List
+import io
+import os
+import threading
+import numpy as np
+from ._lru_cache import _LRUCache
+from ._audio_source import _AudioSource
+from ._find_singular_file_in_dir import _find_singular_file_in_dir
+
+
+# Short clips of the raw audio of a session, for playing back vocalizations.
+# Only the samples of the clip are read: HDF5 datasets are read in blocks of
+# _block_num_samples samples per channel that are kept in an LRU cache, and
+# WAV files are memory-mapped. The open files are kept between queries.
+_block_num_samples = 65536
+_max_clip_duration_sec = 60
+
+_audio_block_cache = _LRUCache(max_bytes=int(os.environ.get('ISA_AUDIO_CACHE_MB', '256')) * 1024 * 1024)
+_open_audio_files = {}
+_open_audio_files_lock = threading.Lock()
+
+class _AudioFile:
+    def __init__(self, audio_path: str):
+        self.audio_path = audio_path
+        self.mtime = os.stat(audio_path).st_mtime_ns
+        self.source = _AudioSource(audio_path)
+        self.sr_hz = self.source.sr_hz
+        self.num_channels = self.source.num_channels
+        self.num_samples = self.source.num_samples
+    def read(self, i1: int, i2: int, channels: List[int]):
+        # samples [i1, i2) of the channels as float32 (Nsamples x Nchannels)
+        if self.audio_path.endswith('.wav'):
+            return self.source.read(i1, i2, channels=channels, dtype=np.float32)
+        X = np.zeros((i2 - i1, len(channels)), dtype=np.float32)
+        for block_index in range(i1 // _block_num_samples, (i2 - 1) // _block_num_samples + 1):
+            offset = block_index * _block_num_samples
+            j1 = max(i1, offset)
+            j2 = min(i2, offset + _block_num_samples)
+            for k, channel in enumerate(channels):
+                block = self._read_h5_block(channel, block_index)
+                X[j1 - i1:j2 - i1, k] = block[j1 - offset:j2 - offset]
+        return X
+    def _read_h5_block(self, channel: int, block_index: int):
+        key = (self.audio_path, self.mtime, channel, block_index)
+        block = _audio_block_cache.get(key)
+        if block is None:
+            block = self.source.read(block_index * _block_num_samples, (block_index + 1) * _block_num_samples, channels=[channel], dtype=np.float32)[:, 0]
+            _audio_block_cache.set(key, block)
+        return block
+
+def _get_audio_file(audio_path: str) -> _AudioFile:
+    mtime = os.stat(audio_path).st_mtime_ns
+    with _open_audio_files_lock:
+        a = _open_audio_files.get(audio_path, None)
+        if a is None or a.mtime != mtime:
+            a = _AudioFile(audio_path)
+            _open_audio_files[audio_path] = a
+        return a
+
+def _get_audio_clip(
+    session_fullpath: str, *,
+    start_sec: float,
+    end_sec: float,
+    channels: Union[List[int], None]=None,
+    decimate: int=1,
+    bandpass: Union[List[float], None]=None,
+    format: str='raw'
+):
+    # Returns the info of the clip and either the float32 samples
+    # (Nsamples x Nchannels, little endian) or a float32 WAV file. The
+    # filters are applied to the clip together with a margin on both sides,
+    # which is cropped afterwards.
+    audio_fname = _find_singular_file_in_dir(session_fullpath, ['.h5', '.wav'])
+    if audio_fname is None:
+        raise Exception(f'No .h5 or .wav file found in directory: {session_fullpath}')
+    a = _get_audio_file(f'{session_fullpath}/{audio_fname}')
+    if end_sec - start_sec > _max_clip_duration_sec:
+        raise Exception(f'Audio clip is too long: {end_sec - start_sec} sec (maximum {_max_clip_duration_sec} sec)')
+    if channels is None:
+        channels = list(range(a.num_channels))
+    for channel in channels:
+        if channel < 0 or channel >= a.num_channels:
+            raise Exception(f'Invalid channel: {channel}')
+    decimate = int(decimate)
+    if decimate < 1:
+        raise Exception(f'Invalid decimation factor: {decimate}')
+    i1 = max(0, min(int(np.floor(start_sec * a.sr_hz)), a.num_samples))
+    i2 = max(i1, min(int(np.ceil(end_sec * a.sr_hz)), a.num_samples))
+    margin = int(0.01 * a.sr_hz) if (bandpass is not None or decimate > 1) else 0
+    # whole multiples of the decimation factor so that the output samples line up with i1
+    margin = -(-margin // decimate) * decimate
+    m1 = min(margin, i1 - (i1 % decimate)) if decimate > 1 else min(margin, i1)
+    m2 = min(margin, a.num_samples - i2)
+    X = a.read(i1 - m1, i2 + m2, channels)
+    sr_hz = a.sr_hz
+    if X.shape[0] > 0 and bandpass is not None:
+        from scipy.signal import butter, sosfiltfilt
+        f1, f2 = bandpass
+        nyquist = sr_hz / 2
+        if f1 is not None and f1 > 0 and f2 is not None and f2 < nyquist:
+            sos = butter(4, [f1, f2], btype='bandpass', fs=sr_hz, output='sos')
+        elif f2 is not None and f2 < nyquist:
+            sos = butter(4, f2, btype='lowpass', fs=sr_hz, output='sos')
+        elif f1 is not None and f1 > 0:
+            sos = butter(4, f1, btype='highpass', fs=sr_hz, output='sos')
+        else:
+            sos = None
+        if sos is not None and X.shape[0] > 3 * 2 * sos.shape[0]:
+            X = sosfiltfilt(sos, X, axis=0).astype(np.float32)
+    if X.shape[0] > 0 and decimate > 1:
+        from scipy.signal import resample_poly
+        X = resample_poly(X, 1, decimate, axis=0).astype(np.float32)
+        sr_hz = sr_hz / decimate
+        m1 = m1 // decimate
+        m2 = X.shape[0] - m1 - (i2 - i1 + decimate - 1) // decimate
+    X = np.ascontiguousarray(X[m1:X.shape[0] - m2])
+    info = {
+        'samplingFrequency': sr_hz,
+        'audioSamplingFrequency': a.sr_hz,
+        'startSample': i1,
+        'endSample': i2,
+        'startSec': i1 / a.sr_hz,
+        'channels': channels,
+        'numSamples': int(X.shape[0]),
+        'dtype': 'float32',
+        'format': format
+    }
+    if format == 'raw':
+        return info, X.astype('<f4').tobytes()
+    elif format == 'wav':
+        from scipy.io import wavfile
+        f = io.BytesIO()
+        wavfile.write(f, int(round(sr_hz)), X)
+        return info, f.getvalue()
+    else:
+        raise Exception(f'Unexpected audio clip format: {format}')
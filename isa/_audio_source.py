@@ -0,0 +1,124 @@
+from typing import Union, List
+import os
+import json
+import threading
+import numpy as np
+
+
+# The audio file of a session, for everything that reads its samples (the
+# spectrograms, probing new sessions, audio clips and export).
+#
+# .h5   any number of datasets ai_channels/ai<N>, in the order of N, with the
+#       sampling rate in the JSON config dataset (parsed once, when the file
+#       is opened). The file is opened with a chunk cache that holds a block
+#       of all the channels, so chunked (compressed) datasets are not
+#       decompressed again for the overlapping parts of consecutive blocks.
+# .wav  memory-mapped, so only the requested samples are read. scipy cannot
+#       memory-map 24-bit PCM, so those files are mapped as bytes and each
+#       block is decoded to int32 the way wavfile.read does (the 3 bytes of
+#       a sample in the upper bytes).
+#
+# Blocks of all the channels are read in one pass into a single buffer,
+# converted to the requested dtype as they are read.
+_h5_chunk_cache_num_bytes = int(os.environ.get('ISA_H5_CHUNK_CACHE_MB', '64')) * 1024 * 1024
+# prime, about 100 times the number of chunks that fit in the cache
+_h5_chunk_cache_num_slots = 100003
+
+class _AudioSource:
+    def __init__(self, audio_path: str):
+        self.audio_path = audio_path
+        self._h5 = None
+        # h5py objects are not safe to use from several threads at once
+        self._lock = threading.Lock()
+        if audio_path.endswith('.h5'):
+            import h5py
+            # rdcc_w0=1: chunks that were read completely are evicted first
+            self._h5 = h5py.File(audio_path, 'r', rdcc_nbytes=_h5_chunk_cache_num_bytes, rdcc_nslots=_h5_chunk_cache_num_slots, rdcc_w0=1)
+            channel_names = sorted([name for name in self._h5['ai_channels'].keys() if name.startswith('ai') and name[2:].isdigit()], key=lambda name: int(name[2:]))
+            if len(channel_names) == 0:
+                self._h5.close()
+                raise Exception(f'No ai_channels/ai* datasets in {audio_path}')
+            self._datasets = [self._h5[f'ai_channels/{name}'] for name in channel_names]
+            # as stored in the file (the session config keeps it as it is)
+            self.sample_rate = json.loads(self._h5['config'][()].decode('utf-8'))['microphone_sample_rate']
+            self.sr_hz = float(self.sample_rate)
+            self.num_channels = len(self._datasets)
+            self.num_samples = min([d.shape[0] for d in self._datasets])
+            self.dtype = np.dtype(self._datasets[0].dtype)
+        elif audio_path.endswith('.wav'):
+            from ._probe import _probe_wav
+            info = _probe_wav(audio_path)
+            self._wav_int24 = info['format_tag'] == 1 and info['bits_per_sample'] == 24
+            if self._wav_int24:
+                self._audio = np.memmap(audio_path, dtype=np.uint8, mode='r', offset=info['data_offset'], shape=(info['num_samples'], info['num_channels'], 3))
+                sr_hz = info['sr_hz']
+            else:
+                from scipy.io import wavfile
+                sr_hz, self._audio = wavfile.read(audio_path, mmap=True)
+                if self._audio.ndim == 1:
+                    self._audio = self._audio.reshape((-1, 1))
+            self.sample_rate = sr_hz
+            self.sr_hz = float(sr_hz)
+            self.num_channels = self._audio.shape[1]
+            self.num_samples = self._audio.shape[0]
+            self.dtype = np.dtype(np.int32) if self._wav_int24 else self._audio.dtype
+        else:
+            raise Exception(f'Unknown audio file type: {audio_path}')
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    def read(self, i1: int, i2: int, *, channels: Union[List[int], None]=None, dtype=None):
+        # samples [i1, i2) of the channels (Nsamples x Nchannels), cropped to
+        # the file, in the dtype of the file unless another one is given
+        i1 = max(0, min(i1, self.num_samples))
+        i2 = max(i1, min(i2, self.num_samples))
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        all_channels = channels is None or list(channels) == list(range(self.num_channels))
+        if self._h5 is None:
+            X = self._audio[i1:i2] if all_channels else self._audio[i1:i2, channels]
+            if self._wav_int24:
+                X = _decode_int24(X)
+            return np.array(X, dtype=dtype)
+        if all_channels:
+            channels = range(self.num_channels)
+        # one row per channel, so that each dataset is read straight into
+        # contiguous memory (HDF5 does the conversion to dtype)
+        buf = np.empty((len(channels), i2 - i1), dtype=dtype)
+        if i2 > i1:
+            with self._lock:
+                for k, channel in enumerate(channels):
+                    self._datasets[channel].read_direct(buf[k], np.s_[i1:i2])
+        return buf.T
+    def iterate_blocks(
+        self, *,
+        block_num_samples: int,
+        overlap: int=0,
+        start: int=0,
+        end: Union[int, None]=None,
+        channels: Union[List[int], None]=None,
+        dtype=None
+    ):
+        # (i1, samples [i1, i1 + block_num_samples)) for blocks that start
+        # block_num_samples - overlap apart, the last one ending at end
+        end = self.num_samples if end is None else min(end, self.num_samples)
+        step = block_num_samples - overlap
+        if step <= 0:
+            raise Exception(f'Overlap must be smaller than the block size: {overlap} >= {block_num_samples}')
+        i1 = start
+        while i1 < end:
+            i2 = min(i1 + block_num_samples, end)
+            yield i1, self.read(i1, i2, channels=channels, dtype=dtype)
+            if i2 >= end:
+                break
+            i1 += step
+
+def _decode_int24(X: np.ndarray):
+    # Nsamples x Nchannels x 3 little-endian bytes -> Nsamples x Nchannels int32
+    Y = np.zeros(X.shape[:2] + (4,), dtype=np.uint8)
+    Y[:, :, 1:] = X
+    return Y.view('<i4')[:, :, 0]
@@ -0,0 +1,193 @@
+from typing import Union, List
+import os
+import re
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import zarr
+from ._lru_cache import _LRUCache
+from ._annotations_store import _set_annotations
+from ._project_config import _get_config_file
+from ._spectrogram_stats import _load_spectrogram_stats, _get_band_histogram
+from .auto_detect_vocalizations import _StreamingVocalizationDetector, _get_detection_freq_range, _percentile, _percentile_from_histogram
+
+
+# Vocalization detection with other parameters than those of isa update, run
+# in background threads of the server so that queries are answered while it
+# runs. The detection band of the spectrogram is kept in memory, so running
+# it again on the same band (for example with another threshold) takes only
+# the detection itself. The result is written as a proposal,
+# <session>/proposals/<name>.json, next to annotations.json rather than
+# replacing it.
+_max_num_finished_jobs = 100
+
+_detection_band_cache = _LRUCache(max_bytes=int(os.environ.get('ISA_DETECTION_CACHE_MB', '1024')) * 1024 * 1024)
+_executor: Union[ThreadPoolExecutor, None] = None
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+class _DetectionJobCancelled(Exception):
+    pass
+
+class _DetectionJob:
+    def __init__(self, *, session_fullpath: str, proposal_name: str, params: dict):
+        self.job_id = uuid.uuid4().hex[:16]
+        self.session_fullpath = session_fullpath
+        self.proposal_name = proposal_name
+        self.params = params
+        self.status = 'queued'
+        self.progress = 0.0
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.future = None
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise _DetectionJobCancelled()
+    def to_dict(self):
+        return {
+            'jobId': self.job_id,
+            'proposalName': self.proposal_name,
+            'params': self.params,
+            'status': self.status,
+            'progress': self.progress,
+            'error': self.error,
+            'result': self.result,
+            'createdAt': self.created_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at
+        }
+
+def _get_proposal_fname(session_fullpath: str, proposal_name: str):
+    if not re.match(r'^[A-Za-z0-9_\-]+$', proposal_name):
+        raise Exception(f'Invalid proposal name: {proposal_name}')
+    return f'{session_fullpath}/proposals/{proposal_name}.json'
+
+def _start_detection_job(
+    session_fullpath: str, *,
+    threshold_pct: float=99.8,
+    max_gap: int=20,
+    min_size: int=10,
+    freq_range: Union[List[float], None]=None,
+    proposal_name: Union[str, None]=None
+):
+    global _executor
+    config = _get_config_file(f'{session_fullpath}/isa-session.yaml').to_dict()
+    if freq_range is None:
+        freq_range = config['auto_detect_freq_range']
+    params = {
+        'threshold_pct': float(threshold_pct),
+        'max_gap': int(max_gap),
+        'min_size': int(min_size),
+        'freq_range': [float(freq_range[0]), float(freq_range[1])]
+    }
+    job = _DetectionJob(session_fullpath=session_fullpath, proposal_name='', params=params)
+    job.proposal_name = proposal_name if proposal_name is not None else f'detection-{job.job_id}'
+    # fail here rather than in the job
+    _get_proposal_fname(session_fullpath, job.proposal_name)
+    with _jobs_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=int(os.environ.get('ISA_DETECTION_NUM_WORKERS', '2')))
+        _jobs[job.job_id] = job
+        _prune_finished_jobs()
+        job.future = _executor.submit(_run_detection_job, job, spectrogram_df=config['spectrogram_df'])
+    return job.job_id
+
+def _get_detection_job_status(job_id: str):
+    job = _get_job(job_id)
+    with _jobs_lock:
+        return job.to_dict()
+
+def _cancel_detection_job(job_id: str):
+    job = _get_job(job_id)
+    job.cancel_event.set()
+    with _jobs_lock:
+        if job.future is not None and job.future.cancel():
+            # it had not started
+            job.status = 'cancelled'
+            job.finished_at = time.time()
+        return job.to_dict()
+
+def _get_job(job_id: str) -> _DetectionJob:
+    with _jobs_lock:
+        job = _jobs.get(job_id, None)
+    if job is None:
+        raise Exception(f'Unknown job: {job_id}')
+    return job
+
+def _prune_finished_jobs():
+    finished = [j for j in _jobs.values() if j.finished_at is not None]
+    finished.sort(key=lambda j: j.finished_at)
+    for j in finished[:max(0, len(finished) - _max_num_finished_jobs)]:
+        del _jobs[j.job_id]
+
+def _set_job_state(job: _DetectionJob, **kwargs):
+    with _jobs_lock:
+        for k, v in kwargs.items():
+            setattr(job, k, v)
+
+def _run_detection_job(job: _DetectionJob, *, spectrogram_df: float):
+    _set_job_state(job, status='running', started_at=time.time())
+    try:
+        job.check_cancelled()
+        spectrogram_for_gui_zarr_fname = f'{job.session_fullpath}/spectrogram_for_gui.zarr'
+        freq_range = _get_detection_freq_range(job.params['freq_range'], spectrogram_df=spectrogram_df)
+        band, sr_spectrogram, freq_range = _get_detection_band(spectrogram_for_gui_zarr_fname, freq_range, job=job)
+        if freq_range[1] <= freq_range[0]:
+            raise Exception(f'The frequency range {job.params["freq_range"]} does not contain any frequency of the spectrogram')
+        stats = _load_spectrogram_stats(spectrogram_for_gui_zarr_fname)
+        if stats is not None:
+            threshold = _percentile_from_histogram(_get_band_histogram(stats, freq_range), job.params['threshold_pct'])
+        else:
+            threshold = _percentile(band, job.params['threshold_pct'])
+        detector = _StreamingVocalizationDetector(threshold=threshold, max_gap=job.params['max_gap'], min_size=job.params['min_size'])
+        vocalizations = []
+        block_num_frames = 100000
+        for i in range(0, band.shape[0], block_num_frames):
+            job.check_cancelled()
+            vocalizations.extend(detector.process_block(band[i:i + block_num_frames]))
+            _set_job_state(job, progress=0.5 + 0.5 * min(i + block_num_frames, band.shape[0]) / max(band.shape[0], 1))
+        job.check_cancelled()
+        proposal_fname = _get_proposal_fname(job.session_fullpath, job.proposal_name)
+        os.makedirs(os.path.dirname(proposal_fname), exist_ok=True)
+        _set_annotations(proposal_fname, {
+            'samplingFrequency': sr_spectrogram,
+            'detectionParams': job.params,
+            'vocalizations': vocalizations
+        })
+        result = {'numVocalizations': len(vocalizations), 'threshold': float(threshold)}
+        _set_job_state(job, status='done', progress=1.0, result=result, finished_at=time.time())
+    except _DetectionJobCancelled:
+        _set_job_state(job, status='cancelled', finished_at=time.time())
+    except Exception as e:
+        _set_job_state(job, status='failed', error=f'{type(e).__name__}: {e}', finished_at=time.time())
+
+def _get_detection_band(spectrogram_for_gui_zarr_fname: str, freq_range: List[int], *, job: _DetectionJob):
+    # the frequency bins [freq_range[0], freq_range[1]) of all the frames of
+    # the uint8 spectrogram, from the cache if it is there (the modification
+    # time of the array metadata changes when the spectrograms are recomputed),
+    # and the range clipped to the frequency bins of the spectrogram
+    root_group = zarr.open(spectrogram_for_gui_zarr_fname, mode='r')
+    sr_spectrogram = root_group.attrs['spectrogram_sr_hz']
+    spectrogram: zarr.Array = root_group['spectrogram']
+    num_frequencies = spectrogram.shape[1]
+    f1 = max(0, min(freq_range[0], num_frequencies))
+    freq_range = [f1, max(f1, min(freq_range[1], num_frequencies))]
+    key = (spectrogram_for_gui_zarr_fname, os.stat(f'{spectrogram_for_gui_zarr_fname}/spectrogram/.zarray').st_mtime_ns, freq_range[0], freq_range[1])
+    band = _detection_band_cache.get(key)
+    if band is not None:
+        return band, sr_spectrogram, freq_range
+    num_frames = spectrogram.shape[0]
+    band = np.zeros((num_frames, freq_range[1] - freq_range[0]), dtype=np.uint8)
+    block_num_frames = spectrogram.chunks[0]
+    for i in range(0, num_frames, block_num_frames):
+        job.check_cancelled()
+        band[i:i + block_num_frames] = spectrogram[i:i + block_num_frames, freq_range[0]:freq_range[1]]
+        _set_job_state(job, progress=0.5 * min(i + block_num_frames, num_frames) / num_frames)
+    _detection_band_cache.set(key, band)
+    return band, sr_spectrogram, freq_range
@@ -0,0 +1,37 @@
+from typing import Union
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class _LRUCache:
+    # Thread-safe LRU cache bounded by the total number of bytes of the values
+    def __init__(self, *, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._num_bytes = 0
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                self.num_misses += 1
+                return None
+            self.num_hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+    def set(self, key, value: Union[np.ndarray, bytes], *, num_bytes: Union[int, None]=None):
+        if num_bytes is None:
+            num_bytes = value.nbytes if isinstance(value, np.ndarray) else len(value)
+        with self._lock:
+            if key in self._items:
+                self._num_bytes -= self._items.pop(key)[1]
+            # a value larger than the whole cache is not kept
+            if num_bytes > self._max_bytes:
+                return
+            self._items[key] = (value, num_bytes)
+            self._num_bytes += num_bytes
+            while self._num_bytes > self._max_bytes:
+                _, (_, n) = self._items.popitem(last=False)
+                self._num_bytes -= n
@@ -0,0 +1,38 @@
+import os
+import pickle
+import shutil
+import numpy as np
+from .create_spectrograms import _create_spectrograms_zarr
+
+
+def _migrate_spectrograms_pkl(session: str):
+    # Converts the spectrograms.pkl written by earlier versions to
+    # spectrograms.zarr. The spectrogram_for_gui in the pickle is the same
+    # as the spectrogram array of spectrogram_for_gui.zarr, so it is dropped.
+    dirname = f'./{session}'
+    spectrograms_pkl_fname = f'{dirname}/spectrograms.pkl'
+    spectrograms_zarr_fname = f'{dirname}/spectrograms.zarr'
+    if not os.path.exists(spectrograms_pkl_fname):
+        return False
+    if os.path.exists(spectrograms_zarr_fname):
+        return False
+    print(f'Migrating {spectrograms_pkl_fname} to {spectrograms_zarr_fname}')
+    with open(spectrograms_pkl_fname, 'rb') as f:
+        a = pickle.load(f)
+    spectrograms: list = a['spectrograms']
+    times: np.ndarray = a['times']
+    tmp_fname = f'{spectrograms_zarr_fname}.tmp'
+    if os.path.exists(tmp_fname):
+        shutil.rmtree(tmp_fname)
+    group = _create_spectrograms_zarr(
+        tmp_fname,
+        num_channels=len(spectrograms),
+        frequencies=a['frequencies'],
+        sr_spectrogram=float(1 / (times[1] - times[0])),
+        times=times
+    )
+    for channel_ind, spectrogram in enumerate(spectrograms):
+        group['spectrograms'][channel_ind] = spectrogram
+    os.rename(tmp_fname, spectrograms_zarr_fname)
+    os.remove(spectrograms_pkl_fname)
+    return True
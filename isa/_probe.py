@@ -0,0 +1,160 @@
+import os
+import struct
+
+
+# Metadata-only probing of the session files. None of these functions read
+# audio samples or decode video frames.
+
+def _probe_audio(audio_path: str):
+    if audio_path.endswith('.h5'):
+        return _probe_h5_audio(audio_path)
+    elif audio_path.endswith('.wav'):
+        return _probe_wav(audio_path)
+    else:
+        raise Exception(f'Unknown audio file type: {audio_path}')
+
+def _probe_h5_audio(h5_path: str):
+    from ._audio_source import _AudioSource
+    with _AudioSource(h5_path) as a:
+        return {
+            'sr_hz': a.sample_rate,
+            'num_channels': a.num_channels,
+            'num_samples': a.num_samples,
+            'dtype': str(a.dtype)
+        }
+
+def _probe_wav(wav_path: str):
+    # Parses the RIFF/RF64 chunk headers. For RF64 (and BW64) files the sizes
+    # of files larger than 4 GB are taken from the ds64 chunk.
+    file_size = os.path.getsize(wav_path)
+    with open(wav_path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[0:4] not in [b'RIFF', b'RF64', b'BW64'] or header[8:12] != b'WAVE':
+            raise Exception(f'Not a WAV file: {wav_path}')
+        ds64_data_size = None
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise Exception(f'No data chunk found in WAV file: {wav_path}')
+            chunk_id = chunk_header[0:4]
+            chunk_size = struct.unpack('<I', chunk_header[4:8])[0]
+            chunk_start = f.tell()
+            if chunk_id == b'ds64':
+                _riff_size, ds64_data_size, _sample_count = struct.unpack('<QQQ', f.read(24))
+            elif chunk_id == b'fmt ':
+                d = f.read(chunk_size)
+                format_tag, num_channels, sr_hz, _byte_rate, block_align, bits_per_sample = struct.unpack('<HHIIHH', d[0:16])
+                if format_tag == 0xFFFE and len(d) >= 26:
+                    # WAVE_FORMAT_EXTENSIBLE: the format is the start of the sub-format GUID
+                    format_tag = struct.unpack('<H', d[24:26])[0]
+                fmt = {
+                    'format_tag': format_tag,
+                    'num_channels': num_channels,
+                    'sr_hz': sr_hz,
+                    'block_align': block_align,
+                    'bits_per_sample': bits_per_sample
+                }
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise Exception(f'Missing fmt chunk in WAV file: {wav_path}')
+                data_size = chunk_size
+                if chunk_size == 0xFFFFFFFF and ds64_data_size is not None:
+                    data_size = ds64_data_size
+                # the size may not have been finalized if the recording was interrupted
+                data_size = min(data_size, file_size - chunk_start)
+                return {
+                    'sr_hz': fmt['sr_hz'],
+                    'num_channels': fmt['num_channels'],
+                    'num_samples': data_size // fmt['block_align'],
+                    'dtype': _get_wav_dtype(fmt['format_tag'], fmt['bits_per_sample']),
+                    'format_tag': fmt['format_tag'],
+                    'bits_per_sample': fmt['bits_per_sample'],
+                    'data_offset': chunk_start
+                }
+            # chunks are padded to an even number of bytes
+            f.seek(chunk_start + chunk_size + (chunk_size % 2))
+
+def _get_wav_dtype(format_tag: int, bits_per_sample: int):
+    if format_tag == 1:
+        if bits_per_sample == 8:
+            return 'uint8'
+        # 24-bit samples are read as int32, like scipy's wavfile.read does
+        if bits_per_sample == 24:
+            return 'int32'
+        if bits_per_sample in [16, 32, 64]:
+            return f'int{bits_per_sample}'
+    elif format_tag == 3:
+        if bits_per_sample in [32, 64]:
+            return f'float{bits_per_sample}'
+    raise Exception(f'Unsupported WAV format: format tag {format_tag}, {bits_per_sample} bits per sample')
+
+def _probe_video(video_path: str):
+    if video_path.endswith('.avi'):
+        try:
+            return _probe_avi(video_path)
+        except Exception as e:
+            print(f'Unable to parse AVI header, using OpenCV instead: {e}')
+    import cv2
+    vid = cv2.VideoCapture(video_path)
+    try:
+        return {
+            'width': int(vid.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'fps': vid.get(cv2.CAP_PROP_FPS),
+            'num_frames': int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+        }
+    finally:
+        vid.release()
+
+def _probe_avi(avi_path: str):
+    # Reads the stream header (strh) and format (strf) of the first video
+    # stream from the hdrl list at the start of the file
+    with open(avi_path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'AVI ':
+            raise Exception('Not an AVI file')
+        while True:
+            chunk_header = f.read(12)
+            if len(chunk_header) < 12:
+                raise Exception('No hdrl list found')
+            chunk_id = chunk_header[0:4]
+            chunk_size = struct.unpack('<I', chunk_header[4:8])[0]
+            if chunk_id == b'LIST' and chunk_header[8:12] == b'hdrl':
+                hdrl = f.read(chunk_size - 4)
+                break
+            f.seek(chunk_size - 4 + (chunk_size % 2), 1)
+    for strl in _iterate_riff_lists(hdrl, b'strl'):
+        strh = None
+        strf = None
+        for chunk_id, data in _iterate_riff_chunks(strl):
+            if chunk_id == b'strh':
+                strh = data
+            elif chunk_id == b'strf':
+                strf = data
+        if strh is None or strh[0:4] != b'vids':
+            continue
+        scale, rate, _start, length = struct.unpack('<IIII', strh[20:36])
+        width, height = struct.unpack('<ii', strf[4:12])
+        if rate == 0 or scale == 0:
+            raise Exception('Invalid frame rate')
+        return {
+            'width': width,
+            'height': abs(height),
+            'fps': rate / scale,
+            'num_frames': length
+        }
+    raise Exception('No video stream found')
+
+def _iterate_riff_chunks(data: bytes):
+    i = 0
+    while i + 8 <= len(data):
+        chunk_id = data[i:i + 4]
+        chunk_size = struct.unpack('<I', data[i + 4:i + 8])[0]
+        yield chunk_id, data[i + 8:i + 8 + chunk_size]
+        i += 8 + chunk_size + (chunk_size % 2)
+
+def _iterate_riff_lists(data: bytes, list_type: bytes):
+    for chunk_id, chunk_data in _iterate_riff_chunks(data):
+        if chunk_id == b'LIST' and chunk_data[0:4] == list_type:
+            yield chunk_data[4:]
@@ -0,0 +1,156 @@
+from typing import Union, List
+import os
+import json
+import time
+import resource
+from contextlib import nullcontext
+
+
+# Instrumentation of the stages of isa update (isa update --profile). When
+# profiling is not enabled _profile_stage returns a shared no-op context, so
+# the instrumented code only pays for a function call and a global lookup.
+_profiler: Union['_Profiler', None] = None
+_null_stage = nullcontext()
+
+def _profile_stage(name: str):
+    if _profiler is None:
+        return _null_stage
+    return _ProfileStage(_profiler, name)
+
+class _Profiler:
+    def __init__(self, session: str):
+        self.session = session
+        self.events: List[dict] = []
+        self.stack: List['_ProfileStage'] = []
+        self.t0 = time.perf_counter()
+        self.can_reset_peak_rss = _reset_peak_rss()
+
+class _ProfileStage:
+    def __init__(self, profiler: _Profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.peak_rss_kb = 0
+    def __enter__(self):
+        p = self.profiler
+        if p.can_reset_peak_rss:
+            # the peak since the parent stage started or last reset, before
+            # it is reset for this stage
+            if len(p.stack) > 0:
+                p.stack[-1].peak_rss_kb = max(p.stack[-1].peak_rss_kb, _get_peak_rss_kb())
+            _reset_peak_rss()
+        p.stack.append(self)
+        self.io = _get_io_counters()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        io = _get_io_counters()
+        p = self.profiler
+        self.peak_rss_kb = max(self.peak_rss_kb, _get_peak_rss_kb())
+        p.stack.pop()
+        if len(p.stack) > 0:
+            p.stack[-1].peak_rss_kb = max(p.stack[-1].peak_rss_kb, self.peak_rss_kb)
+        p.events.append({
+            'session': p.session,
+            'name': self.name,
+            'depth': len(p.stack),
+            'start_sec': self.wall - p.t0,
+            'wall_sec': wall,
+            'cpu_sec': cpu,
+            'peak_rss_mb': self.peak_rss_kb / 1024,
+            'read_bytes': io[0] - self.io[0],
+            'write_bytes': io[1] - self.io[1],
+            'error': exc_type.__name__ if exc_type is not None else None
+        })
+        return False
+
+def _get_peak_rss_kb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # maximum over the life of the process (kilobytes on linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _get_io_counters():
+    # bytes passed to read and write system calls (rchar/wchar), which
+    # includes reads served from the page cache
+    try:
+        with open('/proc/self/io', 'r') as f:
+            d = dict(line.split(':') for line in f if ':' in line)
+        return int(d['rchar']), int(d['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def _start_profiling(session: str):
+    global _profiler
+    _profiler = _Profiler(session)
+
+def _stop_profiling(*, output_fname: str, format: str):
+    # writes the events of the session and returns them
+    global _profiler
+    if _profiler is None:
+        return []
+    events = _profiler.events
+    _profiler = None
+    events = sorted(events, key=lambda e: e['start_sec'])
+    if format == 'jsonl':
+        with open(output_fname, 'w') as f:
+            for e in events:
+                f.write(json.dumps(e) + '\n')
+    elif format == 'chrome':
+        # chrome://tracing or https://ui.perfetto.dev
+        pid = os.getpid()
+        trace_events = [{
+            'name': e['name'],
+            'ph': 'X',
+            'ts': e['start_sec'] * 1e6,
+            'dur': e['wall_sec'] * 1e6,
+            'pid': pid,
+            'tid': 0,
+            'args': {k: v for k, v in e.items() if k not in ['name', 'start_sec', 'wall_sec']}
+        } for e in events]
+        with open(output_fname, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+    else:
+        raise Exception(f'Unexpected profile format: {format}')
+    print(f'Wrote {output_fname}')
+    return events
+
+def _get_profile_output_fname(session: str, *, format: str):
+    if format == 'chrome':
+        return f'./{session}/isa-profile.trace.json'
+    return f'./{session}/isa-profile.jsonl'
+
+def _print_profile_summary(events: List[dict]):
+    # totals per stage over all the sessions, in the order of first appearance
+    rows = {}
+    for e in events:
+        r = rows.get(e['name'], None)
+        if r is None:
+            r = rows[e['name']] = {'depth': e['depth'], 'count': 0, 'sessions': set(), 'wall_sec': 0, 'cpu_sec': 0, 'peak_rss_mb': 0, 'read_bytes': 0, 'write_bytes': 0}
+        r['count'] += 1
+        r['sessions'].add(e['session'])
+        r['wall_sec'] += e['wall_sec']
+        r['cpu_sec'] += e['cpu_sec']
+        r['peak_rss_mb'] = max(r['peak_rss_mb'], e['peak_rss_mb'])
+        r['read_bytes'] += e['read_bytes']
+        r['write_bytes'] += e['write_bytes']
+    print('')
+    print(f'{"stage":<40} {"sessions":>8} {"count":>7} {"wall (s)":>10} {"cpu (s)":>10} {"peak RSS (MB)":>14} {"read (MB)":>10} {"written (MB)":>12}')
+    for name, r in rows.items():
+        label = '  ' * r['depth'] + name
+        print(f'{label:<40} {len(r["sessions"]):>8} {r["count"]:>7} {r["wall_sec"]:>10.2f} {r["cpu_sec"]:>10.2f} {r["peak_rss_mb"]:>14.1f} {r["read_bytes"] / 1e6:>10.1f} {r["write_bytes"] / 1e6:>12.1f}')
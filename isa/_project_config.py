@@ -1,55 +1,166 @@
+from typing import Union, List
 import os
+import fcntl
+import threading
+from contextlib import contextmanager
 import yaml
+from ._profile import _profile_stage
 
 
+class _ConfigFile:
+    # A yaml config file that is parsed once and re-parsed only when it has
+    # been modified on disk. Values that are set are kept as dirty keys until
+    # save(), which merges them into the current file on disk and replaces it
+    # atomically while holding a lock, so that concurrent writers of
+    # different keys do not lose each other's changes.
+    def __init__(self, fname: str):
+        self.fname = fname
+        self._values = {}
+        self._dirty_keys = set()
+        self._stat = None
+        self._lock = threading.RLock()
+        self._reload()
+    def _reload(self):
+        st = _get_file_stat(self.fname)
+        if st is not None and st == self._stat:
+            return
+        values = {}
+        if st is not None:
+            with open(self.fname, 'r') as f:
+                values = yaml.safe_load(f)
+            if values is None:
+                values = {}
+        # keep the values that have not been saved yet
+        for key in self._dirty_keys:
+            if key in self._values:
+                values[key] = self._values[key]
+            else:
+                values.pop(key, None)
+        self._values = values
+        self._stat = st
+    def exists(self):
+        with self._lock:
+            self._reload()
+            return self._stat is not None or len(self._dirty_keys) > 0
+    def get(self, key: str, default=None):
+        with self._lock:
+            self._reload()
+            return self._values.get(key, default)
+    def to_dict(self):
+        with self._lock:
+            self._reload()
+            return dict(self._values)
+    def set(self, key: str, val):
+        with self._lock:
+            self._reload()
+            self._values[key] = val
+            self._dirty_keys.add(key)
+    def update(self, values: dict):
+        for key, val in values.items():
+            self.set(key, val)
+    def save(self):
+        with self._lock:
+            if len(self._dirty_keys) == 0:
+                return
+            with _profile_stage('write_config'), _lock_file(_get_lock_fname(self.fname)):
+                self._stat = None
+                self._reload()
+                tmp_fname = f'{self.fname}.tmp'
+                with open(tmp_fname, 'w') as f:
+                    yaml.dump(self._values, f)
+                os.replace(tmp_fname, self.fname)
+                self._dirty_keys = set()
+                self._stat = _get_file_stat(self.fname)
+
+def _get_file_stat(fname: str):
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _get_lock_fname(fname: str):
+    # in a hidden directory, rather than next to the file
+    dirname, basename = os.path.split(os.path.abspath(fname))
+    os.makedirs(f'{dirname}/.isa-locks', exist_ok=True)
+    return f'{dirname}/.isa-locks/{basename}.lock'
+
+@contextmanager
+def _lock_file(lock_fname: str):
+    with open(lock_fname, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+_config_files = {}
+_config_files_lock = threading.Lock()
+
+def _get_config_file(fname: str) -> _ConfigFile:
+    key = os.path.abspath(fname)
+    with _config_files_lock:
+        if key not in _config_files:
+            _config_files[key] = _ConfigFile(fname)
+        return _config_files[key]
+
+def _get_project_config_file(project_dir: str='.'):
+    return _get_config_file(f'{project_dir}/isa-project.yaml')
+
+def _get_session_config_file(session: str, *, project_dir: str='.'):
+    return _get_config_file(f'{project_dir}/{session}/isa-session.yaml')
+
+@contextmanager
+def _edit_session_config(session: str):
+    # the values set in the block are written together when it completes
+    config = _get_session_config_file(session)
+    yield config
+    config.save()
+
 def _set_project_config_value(key: str, val: str):
-    isa_project_yaml_fname = 'isa-project.yaml'
-    if os.path.exists(isa_project_yaml_fname):
-        with open(isa_project_yaml_fname, 'r') as f:
-            project_config = yaml.safe_load(f)
-        if project_config is None:
-            project_config = {}
-    else:
-        project_config = {}
-    project_config[key] = val
-    with open(isa_project_yaml_fname, 'w') as f:
-        yaml.dump(project_config, f)
+    config = _get_project_config_file()
+    config.set(key, val)
+    config.save()
 
 def _get_project_config_value(key: str):
-    isa_project_yaml_fname = 'isa-project.yaml'
-    if os.path.exists(isa_project_yaml_fname):
-        with open(isa_project_yaml_fname, 'r') as f:
-            project_config = yaml.safe_load(f)
-        if project_config is None:
-            project_config = {}
-    else:
-        project_config = {}
-    return project_config.get(key, None)
+    return _get_project_config_file().get(key, None)
 
 def _check_project_config_exists():
-    isa_project_yaml_fname = 'isa-project.yaml'
-    return os.path.exists(isa_project_yaml_fname)
+    return _get_project_config_file().exists()
 
 def _set_session_config_value(session: str, key: str, val: str):
-    isa_session_yaml_fname = f'./{session}/isa-session.yaml'
-    if os.path.exists(isa_session_yaml_fname):
-        with open(isa_session_yaml_fname, 'r') as f:
-            session_config = yaml.safe_load(f)
-        if session_config is None:
-            session_config = {}
-    else:
-        session_config = {}
-    session_config[key] = val
-    with open(isa_session_yaml_fname, 'w') as f:
-        yaml.dump(session_config, f)
+    with _edit_session_config(session) as config:
+        config.set(key, val)
 
 def _get_session_config_value(session: str, key: str):
-    isa_session_yaml_fname = f'./{session}/isa-session.yaml'
-    if os.path.exists(isa_session_yaml_fname):
-        with open(isa_session_yaml_fname, 'r') as f:
-            session_config = yaml.safe_load(f)
-        if session_config is None:
-            session_config = {}
-    else:
-        session_config = {}
-    return session_config.get(key, None)
\ No newline at end of file
+    return _get_session_config_file(session).get(key, None)
+
+# session config values listed in the project index
+_project_index_keys = ['audio_fname', 'audio_sr_hz', 'audio_duration_sec', 'video_fname', 'video_fps', 'video_num_frames', 'spectrogram_sr_hz']
+
+_project_indexes = {}
+_project_indexes_lock = threading.Lock()
+
+def _get_project_index(project_dir: str='.') -> List[dict]:
+    # The sessions of the project with their main metadata. The entries are
+    # kept in memory (nothing is written, so that read-only queries do not
+    # need write access to the project) and a session config is parsed only
+    # when it has changed since its entry was made.
+    sessions: Union[List[str], None] = _get_project_config_file(project_dir).get('sessions', None)
+    key = os.path.abspath(project_dir)
+    with _project_indexes_lock:
+        previous_entries = _project_indexes.get(key, {})
+        entries = {}
+        for session in (sessions or []):
+            stat = _get_file_stat(f'{project_dir}/{session}/isa-session.yaml')
+            e = previous_entries.get(session, None)
+            if e is None or e['stat'] != stat:
+                config = _get_session_config_file(session, project_dir=project_dir).to_dict() if stat is not None else {}
+                e = {
+                    'session': session,
+                    'stat': stat,
+                    **{k: config.get(k, None) for k in _project_index_keys}
+                }
+            entries[session] = e
+        _project_indexes[key] = entries
+    return [{k: v for k, v in e.items() if k != 'stat'} for e in entries.values()]
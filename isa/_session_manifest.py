@@ -0,0 +1,83 @@
+from typing import Union
+import os
+import json
+import hashlib
+
+
+# Bump the version of an artifact when the code that produces it changes in
+# a way that should invalidate previously computed outputs
+_artifact_versions = {
+    'init': 1,
+    'spectrograms': 1,
+    'annotations': 1,
+    'video_proxy': 1,
+    'fingerprints': 1
+}
+
+def _load_session_manifest(session: str) -> dict:
+    manifest_fname = f'./{session}/isa-manifest.json'
+    if not os.path.exists(manifest_fname):
+        return {'inputs': {}, 'stages': {}}
+    with open(manifest_fname, 'r') as f:
+        manifest = json.load(f)
+    manifest.setdefault('inputs', {})
+    manifest.setdefault('stages', {})
+    return manifest
+
+def _save_session_manifest(session: str, manifest: dict):
+    manifest_fname = f'./{session}/isa-manifest.json'
+    tmp_fname = f'{manifest_fname}.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_fname, manifest_fname)
+
+def _get_file_fingerprint(path: str, previous: Union[dict, None]=None) -> dict:
+    st = os.stat(path)
+    if previous is not None and previous.get('size') == st.st_size and previous.get('mtime_ns') == st.st_mtime_ns:
+        # unchanged since the last time, no need to read the file
+        return previous
+    return {
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'hash': _fast_file_hash(path, size=st.st_size)
+    }
+
+def _fast_file_hash(path: str, *, size: int, block_size: int=1024 * 1024):
+    # hash of the size and of blocks at the start, middle and end of the file
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode('utf-8'))
+    with open(path, 'rb') as f:
+        for offset in [0, max(0, size // 2 - block_size // 2), max(0, size - block_size)]:
+            f.seek(offset)
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+def _get_session_input_fingerprint(session: str, manifest: dict, fname: Union[str, None]):
+    # Returns the content part of the fingerprint (size and hash) of an input
+    # file of the session and records the full fingerprint in the manifest
+    if fname is None:
+        return None
+    fp = _get_file_fingerprint(f'./{session}/{fname}', manifest['inputs'].get(fname, None))
+    manifest['inputs'][fname] = fp
+    return {'fname': fname, 'size': fp['size'], 'hash': fp['hash']}
+
+def _is_stage_up_to_date(manifest: dict, stage: str, key: dict):
+    s = manifest['stages'].get(stage, None)
+    if s is None:
+        return False
+    return s['key'] == key
+
+def _has_stage(manifest: dict, stage: str):
+    return stage in manifest['stages']
+
+def _set_stage(manifest: dict, stage: str, key: dict, *, outputs: Union[dict, None]=None):
+    manifest['stages'][stage] = {
+        'key': key,
+        'outputs': outputs if outputs is not None else {}
+    }
+
+def _get_stage_outputs(manifest: dict, stage: str) -> dict:
+    s = manifest['stages'].get(stage, None)
+    if s is None:
+        return {}
+    return s['outputs']
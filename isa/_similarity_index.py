@@ -0,0 +1,314 @@
+from typing import Union, List
+import os
+import json
+import threading
+import numpy as np
+import zarr
+from ._project_config import _get_project_config_file, _get_session_config_file
+from ._annotations_store import _get_annotations, _lock_annotations, _load_annotations_state
+
+
+# Finding vocalizations that are similar to a given one, across all the
+# sessions of the project. The fingerprint of a vocalization is its patch of
+# the uint8 spectrogram_for_gui, cropped to a frequency range and resampled
+# to patch_num_frames x patch_num_frequencies (so that it does not depend on
+# the duration of the vocalization), with the mean subtracted and unit norm.
+# The similarity of two vocalizations is the dot product of their
+# fingerprints.
+#
+# isa update writes the fingerprints of each session to
+# .isa-index/<session>.npz, computing only those of the vocalizations that
+# were added or changed since the last time. The service keeps the
+# fingerprints of all the sessions in memory, reloading the sessions whose
+# files changed. Below approximate_min_num_vectors fingerprints the search is
+# brute force, above it the fingerprints are grouped in sqrt(N) lists around
+# k-means centroids and only the nprobe lists closest to the query are
+# searched (the centroids are kept until the project has doubled in size).
+_index_dirname = '.isa-index'
+
+def _get_similarity_index_opts(config: Union[dict, None]):
+    # The similarity_index value of isa-project.yaml, for example
+    #
+    # similarity_index:
+    #   freq_range: [20000, 100000] # Hz, auto_detect_freq_range of each session by default
+    #   patch_num_frames: 16
+    #   patch_num_frequencies: 16
+    #   approximate_min_num_vectors: 100000
+    #   nprobe: 8
+    if config is None:
+        config = {}
+    freq_range = config.get('freq_range', None)
+    return {
+        'freq_range': [float(freq_range[0]), float(freq_range[1])] if freq_range is not None else None,
+        'patch_num_frames': int(config.get('patch_num_frames', 16)),
+        'patch_num_frequencies': int(config.get('patch_num_frequencies', 16)),
+        'approximate_min_num_vectors': int(config.get('approximate_min_num_vectors', 100000)),
+        'nprobe': int(config.get('nprobe', 8))
+    }
+
+def _get_fingerprint_params(session_config: dict, *, opts: dict, spectrograms_key: dict, version: int):
+    # everything the fingerprints of a session depend on, apart from the vocalizations
+    freq_range = opts['freq_range'] if opts['freq_range'] is not None else session_config['auto_detect_freq_range']
+    return {
+        'version': version,
+        'spectrograms': spectrograms_key,
+        'freq_range': [float(freq_range[0]), float(freq_range[1])],
+        'patch_num_frames': opts['patch_num_frames'],
+        'patch_num_frequencies': opts['patch_num_frequencies']
+    }
+
+def _get_session_fingerprints_fname(session: str, *, project_dir: str='.'):
+    return f'{project_dir}/{_index_dirname}/{session}.npz'
+
+def _compute_fingerprints(spectrogram_for_gui_zarr_fname: str, vocalizations: List[dict], *, params: dict):
+    from .export import _ChunkedTimeReader
+    root_group = zarr.open(spectrogram_for_gui_zarr_fname, mode='r')
+    frequencies = root_group['frequencies'][:]
+    f1, f2 = params['freq_range']
+    # at least one frequency bin, even if the range is outside of the spectrogram
+    j1 = min(int(np.searchsorted(frequencies, f1, side='left')), len(frequencies) - 1)
+    j2 = min(max(j1 + 1, int(np.searchsorted(frequencies, f2, side='right'))), len(frequencies))
+    T = params['patch_num_frames']
+    F = params['patch_num_frequencies']
+    reader = _ChunkedTimeReader(root_group['spectrogram'], j1=j1, j2=j2)
+    fingerprints = np.zeros((len(vocalizations), T * F), dtype=np.float32)
+    # in order of start frame, so that the reader decompresses each chunk once
+    for i in sorted(range(len(vocalizations)), key=lambda i: vocalizations[i]['startFrame']):
+        v = vocalizations[i]
+        x = reader.read(v['startFrame'], max(v['endFrame'], v['startFrame'] + 1)).astype(np.float32)
+        x = _resample_mean(_resample_mean(x, T, axis=0), F, axis=1).ravel()
+        x -= np.mean(x)
+        norm = np.linalg.norm(x)
+        if norm > 0:
+            fingerprints[i] = x / norm
+    return fingerprints
+
+def _resample_mean(x: np.ndarray, n: int, *, axis: int):
+    # means of x over n equal intervals along the axis, which may be shorter
+    # than one sample (linear interpolation of the cumulative sum)
+    x = np.moveaxis(x, axis, 0)
+    m = x.shape[0]
+    c = np.concatenate([np.zeros((1,) + x.shape[1:], dtype=np.float64), np.cumsum(x, axis=0, dtype=np.float64)], axis=0)
+    edges = np.linspace(0, m, n + 1)
+    k = np.minimum(np.floor(edges).astype(np.int64), m - 1)
+    frac = (edges - k).reshape((-1,) + (1,) * (x.ndim - 1))
+    ce = c[k] + (c[k + 1] - c[k]) * frac
+    return np.moveaxis((np.diff(ce, axis=0) * (n / m)).astype(np.float32), 0, axis)
+
+def _update_session_fingerprints(session: str, *, params: dict):
+    # The fingerprints in the previous file are kept for the vocalizations
+    # whose frames did not change, if they were computed with the same params
+    dirname = f'./{session}'
+    vocalizations = _get_annotations(f'{dirname}/annotations.json')['vocalizations']
+    fname = _get_session_fingerprints_fname(session)
+    previous = _load_session_fingerprints(fname)
+    previous_rows = {}
+    if previous is not None and previous['params'] == params:
+        for i, (vocalization_id, start_frame, end_frame) in enumerate(zip(previous['vocalization_ids'], previous['start_frames'], previous['end_frames'])):
+            previous_rows[(vocalization_id, int(start_frame), int(end_frame))] = i
+    fingerprints = np.zeros((len(vocalizations), params['patch_num_frames'] * params['patch_num_frequencies']), dtype=np.float32)
+    new_indices = []
+    for i, v in enumerate(vocalizations):
+        j = previous_rows.get((v['vocalizationId'], v['startFrame'], v['endFrame']), None)
+        if j is not None:
+            fingerprints[i] = previous['fingerprints'][j]
+        else:
+            new_indices.append(i)
+    print(f'Computing fingerprints of {len(new_indices)} of {len(vocalizations)} vocalizations')
+    if len(new_indices) > 0:
+        fingerprints[new_indices] = _compute_fingerprints(f'{dirname}/spectrogram_for_gui.zarr', [vocalizations[i] for i in new_indices], params=params)
+    sampling_frequency = zarr.open(f'{dirname}/spectrogram_for_gui.zarr', mode='r').attrs['spectrogram_sr_hz']
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = f'{fname}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.savez(
+            f,
+            params=np.array(json.dumps(params)),
+            sampling_frequency=np.array(sampling_frequency, dtype=np.float64),
+            vocalization_ids=np.array([v['vocalizationId'] for v in vocalizations], dtype=str),
+            start_frames=np.array([v['startFrame'] for v in vocalizations], dtype=np.int64),
+            end_frames=np.array([v['endFrame'] for v in vocalizations], dtype=np.int64),
+            fingerprints=fingerprints
+        )
+    os.replace(tmp_fname, fname)
+
+def _load_session_fingerprints(fname: str) -> Union[dict, None]:
+    if not os.path.exists(fname):
+        return None
+    with np.load(fname, allow_pickle=False) as f:
+        return {
+            'params': json.loads(str(f['params'])),
+            'sampling_frequency': float(f['sampling_frequency']),
+            'vocalization_ids': f['vocalization_ids'],
+            'start_frames': f['start_frames'],
+            'end_frames': f['end_frames'],
+            'fingerprints': f['fingerprints']
+        }
+
+class _ProjectSimilarityIndex:
+    def __init__(self, project_dir: str):
+        self.project_dir = project_dir
+        # session -> (stat of the file, fingerprints of the session, list of each fingerprint)
+        self.sessions = {}
+        self.session_names = []
+        self.centroids = None
+        self.num_trained = 0
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.session_indices = None
+        self.row_indices = None
+        self.list_offsets = None
+    def refresh(self, opts: dict):
+        session_names = _get_project_config_file(self.project_dir).get('sessions', None) or []
+        dim = opts['patch_num_frames'] * opts['patch_num_frequencies']
+        changed = self.vectors is None or session_names != self.session_names
+        for session in session_names:
+            fname = _get_session_fingerprints_fname(session, project_dir=self.project_dir)
+            try:
+                st = os.stat(fname)
+                stat = (st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                stat = None
+            s = self.sessions.get(session, None)
+            if s is not None and s[0] == stat:
+                continue
+            changed = True
+            data = _load_session_fingerprints(fname) if stat is not None else None
+            if data is not None and data['fingerprints'].shape[1] != dim:
+                print(f'WARNING: fingerprints of {session} were computed with other options, run isa update')
+                data = None
+            self.sessions[session] = (stat, data, None)
+        for session in list(self.sessions.keys()):
+            if session not in session_names:
+                del self.sessions[session]
+        if not changed:
+            return
+        self.session_names = list(session_names)
+        datas = [self.sessions[s][1] for s in session_names]
+        counts = [len(d['fingerprints']) if d is not None else 0 for d in datas]
+        vectors = np.concatenate([d['fingerprints'] for d in datas if d is not None] + [np.zeros((0, dim), dtype=np.float32)])
+        session_indices = np.repeat(np.arange(len(session_names), dtype=np.int32), counts)
+        row_indices = np.concatenate([np.arange(n, dtype=np.int64) for n in counts] + [np.zeros((0,), dtype=np.int64)])
+        if len(vectors) < opts['approximate_min_num_vectors']:
+            self.centroids = None
+            self.num_trained = 0
+            self.vectors, self.session_indices, self.row_indices, self.list_offsets = vectors, session_indices, row_indices, None
+            return
+        if self.centroids is None or self.centroids.shape[1] != dim or len(vectors) > 2 * self.num_trained:
+            print(f'Training the similarity index on {len(vectors)} fingerprints')
+            self.centroids = _train_centroids(vectors, num_lists=int(np.sqrt(len(vectors))))
+            self.num_trained = len(vectors)
+            self.sessions = {s: (stat, data, None) for s, (stat, data, _) in self.sessions.items()}
+        lists = []
+        for session in session_names:
+            stat, data, session_lists = self.sessions[session]
+            if data is None:
+                continue
+            if session_lists is None:
+                session_lists = _assign_lists(data['fingerprints'], self.centroids)
+                self.sessions[session] = (stat, data, session_lists)
+            lists.append(session_lists)
+        lists = np.concatenate(lists)
+        # the fingerprints of each list are contiguous
+        order = np.argsort(lists, kind='stable')
+        self.vectors = vectors[order]
+        self.session_indices = session_indices[order]
+        self.row_indices = row_indices[order]
+        self.list_offsets = np.searchsorted(lists[order], np.arange(len(self.centroids) + 1))
+    def search(self, q: np.ndarray, *, k: int, nprobe: int, exclude: Union[tuple, None]=None):
+        if self.list_offsets is None:
+            candidates = np.arange(len(self.vectors))
+            scores = self.vectors @ q
+        else:
+            lists = np.argsort(-(self.centroids @ q))[:nprobe]
+            candidates = np.concatenate([np.arange(self.list_offsets[l], self.list_offsets[l + 1]) for l in lists])
+            scores = self.vectors[candidates] @ q
+        # one more in case the query itself is among them
+        n = min(k + 1, len(candidates))
+        top = np.argpartition(-scores, n - 1)[:n] if n > 0 else np.zeros((0,), dtype=np.int64)
+        top = top[np.argsort(-scores[top], kind='stable')]
+        results = []
+        for i in top:
+            session = self.session_names[self.session_indices[candidates[i]]]
+            data = self.sessions[session][1]
+            row = self.row_indices[candidates[i]]
+            vocalization_id = str(data['vocalization_ids'][row])
+            if exclude is not None and (session, vocalization_id) == exclude:
+                continue
+            results.append({
+                'session': session,
+                'vocalizationId': vocalization_id,
+                'startFrame': int(data['start_frames'][row]),
+                'endFrame': int(data['end_frames'][row]),
+                'samplingFrequency': data['sampling_frequency'],
+                'similarity': float(scores[i])
+            })
+        return results[:k]
+
+def _assign_lists(vectors: np.ndarray, centroids: np.ndarray, *, block_size: int=16384):
+    lists = np.zeros((len(vectors),), dtype=np.int32)
+    for i in range(0, len(vectors), block_size):
+        lists[i:i + block_size] = np.argmax(vectors[i:i + block_size] @ centroids.T, axis=1)
+    return lists
+
+def _train_centroids(vectors: np.ndarray, *, num_lists: int, num_iterations: int=10):
+    # spherical k-means on a sample of the fingerprints
+    rng = np.random.default_rng(0)
+    sample = vectors[np.sort(rng.choice(len(vectors), size=min(len(vectors), 64 * num_lists), replace=False))]
+    centroids = sample[rng.choice(len(sample), size=num_lists, replace=False)].copy()
+    for _ in range(num_iterations):
+        lists = _assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, sample)
+        norms = np.linalg.norm(sums, axis=1)
+        # lists that are empty keep their centroid
+        nonempty = norms > 0
+        centroids[nonempty] = sums[nonempty] / norms[nonempty].reshape((-1, 1))
+    return centroids
+
+_project_indexes = {}
+_project_indexes_lock = threading.Lock()
+
+def _find_similar_vocalizations(
+    project_dir: str, *,
+    session: str,
+    vocalization_id: str,
+    k: int=20,
+    exact: bool=False
+):
+    # The k vocalizations of the project that are most similar to a
+    # vocalization, which may have been added or changed since isa update
+    # (its fingerprint is then computed here)
+    opts = _get_similarity_index_opts(_get_project_config_file(project_dir).get('similarity_index', None))
+    with _project_indexes_lock:
+        index = _project_indexes.get(project_dir, None)
+        if index is None:
+            index = _ProjectSimilarityIndex(project_dir)
+            _project_indexes[project_dir] = index
+    annotations_json_fname = f'{project_dir}/{session}/annotations.json'
+    with _lock_annotations(annotations_json_fname):
+        v = _load_annotations_state(annotations_json_fname).vocalizations.get(vocalization_id, None)
+    if v is None:
+        raise Exception(f'Vocalization not found in {session}: {vocalization_id}')
+    with index.lock:
+        index.refresh(opts)
+        q = None
+        data = index.sessions.get(session, (None, None, None))[1]
+        if data is not None:
+            rows = np.nonzero(data['vocalization_ids'] == vocalization_id)[0]
+            if len(rows) > 0 and data['start_frames'][rows[0]] == v['startFrame'] and data['end_frames'][rows[0]] == v['endFrame']:
+                q = data['fingerprints'][rows[0]]
+        if q is None:
+            if data is not None:
+                params = data['params']
+            else:
+                session_config = _get_session_config_file(session, project_dir=project_dir).to_dict()
+                params = _get_fingerprint_params(session_config, opts=opts, spectrograms_key=None, version=None)
+            q = _compute_fingerprints(f'{project_dir}/{session}/spectrogram_for_gui.zarr', [v], params=params)[0]
+        nprobe = len(index.centroids) if (exact and index.centroids is not None) else opts['nprobe']
+        results = index.search(q, k=k, nprobe=nprobe, exclude=(session, vocalization_id))
+        return {
+            'vocalizations': results,
+            'numFingerprints': len(index.vectors),
+            'approximate': index.list_offsets is not None and not exact
+        }
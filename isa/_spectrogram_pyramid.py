@@ -0,0 +1,174 @@
+from typing import Union, List
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import zarr
+import numcodecs
+from ._profile import _profile_stage
+
+
+def _get_spectrogram_pyramid_opts(config: Union[dict, None]):
+    # The spectrogram_pyramid value of isa-project.yaml, for example
+    #
+    # spectrogram_pyramid:
+    #   chunk_num_frames: 10000
+    #   compressor: {id: blosc, cname: zstd, clevel: 5, shuffle: bitshuffle}
+    #   reducer: max # or mean
+    #   num_threads: 8
+    #   frequency_ds_factors: [2, 4]
+    #   band: false # also write levels cropped to auto_detect_freq_range
+    if config is None:
+        config = {}
+    compressor_config = config.get('compressor', None)
+    return {
+        'chunk_num_frames': int(config.get('chunk_num_frames', 10000)),
+        'compressor': _get_compressor(compressor_config) if compressor_config is not None else 'default',
+        'reducer': config.get('reducer', 'max'),
+        'num_threads': int(config.get('num_threads', min(8, os.cpu_count() or 1))),
+        'frequency_ds_factors': [int(m) for m in config.get('frequency_ds_factors', [2, 4])],
+        'band': bool(config.get('band', False))
+    }
+
+def _get_compressor(compressor_config: dict):
+    c = dict(compressor_config)
+    if c.get('id', 'blosc') == 'blosc':
+        c['id'] = 'blosc'
+        shuffle = c.get('shuffle', 'shuffle')
+        if isinstance(shuffle, str):
+            shuffle_values = {'noshuffle': numcodecs.Blosc.NOSHUFFLE, 'shuffle': numcodecs.Blosc.SHUFFLE, 'bitshuffle': numcodecs.Blosc.BITSHUFFLE}
+            if shuffle not in shuffle_values:
+                raise Exception(f'Unexpected blosc shuffle: {shuffle}')
+            c['shuffle'] = shuffle_values[shuffle]
+    return numcodecs.get_codec(c)
+
+def _create_spectrogram_array(root_group: zarr.Group, name: str, *, shape: tuple, pyramid_opts: dict, data: Union[np.ndarray, None]=None):
+    kwargs = {}
+    if pyramid_opts['compressor'] != 'default':
+        kwargs['compressor'] = pyramid_opts['compressor']
+    chunks = (pyramid_opts['chunk_num_frames'], shape[1])
+    if data is not None:
+        return root_group.create_dataset(name, data=data, chunks=chunks, **kwargs)
+    return root_group.create_dataset(name, shape=shape, dtype=np.uint8, chunks=chunks, **kwargs)
+
+def _build_spectrogram_pyramid(root_group: zarr.Group, *, pyramid_opts: dict, band_freq_range: Union[List[int], None]=None):
+    # Creates spectrogram_ds3, spectrogram_ds9, ... from the spectrogram array
+    # of the group. Each output chunk is computed from the (three) source
+    # chunks behind it only, and the chunks of a level are computed and
+    # written in parallel threads (compression releases the GIL).
+    #
+    # Each of these time levels (and the spectrogram itself) also gets
+    # frequency levels, for example spectrogram_ds9_fds4 with the max (or
+    # mean) of groups of 4 frequency bins, and optionally a band level,
+    # spectrogram_band_ds9, with only the frequency bins of band_freq_range.
+    # The levels are listed in the pyramid attribute of the group so that
+    # readers can choose the smallest one for what they display.
+    source = root_group['spectrogram']
+    num_frames = source.shape[0]
+    num_frequencies = source.shape[1]
+    chunk_num_frames = pyramid_opts['chunk_num_frames']
+    reducer = pyramid_opts['reducer']
+    if reducer not in ['max', 'mean']:
+        raise Exception(f'Unexpected spectrogram pyramid reducer: {reducer}')
+    if band_freq_range is not None:
+        j1 = max(0, min(band_freq_range[0], num_frequencies - 1))
+        band_freq_range = [j1, max(j1 + 1, min(band_freq_range[1], num_frequencies))]
+    ds_factor = 3
+    time_levels = [('spectrogram', 1)]
+    with _profile_stage('pyramid'), ThreadPoolExecutor(max_workers=pyramid_opts['num_threads']) as executor:
+        while ds_factor < num_frames:
+            with _profile_stage(f'pyramid_ds{ds_factor}'):
+                n = source.shape[0] // 3
+                target = _create_spectrogram_array(root_group, f'spectrogram_ds{ds_factor}', shape=(n, num_frequencies), pyramid_opts=pyramid_opts)
+                def write_chunk(i1: int):
+                    i2 = min(i1 + chunk_num_frames, n)
+                    x = source[i1 * 3:i2 * 3]
+                    if reducer == 'max':
+                        x_ds = downsample_spectrogram_using_max(x, ds_factor=3)
+                    else:
+                        x_ds = downsample_spectrogram_using_mean(x, ds_factor=3)
+                    target[i1:i2] = x_ds
+                # consume the results so that exceptions are raised
+                list(executor.map(write_chunk, range(0, n, chunk_num_frames)))
+            time_levels.append((f'spectrogram_ds{ds_factor}', ds_factor))
+            source = target
+            ds_factor *= 3
+        levels = [_get_level_info(name, ds_factor=level_ds_factor, num_frames=root_group[name].shape[0], frequency_ds_factor=1, frequency_range=[0, num_frequencies]) for name, level_ds_factor in time_levels]
+        with _profile_stage('pyramid_frequency'):
+            for name, level_ds_factor in time_levels:
+                for m in pyramid_opts['frequency_ds_factors']:
+                    if m <= 1 or m >= num_frequencies:
+                        continue
+                    info = _get_level_info(f'{name}_fds{m}', ds_factor=level_ds_factor, num_frames=root_group[name].shape[0], frequency_ds_factor=m, frequency_range=[0, num_frequencies])
+                    _write_frequency_level(root_group, name, info, executor=executor, pyramid_opts=pyramid_opts)
+                    levels.append(info)
+                if band_freq_range is not None:
+                    band_name = 'spectrogram_band' if level_ds_factor == 1 else f'spectrogram_band_ds{level_ds_factor}'
+                    info = _get_level_info(band_name, ds_factor=level_ds_factor, num_frames=root_group[name].shape[0], frequency_ds_factor=1, frequency_range=band_freq_range)
+                    _write_frequency_level(root_group, name, info, executor=executor, pyramid_opts=pyramid_opts)
+                    levels.append(info)
+    root_group.attrs['pyramid'] = {
+        'reducer': reducer,
+        'frequency_ds_factors': sorted(set([1] + [level['frequency_ds_factor'] for level in levels])),
+        'band_frequency_range': band_freq_range,
+        'levels': levels
+    }
+
+def _get_level_info(name: str, *, ds_factor: int, num_frames: int, frequency_ds_factor: int, frequency_range: List[int]):
+    return {
+        'name': name,
+        'ds_factor': ds_factor,
+        'frequency_ds_factor': frequency_ds_factor,
+        'start_frequency_index': frequency_range[0],
+        'end_frequency_index': frequency_range[1],
+        'num_frames': num_frames,
+        'num_frequencies': (frequency_range[1] - frequency_range[0] + frequency_ds_factor - 1) // frequency_ds_factor
+    }
+
+def _write_frequency_level(root_group: zarr.Group, source_name: str, info: dict, *, executor: ThreadPoolExecutor, pyramid_opts: dict):
+    source = root_group[source_name]
+    chunk_num_frames = pyramid_opts['chunk_num_frames']
+    n = source.shape[0]
+    j1, j2 = info['start_frequency_index'], info['end_frequency_index']
+    m = info['frequency_ds_factor']
+    target = _create_spectrogram_array(root_group, info['name'], shape=(n, info['num_frequencies']), pyramid_opts=pyramid_opts)
+    def write_chunk(i1: int):
+        i2 = min(i1 + chunk_num_frames, n)
+        x = source[i1:i2, j1:j2]
+        if m == 1:
+            target[i1:i2] = x
+        elif pyramid_opts['reducer'] == 'max':
+            target[i1:i2] = downsample_spectrogram_frequencies_using_max(x, ds_factor=m)
+        else:
+            target[i1:i2] = downsample_spectrogram_frequencies_using_mean(x, ds_factor=m)
+    list(executor.map(write_chunk, range(0, n, chunk_num_frames)))
+
+def downsample_spectrogram_using_max(spectrogram: np.ndarray, *, ds_factor: int):
+    Nt = spectrogram.shape[0]
+    Nf = spectrogram.shape[1]
+    Nt_ds = Nt // ds_factor
+    spectrogram = spectrogram[:Nt_ds * ds_factor, :]
+    spectrogram_reshaped = spectrogram.reshape((Nt_ds, ds_factor, Nf))
+    spectrogram_ds = np.max(spectrogram_reshaped, axis=1)
+    return spectrogram_ds
+
+def downsample_spectrogram_using_mean(spectrogram: np.ndarray, *, ds_factor: int):
+    Nt = spectrogram.shape[0]
+    Nf = spectrogram.shape[1]
+    Nt_ds = Nt // ds_factor
+    spectrogram = spectrogram[:Nt_ds * ds_factor, :]
+    spectrogram_reshaped = spectrogram.reshape((Nt_ds, ds_factor, Nf))
+    # rounded integer mean
+    s = np.sum(spectrogram_reshaped, axis=1, dtype=np.int64)
+    spectrogram_ds = ((s + ds_factor // 2) // ds_factor).astype(spectrogram.dtype)
+    return spectrogram_ds
+
+def downsample_spectrogram_frequencies_using_max(spectrogram: np.ndarray, *, ds_factor: int):
+    # the last group of frequency bins may have fewer than ds_factor bins
+    return np.maximum.reduceat(spectrogram, np.arange(0, spectrogram.shape[1], ds_factor), axis=1)
+
+def downsample_spectrogram_frequencies_using_mean(spectrogram: np.ndarray, *, ds_factor: int):
+    starts = np.arange(0, spectrogram.shape[1], ds_factor)
+    counts = np.diff(np.append(starts, spectrogram.shape[1]))
+    # rounded integer mean
+    s = np.add.reduceat(spectrogram.astype(np.int64), starts, axis=1)
+    return ((s + counts // 2) // counts).astype(spectrogram.dtype)
@@ -0,0 +1,151 @@
+from typing import Union, List
+import os
+import numpy as np
+import zarr
+from ._lru_cache import _LRUCache
+
+
+# Summary statistics of spectrogram_for_gui, written to the stats group of
+# spectrogram_for_gui.zarr when the spectrograms are created:
+#
+# chunk_frequency_max    Nchunks x Nf, max of the (unscaled) summed spectrogram
+# chunk_frequency_mean   Nchunks x Nf, mean of the (unscaled) summed spectrogram
+# chunk_histogram        Nchunks x 16, counts of the uint8 values in bins of 16 levels
+# frequency_histogram    Nf x 256, counts of the uint8 values per frequency
+#
+# The chunks are the 15-second chunks that the maxval is the median of, so
+# the maxval, and the percentile threshold for any band of frequencies, come
+# from the statistics rather than from another pass over the spectrogram.
+_spectrogram_stats_version = 1
+_chunk_duration_sec = 15
+_chunk_histogram_num_bins = 16
+
+class _SpectrogramStatsAccumulator:
+    def __init__(self, *, num_frames: int, num_frequencies: int, sr_spectrogram: float):
+        self.num_frames = num_frames
+        self.num_frequencies = num_frequencies
+        self.chunk_num_frames = int(_chunk_duration_sec * sr_spectrogram)
+        num_chunks = (num_frames + self.chunk_num_frames - 1) // self.chunk_num_frames
+        self.chunk_frequency_max = np.zeros((num_chunks, num_frequencies), dtype=np.float64)
+        self.chunk_frequency_sum = np.zeros((num_chunks, num_frequencies), dtype=np.float64)
+        self.chunk_histogram = np.zeros((num_chunks, _chunk_histogram_num_bins), dtype=np.int64)
+        self.frequency_histogram = np.zeros((num_frequencies, 256), dtype=np.int64)
+    def _iterate_chunk_pieces(self, frame_start: int, frame_end: int):
+        # the parts of the frames [frame_start, frame_end) in each chunk, relative to frame_start
+        chunk_num_frames = self.chunk_num_frames
+        for chunk_ind in range(frame_start // chunk_num_frames, (frame_end - 1) // chunk_num_frames + 1):
+            i1 = max(chunk_ind * chunk_num_frames, frame_start) - frame_start
+            i2 = min((chunk_ind + 1) * chunk_num_frames, frame_end) - frame_start
+            yield chunk_ind, i1, i2
+    def add_block(self, spectrogram: np.ndarray, *, frame_start: int):
+        # frames of the unscaled spectrogram_for_gui (Nt x Nf)
+        for chunk_ind, i1, i2 in self._iterate_chunk_pieces(frame_start, frame_start + spectrogram.shape[0]):
+            np.maximum(self.chunk_frequency_max[chunk_ind], np.max(spectrogram[i1:i2], axis=0), out=self.chunk_frequency_max[chunk_ind])
+            self.chunk_frequency_sum[chunk_ind] += np.sum(spectrogram[i1:i2], axis=0)
+    def add_scaled_block(self, spectrogram: np.ndarray, *, frame_start: int):
+        # frames of the uint8 spectrogram_for_gui (Nt x Nf)
+        if spectrogram.dtype != np.uint8:
+            raise Exception(f'Unexpected dtype for spectrogram: {spectrogram.dtype}')
+        offsets = np.arange(self.num_frequencies, dtype=np.int32) * 256
+        bin_width = 256 // _chunk_histogram_num_bins
+        for chunk_ind, i1, i2 in self._iterate_chunk_pieces(frame_start, frame_start + spectrogram.shape[0]):
+            x = spectrogram[i1:i2]
+            self.chunk_histogram[chunk_ind] += np.bincount((x // bin_width).ravel(), minlength=_chunk_histogram_num_bins)
+            self.frequency_histogram += np.bincount((x + offsets).ravel(), minlength=self.num_frequencies * 256).reshape((self.num_frequencies, 256))
+    def get_maxval(self):
+        # median of the maxima of the chunks, leaving out the last chunk
+        # (which ends at or before the end of the spectrogram)
+        num_chunks = max(0, (self.num_frames - 1) // self.chunk_num_frames)
+        return np.median(np.max(self.chunk_frequency_max[:num_chunks], axis=1)) if num_chunks > 0 else np.median([])
+    def get_absolute_maxval(self):
+        return np.max(self.chunk_frequency_max)
+    def write(self, root_group: zarr.Group, *, maxval: float, minval: float):
+        chunk_frame_counts = np.diff(np.minimum(np.arange(len(self.chunk_frequency_sum) + 1) * self.chunk_num_frames, self.num_frames))
+        g = root_group.create_group('stats', overwrite=True)
+        g.create_dataset('chunk_frequency_max', data=self.chunk_frequency_max)
+        g.create_dataset('chunk_frequency_mean', data=self.chunk_frequency_sum / np.maximum(chunk_frame_counts, 1).reshape((-1, 1)))
+        g.create_dataset('chunk_histogram', data=self.chunk_histogram)
+        g.create_dataset('frequency_histogram', data=self.frequency_histogram)
+        g.attrs.update({
+            'version': _spectrogram_stats_version,
+            'num_frames': self.num_frames,
+            'chunk_num_frames': self.chunk_num_frames,
+            'maxval': float(maxval),
+            'minval': float(minval)
+        })
+
+def _has_spectrogram_stats(spectrogram_for_gui_zarr_fname: str):
+    return os.path.exists(f'{spectrogram_for_gui_zarr_fname}/stats/.zattrs')
+
+def _create_spectrogram_stats_from_zarr(spectrogram_for_gui_zarr_fname: str, spectrograms_zarr_fname: str):
+    # for spectrograms that were created before the statistics existed
+    spectrograms: zarr.Array = zarr.open(spectrograms_zarr_fname, mode='r')['spectrograms']
+    root_group = zarr.open(spectrogram_for_gui_zarr_fname, mode='a')
+    spectrogram: zarr.Array = root_group['spectrogram']
+    num_frames, num_frequencies = spectrogram.shape
+    stats = _SpectrogramStatsAccumulator(num_frames=num_frames, num_frequencies=num_frequencies, sr_spectrogram=root_group.attrs['spectrogram_sr_hz'])
+    block_num_frames = spectrograms.chunks[1]
+    for i in range(0, num_frames, block_num_frames):
+        x = spectrograms[:, i:i + block_num_frames]
+        # same summation order as _stft_psd
+        stats.add_block(np.sum(x, axis=0), frame_start=i)
+        stats.add_scaled_block(spectrogram[i:i + block_num_frames], frame_start=i)
+    stats.write(root_group, maxval=stats.get_maxval(), minval=0)
+
+_spectrogram_stats_cache = _LRUCache(max_bytes=64 * 1024 * 1024)
+
+def _load_spectrogram_stats(spectrogram_for_gui_zarr_fname: str) -> Union[dict, None]:
+    try:
+        mtime = os.stat(f'{spectrogram_for_gui_zarr_fname}/stats/.zattrs').st_mtime_ns
+    except OSError:
+        return None
+    key = (spectrogram_for_gui_zarr_fname, mtime)
+    cached = _spectrogram_stats_cache.get(key)
+    if cached is not None:
+        return cached
+    g = zarr.open(spectrogram_for_gui_zarr_fname, mode='r')['stats']
+    stats = {k: g[k][:] for k in ['chunk_frequency_max', 'chunk_frequency_mean', 'chunk_histogram', 'frequency_histogram']}
+    stats.update(dict(g.attrs))
+    _spectrogram_stats_cache.set(key, stats, num_bytes=sum(v.nbytes for v in stats.values() if isinstance(v, np.ndarray)))
+    return stats
+
+def _get_band_histogram(stats: dict, freq_range: List[int]):
+    # counts of the uint8 values in the frequency bins [freq_range[0], freq_range[1])
+    return np.sum(stats['frequency_histogram'][freq_range[0]:freq_range[1]], axis=0)
+
+def _get_spectrogram_stats_summary(
+    spectrogram_for_gui_zarr_fname: str, *,
+    f1_hz: Union[float, None]=None,
+    f2_hz: Union[float, None]=None,
+    percentiles: List[float]=[50, 90, 99, 99.9]
+):
+    # For the viewer: the chunk maxima and means of the band (on the uint8
+    # scale of the spectrogram), its histogram and percentiles, and default
+    # contrast limits
+    from .auto_detect_vocalizations import _percentile_from_histogram
+    stats = _load_spectrogram_stats(spectrogram_for_gui_zarr_fname)
+    if stats is None:
+        return None
+    root_group = zarr.open(spectrogram_for_gui_zarr_fname, mode='r')
+    frequencies = root_group['frequencies'][:]
+    j1 = 0 if f1_hz is None else int(np.searchsorted(frequencies, f1_hz, side='left'))
+    j2 = len(frequencies) if f2_hz is None else int(np.searchsorted(frequencies, f2_hz, side='right'))
+    j2 = max(j1 + 1, j2)
+    scale = 255 / (stats['maxval'] - stats['minval'])
+    histogram = _get_band_histogram(stats, [j1, j2])
+    percentile_values = {str(p): float(_percentile_from_histogram(histogram, p)) for p in percentiles}
+    low = float(_percentile_from_histogram(histogram, 50))
+    high = max(float(_percentile_from_histogram(histogram, 99.9)), low + 1)
+    return {
+        'startFrequencyIndex': j1,
+        'endFrequencyIndex': j2,
+        'samplingFrequency': root_group.attrs['spectrogram_sr_hz'],
+        'chunkNumFrames': stats['chunk_num_frames'],
+        'numFrames': stats['num_frames'],
+        'chunkMax': ((np.max(stats['chunk_frequency_max'][:, j1:j2], axis=1) - stats['minval']) * scale).tolist(),
+        'chunkMean': ((np.mean(stats['chunk_frequency_mean'][:, j1:j2], axis=1) - stats['minval']) * scale).tolist(),
+        'chunkHistogram': stats['chunk_histogram'].tolist(),
+        'histogram': histogram.tolist(),
+        'percentiles': percentile_values,
+        'contrast': {'min': low, 'max': min(high, 255)}
+    }
@@ -0,0 +1,119 @@
+from typing import Union
+import os
+import numpy as np
+import zarr
+from ._lru_cache import _LRUCache
+
+
+_spectrogram_chunk_cache = _LRUCache(max_bytes=int(os.environ.get('ISA_SPECTROGRAM_CACHE_MB', '512')) * 1024 * 1024)
+
+def _get_spectrogram_tile(
+    spectrogram_for_gui_zarr_fname: str, *,
+    t1_sec: float,
+    t2_sec: float,
+    target_width: int,
+    f1_hz: Union[float, None]=None,
+    f2_hz: Union[float, None]=None,
+    target_height: Union[int, None]=None
+):
+    # Returns the part of the coarsest pyramid level that still has at least
+    # target_width frames in the time range, cropped to the frequency range.
+    # If target_height is given, the frequency bins may also be downsampled
+    # as long as at least target_height of them are left in the range.
+    root_group = zarr.open(spectrogram_for_gui_zarr_fname, mode='r')
+    sr_spectrogram = root_group.attrs['spectrogram_sr_hz']
+    frequencies = _get_cached_array(spectrogram_for_gui_zarr_fname, root_group, 'frequencies')
+    num_frames = root_group['spectrogram'].shape[0]
+
+    ds_factor = 1
+    while (t2_sec - t1_sec) * sr_spectrogram / (ds_factor * 3) >= target_width and f'spectrogram_ds{ds_factor * 3}' in root_group:
+        ds_factor *= 3
+    j1 = 0 if f1_hz is None else int(np.searchsorted(frequencies, f1_hz, side='left'))
+    j2 = len(frequencies) if f2_hz is None else int(np.searchsorted(frequencies, f2_hz, side='right'))
+    j2 = max(j1, j2)
+    level = _choose_frequency_level(root_group.attrs.get('pyramid', None), ds_factor=ds_factor, j1=j1, j2=j2, target_height=target_height)
+    if level is not None:
+        array_name = level['name']
+        frequency_ds_factor = level['frequency_ds_factor']
+        level_start = level['start_frequency_index']
+    else:
+        # pyramid without frequency levels
+        array_name = 'spectrogram' if ds_factor == 1 else f'spectrogram_ds{ds_factor}'
+        frequency_ds_factor = 1
+        level_start = 0
+    array: zarr.Array = root_group[array_name]
+
+    i1 = max(0, min(int(np.floor(t1_sec * sr_spectrogram / ds_factor)), array.shape[0]))
+    i2 = max(i1, min(int(np.ceil(t2_sec * sr_spectrogram / ds_factor)), array.shape[0]))
+    # the bins of the level that cover [j1, j2)
+    k1 = (j1 - level_start) // frequency_ds_factor
+    k2 = max(k1, min(-(-(j2 - level_start) // frequency_ds_factor), array.shape[1]))
+
+    chunk_num_frames = array.chunks[0]
+    pieces = []
+    chunk_indices = range(i1 // chunk_num_frames, (i2 - 1) // chunk_num_frames + 1) if i2 > i1 else []
+    for chunk_index in chunk_indices:
+        chunk = _get_spectrogram_chunk(spectrogram_for_gui_zarr_fname, array, array_name, chunk_index)
+        offset = chunk_index * chunk_num_frames
+        pieces.append(chunk[max(i1 - offset, 0):min(i2 - offset, chunk.shape[0]), k1:k2])
+    tile = np.concatenate(pieces, axis=0) if len(pieces) > 0 else np.zeros((0, k2 - k1), dtype=np.uint8)
+    info = {
+        'dsFactor': ds_factor,
+        'frequencyDsFactor': frequency_ds_factor,
+        'startFrame': i1,
+        'endFrame': i2,
+        # in full resolution frequency bins
+        'startFrequencyIndex': level_start + k1 * frequency_ds_factor,
+        'endFrequencyIndex': min(level_start + k2 * frequency_ds_factor, len(frequencies)),
+        'samplingFrequency': sr_spectrogram / ds_factor,
+        'numFramesFullResolution': num_frames,
+        'shape': [int(tile.shape[0]), int(tile.shape[1])],
+        'dtype': str(tile.dtype)
+    }
+    return info, np.ascontiguousarray(tile)
+
+def _choose_frequency_level(pyramid: Union[dict, None], *, ds_factor: int, j1: int, j2: int, target_height: Union[int, None]):
+    # Among the levels of the time downsampling factor that cover the
+    # frequency bins [j1, j2), the one with the largest frequency
+    # downsampling that leaves at least target_height bins, and then the one
+    # with the fewest bins per frame (a band level if the range is within it)
+    if pyramid is None:
+        return None
+    best = None
+    for level in pyramid['levels']:
+        if level['ds_factor'] != ds_factor:
+            continue
+        if level['start_frequency_index'] > j1 or level['end_frequency_index'] < j2:
+            continue
+        m = level['frequency_ds_factor']
+        if m > 1 and (target_height is None or -(-(j2 - j1) // m) < target_height):
+            continue
+        if best is None or (m, -level['num_frequencies']) > (best['frequency_ds_factor'], -best['num_frequencies']):
+            best = level
+    return best
+
+def _get_spectrogram_chunk(spectrogram_for_gui_zarr_fname: str, array: zarr.Array, array_name: str, chunk_index: int):
+    # the modification time of the array metadata changes when the spectrograms are recomputed
+    key = (spectrogram_for_gui_zarr_fname, array_name, _get_array_mtime(spectrogram_for_gui_zarr_fname, array_name), chunk_index)
+    cached = _spectrogram_chunk_cache.get(key)
+    if cached is not None:
+        return cached
+    chunk_num_frames = array.chunks[0]
+    chunk = array[chunk_index * chunk_num_frames:(chunk_index + 1) * chunk_num_frames]
+    _spectrogram_chunk_cache.set(key, chunk)
+    return chunk
+
+def _get_cached_array(spectrogram_for_gui_zarr_fname: str, root_group: zarr.Group, array_name: str):
+    key = (spectrogram_for_gui_zarr_fname, array_name, _get_array_mtime(spectrogram_for_gui_zarr_fname, array_name), 'all')
+    cached = _spectrogram_chunk_cache.get(key)
+    if cached is not None:
+        return cached
+    x = root_group[array_name][:]
+    _spectrogram_chunk_cache.set(key, x)
+    return x
+
+def _get_array_mtime(zarr_fname: str, array_name: str):
+    try:
+        return os.stat(f'{zarr_fname}/{array_name}/.zarray').st_mtime_ns
+    except OSError:
+        return None
@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def _stft_psd(X: np.ndarray, *, sr_hz: float, nfft: int=512, noverlap: int=256, batch_num_frames: int=4096):
+    # X is Nsamples x Nchannels
+    # Returns the one-sided PSD spectrograms of all channels (Nchannels x Nt x Nf)
+    # with the same framing and scaling as matplotlib's specgram (hanning
+    # window, no detrending, scale_by_freq), together with their sum over channels
+    if X.ndim == 1:
+        X = X.reshape((-1, 1))
+    num_channels = X.shape[1]
+    step = nfft - noverlap
+    if X.shape[0] < nfft:
+        X = np.concatenate([X, np.zeros((nfft - X.shape[0], num_channels), dtype=X.dtype)], axis=0)
+    num_samples = X.shape[0]
+    num_frames = 1 + (num_samples - nfft) // step
+    num_frequencies = nfft // 2 + 1
+
+    window = np.hanning(nfft)
+    # everything except the DC and the nfft/2 component is scaled by 2 for
+    # the one-sided density
+    scaled = slice(1, -1) if nfft % 2 == 0 else slice(1, None)
+
+    # Nt x Nchannels x nfft view of the overlapping frames (no copy)
+    frames = np.lib.stride_tricks.sliding_window_view(X, nfft, axis=0)[::step]
+
+    spectrograms = np.zeros((num_channels, num_frames, num_frequencies), dtype=np.float64)
+    spectrogram_sum = np.zeros((num_frames, num_frequencies), dtype=np.float64)
+    for i1 in range(0, num_frames, batch_num_frames):
+        i2 = min(i1 + batch_num_frames, num_frames)
+        # Nchannels x batch x nfft
+        # the same operations, in the same order and on complex values, as
+        # matplotlib.mlab._spectral_helper, so that the result is identical
+        a = np.transpose(frames[i1:i2], (1, 0, 2)) * window
+        result = np.fft.fft(a, n=nfft, axis=2)[:, :, :num_frequencies]
+        result = np.conj(result) * result
+        result[:, :, scaled] *= 2.
+        result /= sr_hz
+        result /= (window ** 2).sum()
+        psd = result.real
+        spectrograms[:, i1:i2] = psd
+        np.sum(psd, axis=0, out=spectrogram_sum[i1:i2])
+
+    frequencies = np.fft.rfftfreq(nfft, 1 / sr_hz)
+    times = np.arange(nfft / 2, num_samples - nfft / 2 + 1, step) / sr_hz
+    return spectrograms, spectrogram_sum, frequencies, times
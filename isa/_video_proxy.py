@@ -0,0 +1,118 @@
+from typing import Union
+import os
+import json
+import mmap
+import struct
+import threading
+import numpy as np
+
+
+# Layout of video_proxy.bin
+#
+# header (32 bytes): magic, offset of the offset table, number of frames,
+#                    offset of the info json (little-endian uint64)
+# jpeg data:         the encoded frames, one after the other
+# offset table:      num_frames + 1 uint64 file offsets, frame i is
+#                    [offsets[i], offsets[i + 1])
+# info json:         width, height, fps, quality, ... (until the end of the file)
+#
+# so a range of frames is one contiguous slice of the file.
+_video_proxy_magic = b'ISAVPRX1'
+_video_proxy_header_format = '<8sQQQ'
+_video_proxy_header_size = struct.calcsize(_video_proxy_header_format)
+
+def _get_video_proxy_opts(config: Union[dict, None]):
+    # The video_proxy value of isa-project.yaml, for example
+    #
+    # video_proxy:
+    #   max_width: 640
+    #   quality: 40
+    if config is None:
+        config = {}
+    return {
+        'max_width': int(config.get('max_width', 640)),
+        'quality': int(config.get('quality', 40))
+    }
+
+def _create_video_proxy(video_path: str, output_fname: str, *, opts: dict):
+    import cv2
+    tmp_fname = f'{output_fname}.tmp'
+    vid = cv2.VideoCapture(video_path)
+    try:
+        fps = vid.get(cv2.CAP_PROP_FPS)
+        offsets = [_video_proxy_header_size]
+        width = None
+        height = None
+        with open(tmp_fname, 'wb') as f:
+            f.write(b'\0' * _video_proxy_header_size)
+            while True:
+                ret, frame = vid.read()
+                if not ret:
+                    break
+                if width is None:
+                    width, height = _get_video_proxy_frame_size(frame.shape[1], frame.shape[0], max_width=opts['max_width'])
+                if frame.shape[1] != width or frame.shape[0] != height:
+                    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, opts['quality']])
+                if not ok:
+                    raise Exception(f'Unable to encode frame {len(offsets) - 1} of {video_path}')
+                f.write(buf.tobytes())
+                offsets.append(offsets[-1] + len(buf))
+                if (len(offsets) - 1) % 1000 == 0:
+                    print(f'Video proxy: {len(offsets) - 1} frames')
+            num_frames = len(offsets) - 1
+            offset_table_offset = offsets[-1]
+            f.write(np.array(offsets, dtype='<u8').tobytes())
+            info_offset = offset_table_offset + 8 * len(offsets)
+            f.write(json.dumps({
+                'width': width,
+                'height': height,
+                'fps': fps,
+                'num_frames': num_frames,
+                'quality': opts['quality']
+            }).encode('utf-8'))
+            f.seek(0)
+            f.write(struct.pack(_video_proxy_header_format, _video_proxy_magic, offset_table_offset, num_frames, info_offset))
+    finally:
+        vid.release()
+    os.replace(tmp_fname, output_fname)
+    print(f'Video proxy: {num_frames} frames of {width} x {height}, {os.path.getsize(output_fname) / 1e6:.1f} MB')
+
+def _get_video_proxy_frame_size(width: int, height: int, *, max_width: int):
+    if width <= max_width:
+        return width, height
+    # keep the dimensions even for the jpeg chroma subsampling
+    h = int(round(height * max_width / width / 2)) * 2
+    return max_width, max(h, 2)
+
+class _VideoProxyReader:
+    def __init__(self, fname: str):
+        with open(fname, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset_table_offset, num_frames, info_offset = struct.unpack_from(_video_proxy_header_format, self._mm, 0)
+        if magic != _video_proxy_magic:
+            raise Exception(f'Not a video proxy file: {fname}')
+        self.num_frames = num_frames
+        self.offsets = np.frombuffer(self._mm, dtype='<u8', count=num_frames + 1, offset=offset_table_offset)
+        self.info = json.loads(bytes(self._mm[info_offset:]).decode('utf-8'))
+    def get_frames(self, start_frame: int, end_frame: int):
+        # the concatenated jpeg frames (bytes, a single copy from the mapped
+        # file) and the offsets of the frames within it
+        start_frame = max(0, min(start_frame, self.num_frames))
+        end_frame = max(start_frame, min(end_frame, self.num_frames))
+        offsets = self.offsets[start_frame:end_frame + 1]
+        data = self._mm[int(offsets[0]):int(offsets[-1])]
+        return data, (offsets - offsets[0]).tolist(), start_frame, end_frame
+
+_video_proxy_readers = {}
+_video_proxy_readers_lock = threading.Lock()
+
+def _get_video_proxy_reader(fname: str):
+    # The readers are kept open, a rebuilt proxy (different mtime) gets a new one
+    key = (fname, os.stat(fname).st_mtime_ns)
+    with _video_proxy_readers_lock:
+        if key not in _video_proxy_readers:
+            for k in [k for k in _video_proxy_readers if k[0] == fname]:
+                del _video_proxy_readers[k]
+            _video_proxy_readers[key] = _VideoProxyReader(fname)
+        return _video_proxy_readers[key]
@@ -0,0 +1,72 @@
+from typing import Union, List
+import numpy as np
+from ._annotations_store import _lock_annotations, _load_annotations_state
+
+
+class _VocalizationIndex:
+    # Vocalizations sorted by start frame. The ones overlapping [f1, f2) have
+    # start < f2 and start > f1 - max_duration, so a window query is two
+    # binary searches and a filter on end > f1 of the candidates in between.
+    def __init__(self, vocalizations: List[dict]):
+        starts = np.array([v['startFrame'] for v in vocalizations], dtype=np.int64)
+        order = np.argsort(starts, kind='stable')
+        self.vocalizations = [vocalizations[i] for i in order]
+        self.starts = starts[order]
+        self.ends = np.array([v['endFrame'] for v in self.vocalizations], dtype=np.int64)
+        self.max_duration = int(np.max(self.ends - self.starts)) if len(self.vocalizations) > 0 else 0
+        labels = sorted(set(label for v in self.vocalizations for label in v.get('labels', [])))
+        self.label_masks = {
+            label: np.array([label in v.get('labels', []) for v in self.vocalizations], dtype=bool)
+            for label in labels
+        }
+    def get_indices(self, start_frame: int, end_frame: int, *, labels: Union[List[str], None]=None):
+        i1 = int(np.searchsorted(self.starts, start_frame - self.max_duration, side='left'))
+        i2 = int(np.searchsorted(self.starts, end_frame, side='left'))
+        indices = i1 + np.nonzero(self.ends[i1:i2] > start_frame)[0]
+        if labels is not None:
+            mask = np.zeros(len(indices), dtype=bool)
+            for label in labels:
+                if label in self.label_masks:
+                    mask |= self.label_masks[label][indices]
+            indices = indices[mask]
+        return indices
+    def get_label_counts(self, indices: np.ndarray):
+        counts = {label: int(np.count_nonzero(m[indices])) for label, m in self.label_masks.items()}
+        return {label: c for label, c in counts.items() if c > 0}
+
+def _get_vocalization_index(annotations_json_fname: str):
+    # built on demand and dropped whenever the annotations change
+    with _lock_annotations(annotations_json_fname):
+        state = _load_annotations_state(annotations_json_fname)
+        if state.index is None:
+            state.index = _VocalizationIndex(list(state.vocalizations.values()))
+        return state.index, state.version, state.other_fields.get('samplingFrequency', None)
+
+def _get_vocalizations_in_window(
+    annotations_json_fname: str, *,
+    start_frame: int,
+    end_frame: int,
+    labels: Union[List[str], None]=None,
+    offset: int=0,
+    limit: int=1000
+):
+    index, version, sampling_frequency = _get_vocalization_index(annotations_json_fname)
+    indices = index.get_indices(start_frame, end_frame, labels=labels)
+    page = indices[offset:offset + limit]
+    return {
+        'vocalizations': [index.vocalizations[i] for i in page],
+        'totalCount': len(indices),
+        'offset': offset,
+        'nextOffset': offset + len(page) if offset + len(page) < len(indices) else None,
+        'version': version,
+        'samplingFrequency': sampling_frequency
+    }
+
+def _get_vocalization_counts(annotations_json_fname: str, *, start_frame: int, end_frame: int):
+    index, version, _ = _get_vocalization_index(annotations_json_fname)
+    indices = index.get_indices(start_frame, end_frame)
+    return {
+        'totalCount': len(indices),
+        'labelCounts': index.get_label_counts(indices),
+        'version': version
+    }
@@ -1,16 +1,16 @@
-from typing import Union, List
-import yaml
-import pickle
-import json
+from typing import List, Union
 import numpy as np
-import pandas as pd
+import zarr
 from ._find_singular_file_in_dir import _find_singular_file_in_dir
+from ._annotations_store import _set_annotations
+from ._project_config import _get_session_config_file
+from ._profile import _profile_stage
+from ._spectrogram_stats import _load_spectrogram_stats, _get_band_histogram
 
 
 def auto_detect_vocalizations(session: str, output_json_fname: str):
     dirname = f'./{session}'
-    with open(f'{dirname}/isa-session.yaml', 'r') as f:
-        config = yaml.safe_load(f)
+    config = _get_session_config_file(session).to_dict()
     
     try:
         csv_fname = _find_singular_file_in_dir(dirname, ['.csv'])
@@ -21,72 +21,176 @@ def auto_detect_vocalizations(session: str, output_json_fname: str):
         print(f'Generating annotations.json from {csv_fname}')
         csv_path = f'{dirname}/{csv_fname}'
         annotations = _generate_annotations_from_csv(csv_path, sampling_frequency=config['audio_sr_hz'])
-        with open(output_json_fname, 'w') as f:
-            json.dump(annotations, f, indent=4)
+        _set_annotations(output_json_fname, annotations)
         return
 
-    auto_detect_freq_range = config['auto_detect_freq_range']
-    spectrogram_df = config['spectrogram_df']
-    freq_range=[int(auto_detect_freq_range[0] / spectrogram_df), int(auto_detect_freq_range[1] / spectrogram_df)]
+    freq_range = _get_detection_freq_range(config['auto_detect_freq_range'], spectrogram_df=config['spectrogram_df'])
 
-    spectrograms_fname = f'{dirname}/spectrograms.pkl'
-    print(f'Loading {spectrograms_fname}')
-    with open(spectrograms_fname, 'rb') as f:
-        a = pickle.load(f)
-    spectrogram_for_gui: np.ndarray = a['spectrogram_for_gui']
-    t: np.ndarray = a['times']
+    # the detection band of the spectrogram is read one zarr chunk at a time
+    spectrogram_for_gui_zarr_fname = f'{dirname}/spectrogram_for_gui.zarr'
+    print(f'Loading {spectrogram_for_gui_zarr_fname}')
+    root_group = zarr.open(spectrogram_for_gui_zarr_fname, mode='r')
+    t: np.ndarray = root_group['times'][0:2]
+    spectrogram: zarr.Array = root_group['spectrogram']
+    block_num_frames = spectrogram.chunks[0]
     sr_spectrogram = 1 / (t[1] - t[0])
 
     print(f'Spectrogram sampling rate (Hz): {sr_spectrogram}')
 
     print('Auto detecting vocalizations')
-    auto_vocalizations = _auto_detect_vocalizations(spectrogram_for_gui[:, freq_range[0]:freq_range[1]], sampling_frequency=sr_spectrogram)
+    stats = _load_spectrogram_stats(spectrogram_for_gui_zarr_fname)
+    if stats is not None:
+        # the histogram of the band comes from the statistics of the spectrogram
+        vocalization_detector = _StreamingVocalizationDetector()
+        vocalization_detector.set_histogram(_get_band_histogram(stats, freq_range))
+    else:
+        with _profile_stage('detection_histogram'):
+            vocalization_detector = _StreamingVocalizationDetector()
+            for i in range(0, spectrogram.shape[0], block_num_frames):
+                vocalization_detector.add_histogram_block(spectrogram[i:i + block_num_frames, freq_range[0]:freq_range[1]])
+    with _profile_stage('detection'):
+        auto_vocalizations = []
+        for i in range(0, spectrogram.shape[0], block_num_frames):
+            auto_vocalizations.extend(vocalization_detector.process_block(spectrogram[i:i + block_num_frames, freq_range[0]:freq_range[1]]))
 
     annotations = {
         'samplingFrequency': sr_spectrogram,
         'vocalizations': auto_vocalizations
     }
 
-    with open(output_json_fname, 'w') as f:
-        json.dump(annotations, f, indent=4)
+    with _profile_stage('write_annotations'):
+        _set_annotations(output_json_fname, annotations)
 
-def _auto_detect_vocalizations(spectrogram: np.array, *, sampling_frequency: float):
-    threshold_pct = 99.8
-    threshold = np.percentile(spectrogram, threshold_pct)
-    spectrogram = np.copy(spectrogram)
-    spectrogram[spectrogram < threshold] = 0
+def _get_detection_freq_range(auto_detect_freq_range: List[float], *, spectrogram_df: float):
+    return [int(auto_detect_freq_range[0] / spectrogram_df), int(auto_detect_freq_range[1] / spectrogram_df)]
 
-    vocalizations = []
-    max_gap = 20
-    min_size = 10
-    voc_ind = 0
-    a = np.max(spectrogram, axis=1)
-    vocalization_start_frame: Union[int, None] = None
-    vocalization_last_active_frame: Union[int, None] = None
-    for i in range(len(a)):
-        if a[i] > 0:
-            # non-zero value
-            if vocalization_start_frame is None:
-                # not in a potential vocalization
-                vocalization_start_frame = i
-            vocalization_last_active_frame = i
+def _auto_detect_vocalizations(
+    spectrogram: np.array, *,
+    sampling_frequency: float,
+    threshold_pct: float=99.8,
+    max_gap: int=20,
+    min_size: int=10
+):
+    threshold = _percentile(spectrogram, threshold_pct)
+    vocalization_detector = _StreamingVocalizationDetector(threshold=threshold, max_gap=max_gap, min_size=min_size)
+    return vocalization_detector.process_block(spectrogram)
+
+class _StreamingVocalizationDetector:
+    # Detects vocalizations in consecutive blocks of frames of the uint8
+    # spectrogram band, using bounded memory.
+    #
+    # Unless a threshold is given, the percentile threshold comes from a
+    # histogram of the band that is accumulated in a first pass with
+    # add_histogram_block. In the second pass, process_block returns the
+    # vocalizations that end within each block.
+    #
+    # A frame is active if it has a non-zero value that is not below the
+    # threshold. A vocalization is a run of active frames where consecutive
+    # active frames are less than max_gap apart. It ends once max_gap inactive
+    # frames follow the last active frame (so a run that is still open at the
+    # end of the recording is not reported) and is kept if it spans at least
+    # min_size frames.
+    def __init__(self, *, threshold: Union[float, None]=None, threshold_pct: float=99.8, max_gap: int=20, min_size: int=10):
+        self._threshold = threshold
+        self._threshold_pct = threshold_pct
+        self._max_gap = max(max_gap, 1)
+        self._min_size = min_size
+        self._counts = np.zeros((256,), dtype=np.int64)
+        self._num_frames = 0
+        self._start_frame: Union[int, None] = None
+        self._last_active_frame: Union[int, None] = None
+        self._voc_ind = 0
+    def add_histogram_block(self, spectrogram: np.ndarray):
+        if spectrogram.dtype != np.uint8:
+            raise Exception(f'Unexpected dtype for spectrogram: {spectrogram.dtype}')
+        self._counts += np.bincount(spectrogram.ravel(), minlength=256)
+    def set_histogram(self, counts: np.ndarray):
+        self._counts = np.array(counts, dtype=np.int64)
+    def get_threshold(self):
+        if self._threshold is None:
+            self._threshold = _percentile_from_histogram(self._counts, self._threshold_pct)
+        return self._threshold
+    def process_block(self, spectrogram: np.ndarray):
+        threshold = self.get_threshold()
+        a = np.max(spectrogram, axis=1) if spectrogram.shape[0] > 0 else np.zeros((0,))
+        active = (a >= threshold) & (a > 0)
+        return self.process_active_frames(active)
+    def process_active_frames(self, active: np.ndarray):
+        max_gap = self._max_gap
+        inds = np.flatnonzero(active) + self._num_frames
+        self._num_frames += len(active)
+        if self._last_active_frame is not None:
+            # continue the run that was open at the end of the previous block
+            inds = np.concatenate([[self._last_active_frame], inds])
+            first_start_frame = self._start_frame
+        elif len(inds) > 0:
+            first_start_frame = inds[0]
+        else:
+            return []
+        breaks = np.flatnonzero(np.diff(inds) > max_gap)
+        start_frames = inds[np.concatenate([[0], breaks + 1])]
+        start_frames[0] = first_start_frame
+        last_active_frames = inds[np.concatenate([breaks, [len(inds) - 1]])]
+        if last_active_frames[-1] + max_gap >= self._num_frames:
+            # the last run may continue in the next block
+            self._start_frame = int(start_frames[-1])
+            self._last_active_frame = int(last_active_frames[-1])
+            start_frames = start_frames[:-1]
+            last_active_frames = last_active_frames[:-1]
         else:
-            # zero value
-            if vocalization_last_active_frame is not None:
-                # in a potential vocalization
-                if i - vocalization_last_active_frame >= max_gap:
-                    # it's been long enough since we had a non-zero value
-                    if vocalization_last_active_frame - vocalization_start_frame >= min_size:
-                        # the vocalization was long enough
-                        vocalizations.append(
-                            {'vocalizationId': f'auto-{voc_ind}', 'startFrame': vocalization_start_frame, 'endFrame': vocalization_last_active_frame + 1, 'labels': ['auto']}
-                        )
-                        voc_ind = voc_ind + 1
-                    vocalization_start_frame = None
-                    vocalization_last_active_frame = None
-    return vocalizations
+            self._start_frame = None
+            self._last_active_frame = None
+        keep = last_active_frames - start_frames >= self._min_size
+        vocalizations = []
+        for i1, i2 in zip(start_frames[keep], last_active_frames[keep]):
+            vocalizations.append(
+                {'vocalizationId': f'auto-{self._voc_ind}', 'startFrame': int(i1), 'endFrame': int(i2) + 1, 'labels': ['auto']}
+            )
+            self._voc_ind = self._voc_ind + 1
+        return vocalizations
+
+def _percentile(x: np.ndarray, pct: float, *, block_num_rows: int=10000):
+    # Same result as np.percentile(x, pct) with the default linear method.
+    # For 8/16-bit integer data (the uint8 spectrogram_for_gui) the order
+    # statistics come from a histogram accumulated over blocks of rows, so
+    # the data is neither copied nor sorted.
+    if x.dtype not in [np.uint8, np.uint16, np.int8, np.int16]:
+        return np.percentile(x, pct)
+    info = np.iinfo(x.dtype)
+    counts = np.zeros((int(info.max) - int(info.min) + 1,), dtype=np.int64)
+    for i in range(0, x.shape[0], block_num_rows):
+        block = x[i:i + block_num_rows].ravel()
+        if info.min != 0:
+            block = block.astype(np.int64) - int(info.min)
+        counts += np.bincount(block, minlength=len(counts))
+    return _percentile_from_histogram(counts, pct, min_value=int(info.min))
+
+def _percentile_from_histogram(counts: np.ndarray, pct: float, *, min_value: int=0):
+    # counts[k] is the number of occurrences of the integer value min_value + k
+    n = int(np.sum(counts))
+    if n == 0:
+        return np.nan
+    q = np.true_divide(pct, 100)
+    # virtual index of the linear method
+    virtual_index = (n - 1) * q
+    if virtual_index >= n - 1:
+        previous_index = next_index = n - 1
+    elif virtual_index < 0:
+        previous_index = next_index = 0
+    else:
+        previous_index = int(np.floor(virtual_index))
+        next_index = previous_index + 1
+    gamma = virtual_index - np.floor(virtual_index)
+    cumulative_counts = np.cumsum(counts)
+    a = float(np.searchsorted(cumulative_counts, previous_index, side='right') + min_value)
+    b = float(np.searchsorted(cumulative_counts, next_index, side='right') + min_value)
+    # same interpolation as numpy
+    if gamma >= 0.5:
+        return b - (b - a) * (1 - gamma)
+    return a + (b - a) * gamma
 
 def _generate_annotations_from_csv(csv_fname: str, *, sampling_frequency: float):
+    import pandas as pd
     # read in the csv file
     x = pd.read_csv(csv_fname, header=None)
 
@@ -1,6 +1,4 @@
 import click
-import isa
-from .update import IsaUpdateOpts
 
 
 @click.group(help="Isa command-line client")
@@ -9,7 +7,8 @@ def cli():
 
 @click.command(help="One-time initialization of an isa project")
 def init():
-    isa.init()
+    from .init import init as isa_init
+    isa_init()
 
 @click.command(help="Add a session to an isa project")
 @click.argument('session_id', required=False, default='')
@@ -18,7 +17,8 @@ def add(session_id: str, all: bool):
     if not all:
         if not session_id:
             raise Exception('Either use the --all option or specify a session id')
-    isa.add(session_id, all=all)
+    from .add import add as isa_add
+    isa_add(session_id, all=all)
 
 @click.command(help="Update one or more sessions")
 @click.option('--session', required=False, default='', help="Session to process, if not using --all")
@@ -26,12 +26,24 @@ def add(session_id: str, all: bool):
 @click.option('--redo-spectrograms', is_flag=True, help="Recompute the spectrograms")
 @click.option('--no-vocalization-detection', is_flag=True, help="disable automatic vocalization detection")
 @click.option('--redo-vocalization-detection', is_flag=True, help="force recompute automatic vocalization detection")
+@click.option('--streaming', is_flag=True, help="Compute the spectrograms in blocks without loading the whole recording")
+@click.option('--no-video-proxy', is_flag=True, help="Do not create the downscaled video frames used by the viewer")
+@click.option('--no-similarity-index', is_flag=True, help="Do not compute the fingerprints used for finding similar vocalizations")
+@click.option('--profile', is_flag=True, help="Record the time, memory and I/O of each stage in isa-profile.jsonl of each session")
+@click.option('--profile-format', default='jsonl', type=click.Choice(['jsonl', 'chrome']), help="Format of the profile: JSON lines or a Chrome trace (isa-profile.trace.json)")
+@click.option('--jobs', default=1, help="Number of sessions to process in parallel when using --all")
 def update(
     session: str,
     all: bool,
     redo_spectrograms: bool,
     no_vocalization_detection: bool,
-    redo_vocalization_detection: bool
+    redo_vocalization_detection: bool,
+    streaming: bool,
+    no_video_proxy: bool,
+    no_similarity_index: bool,
+    profile: bool,
+    profile_format: str,
+    jobs: int
 ):
     if session and all:
         raise Exception('Cannot specify session with --all flag')
@@ -39,16 +51,104 @@ def update(
         raise Exception('Either use the --session or the --all option')
     if no_vocalization_detection and redo_vocalization_detection:
         raise Exception('You must cannot specify both --redo-vocalization-detection and --no-vocalization-detection')
-    isa.update(
+    if jobs > 1 and not all:
+        raise Exception('The --jobs option can only be used with --all')
+    from .update import update as isa_update, IsaUpdateOpts
+    isa_update(
         session=session,
         all=all,
         opts=IsaUpdateOpts(
             redo_spectrograms=redo_spectrograms,
             no_vocalization_detection=no_vocalization_detection,
-            redo_vocalization_detection=redo_vocalization_detection
-        )
+            redo_vocalization_detection=redo_vocalization_detection,
+            streaming_spectrograms=streaming,
+            no_video_proxy=no_video_proxy,
+            no_similarity_index=no_similarity_index,
+            profile=profile_format if profile else None
+        ),
+        jobs=jobs
+    )
+
+@click.command(help="Process the sessions of the project from a shared work queue (run on any number of machines)")
+@click.option('--lease-sec', default=300.0, help="A session claimed by a worker that has not sent a heartbeat for this long is processed again")
+@click.option('--max-attempts', default=3, help="Number of times a failed session is tried")
+@click.option('--poll-sec', default=10.0, help="How often to check for work while other workers are busy")
+@click.option('--reset', is_flag=True, help="Forget the status of all sessions and process them again")
+@click.option('--status', is_flag=True, help="Print the status of the queue and exit")
+@click.option('--no-vocalization-detection', is_flag=True, help="disable automatic vocalization detection")
+@click.option('--streaming', is_flag=True, help="Compute the spectrograms in blocks without loading the whole recording")
+@click.option('--no-video-proxy', is_flag=True, help="Do not create the downscaled video frames used by the viewer")
+@click.option('--no-similarity-index', is_flag=True, help="Do not compute the fingerprints used for finding similar vocalizations")
+def worker(
+    lease_sec: float,
+    max_attempts: int,
+    poll_sec: float,
+    reset: bool,
+    status: bool,
+    no_vocalization_detection: bool,
+    streaming: bool,
+    no_video_proxy: bool,
+    no_similarity_index: bool
+):
+    from .worker import worker as isa_worker, _print_queue_status
+    if status:
+        _print_queue_status(max_attempts=max_attempts)
+        return
+    from .update import IsaUpdateOpts
+    isa_worker(
+        opts=IsaUpdateOpts(
+            no_vocalization_detection=no_vocalization_detection,
+            streaming_spectrograms=streaming,
+            no_video_proxy=no_video_proxy,
+            no_similarity_index=no_similarity_index
+        ),
+        lease_sec=lease_sec,
+        max_attempts=max_attempts,
+        poll_sec=poll_sec,
+        reset=reset
+    )
+
+@click.command(help="Export the vocalizations of all sessions as fixed-size spectrogram patches for training")
+@click.argument('output_dir')
+@click.option('--patch-frames', default=64, help="Number of spectrogram frames of each patch (centered on the vocalization)")
+@click.option('--channels', is_flag=True, help="Export the spectrogram of each channel (float32) rather than the summed spectrogram (uint8)")
+@click.option('--freq-range', nargs=2, type=float, default=None, help="Only export the frequencies in this range (Hz)")
+@click.option('--audio', is_flag=True, help="Also export the raw audio of each patch")
+@click.option('--labels', default='', help="Comma-separated labels of the vocalizations to export (default: all vocalizations that have a label)")
+@click.option('--include-unlabeled', is_flag=True, help="Also export the vocalizations that have no label")
+@click.option('--shard-size', default=4096, help="Number of records per shard")
+@click.option('--jobs', default=1, help="Number of sessions to export in parallel")
+@click.option('--overwrite', is_flag=True, help="Replace an export with other options in the output directory")
+def export(
+    output_dir: str,
+    patch_frames: int,
+    channels: bool,
+    freq_range: tuple,
+    audio: bool,
+    labels: str,
+    include_unlabeled: bool,
+    shard_size: int,
+    jobs: int,
+    overwrite: bool
+):
+    from .export import export as isa_export, IsaExportOpts
+    isa_export(
+        output_dir,
+        opts=IsaExportOpts(
+            patch_num_frames=patch_frames,
+            spectrogram='channels' if channels else 'summed',
+            freq_range=list(freq_range) if freq_range else None,
+            audio=audio,
+            labels=labels.split(',') if labels else None,
+            include_unlabeled=include_unlabeled,
+            shard_num_records=shard_size
+        ),
+        jobs=jobs,
+        overwrite=overwrite
     )
 
 cli.add_command(init)
 cli.add_command(add)
-cli.add_command(update)
\ No newline at end of file
+cli.add_command(update)
+cli.add_command(worker)
+cli.add_command(export)
\ No newline at end of file
@@ -1,29 +1,36 @@
-from typing import List
+from typing import List, Union
 import os
-import yaml
-import h5py
 import shutil
 import numpy as np
 import zarr
-from scipy.io import wavfile
-from matplotlib.pyplot import specgram
-import pickle
+from ._stft import _stft_psd
+from ._audio_source import _AudioSource
+from ._profile import _profile_stage
 from .init import _find_singular_file_in_dir
-from ._project_config import _set_session_config_value
+from ._project_config import _get_session_config_file, _edit_session_config, _get_project_config_value
+from .auto_detect_vocalizations import _get_detection_freq_range
+from ._spectrogram_stats import _SpectrogramStatsAccumulator
+from ._spectrogram_pyramid import _get_spectrogram_pyramid_opts, _create_spectrogram_array, _build_spectrogram_pyramid, downsample_spectrogram_using_max
 
 
-def create_spectrograms(session: str):
+def create_spectrograms(
+    session: str, *,
+    streaming: bool=False,
+    block_num_frames: int=10000
+):
     dirname = f'./{session}'
-    with open(f'{dirname}/isa-session.yaml', 'r') as f:
-        config = yaml.safe_load(f)
+    config = _get_session_config_file(session).to_dict()
     print('USING CONFIG')
     print(config)
 
     spectrograms_pkl_fname = f'{dirname}/spectrograms.pkl'
+    spectrograms_zarr_fname = f'{dirname}/spectrograms.zarr'
     spectrogram_for_gui_zarr_fname = f'{dirname}/spectrogram_for_gui.zarr'
 
     duration_sec = config['audio_duration_sec']
     audio_sr_hz = config['audio_sr_hz']
+    nfft = config.get('spectrogram_nfft', 512)
+    noverlap = config.get('spectrogram_noverlap', 256)
 
     # freq_range=[130, 230]
 
@@ -39,104 +46,229 @@ def create_spectrograms(session: str):
     print(f'USING AUDIO: {audio_fname}')
     audio_path = f'{dirname}/{audio_fname}'
 
-    print('Extracting audio signals')
-    if audio_path.endswith('.h5'):
-        with h5py.File(audio_path, 'r') as f:
-            ch1 = np.array(f['ai_channels/ai0'])
-            ch2 = np.array(f['ai_channels/ai1'])
-            ch3 = np.array(f['ai_channels/ai2'])
-            ch4 = np.array(f['ai_channels/ai3'])
-            X = np.stack([ch1, ch2, ch3, ch4]).T
+    pyramid_opts = _get_spectrogram_pyramid_opts(_get_project_config_value('spectrogram_pyramid'))
+
+    if streaming:
+        _create_spectrograms_streaming(
+            session,
+            audio_path=audio_path,
+            num_samples=int(duration_sec * audio_sr_hz),
+            audio_sr_hz=audio_sr_hz,
+            nfft=nfft,
+            noverlap=noverlap,
+            block_num_frames=block_num_frames,
+            pyramid_opts=pyramid_opts,
+            auto_detect_freq_range=config.get('auto_detect_freq_range', None)
+        )
+        return
 
+    print('Extracting audio signals')
+    with _profile_stage('read_audio'):
+        with _AudioSource(audio_path) as audio_source:
             # crop to duration
-            X = X[0:int(duration_sec * audio_sr_hz)]
-    elif audio_path.endswith('.wav'):
-        sr, audio = wavfile.read(audio_path)
-        # n_samples = audio.shape[0]
-        # n_channels = audio.shape[1]
-        # crop to duration
-        X = audio[0:int(duration_sec * audio_sr_hz)]
-    else:
-        raise Exception(f'Unknown audio file type: {audio_path}')
+            X = audio_source.read(0, int(duration_sec * audio_sr_hz))
     
     num_channels = X.shape[1]
 
     print('Computing spectrograms')
-    spectrograms = []
-    for channel_ind in range(num_channels):
-        s, spectrogram_frequencies, spectrogram_times, im = specgram(X[:, channel_ind], NFFT=512, noverlap=256, Fs=audio_sr_hz)
-        sr_spectrogram = float(1 / (spectrogram_times[1] - spectrogram_times[0]))
-        spectrograms.append(s.T) # Use transpose so we have Nt x Nf
+    # Nchannels x Nt x Nf, and the sum over channels (Nt x Nf)
+    with _profile_stage('stft'):
+        spectrograms, spectrogram_for_gui, spectrogram_frequencies, spectrogram_times = _stft_psd(X, sr_hz=audio_sr_hz, nfft=nfft, noverlap=noverlap)
+    sr_spectrogram = float(1 / (spectrogram_times[1] - spectrogram_times[0]))
     print(f'Spectrogram sampling rate (Hz): {sr_spectrogram}')
-    _set_session_config_value(session, 'spectrogram_sr_hz', sr_spectrogram)
-    _set_session_config_value(session, 'spectrogram_num_frequencies', len(spectrogram_frequencies))
-    _set_session_config_value(session, 'spectrogram_df', float(spectrogram_frequencies[1] - spectrogram_frequencies[0]))
-    spectrogram_for_gui = sum(spectrograms)
+    with _edit_session_config(session) as session_config:
+        session_config.set('spectrogram_sr_hz', sr_spectrogram)
+        session_config.set('spectrogram_num_frequencies', len(spectrogram_frequencies))
+        session_config.set('spectrogram_df', float(spectrogram_frequencies[1] - spectrogram_frequencies[0]))
 
     print('Auto detecting maxval')
-    maxval = _auto_detect_spectrogram_maxval(spectrogram_for_gui, sr_spectrogram=sr_spectrogram)
-    minval = 0
-    print(f'Absolute spectrogram max: {np.max(spectrogram_for_gui)}')
-    print(f'Auto detected spectrogram max: {maxval}')
+    with _profile_stage('scaling'):
+        stats = _SpectrogramStatsAccumulator(num_frames=spectrogram_for_gui.shape[0], num_frequencies=spectrogram_for_gui.shape[1], sr_spectrogram=sr_spectrogram)
+        stats.add_block(spectrogram_for_gui, frame_start=0)
+        maxval = stats.get_maxval()
+        minval = 0
+        print(f'Absolute spectrogram max: {stats.get_absolute_maxval()}')
+        print(f'Auto detected spectrogram max: {maxval}')
 
-    print('Scaling spectogram data')
-    # Nf x Nt
-    spectrogram_for_gui: np.ndarray = np.floor((spectrogram_for_gui - minval) / (maxval - minval) * 255).astype(np.uint8)
+        print('Scaling spectogram data')
+        # Nf x Nt
+        spectrogram_for_gui: np.ndarray = np.floor((spectrogram_for_gui - minval) / (maxval - minval) * 255).astype(np.uint8)
+    with _profile_stage('spectrogram_stats'):
+        stats.add_scaled_block(spectrogram_for_gui, frame_start=0)
 
     # threshold = np.percentile(spectrogram_for_gui[freq_range[0]:freq_range[1]], threshold_pct)
     # print(f'Using threshold: {threshold} ({threshold_pct} pct)')
     # spectrogram_for_gui[spectrogram_for_gui <= threshold] = 0
 
-    if os.path.exists(spectrogram_for_gui_zarr_fname):
-        shutil.rmtree(spectrogram_for_gui_zarr_fname)
+    for fname in [spectrogram_for_gui_zarr_fname, spectrograms_zarr_fname]:
+        if os.path.exists(fname):
+            shutil.rmtree(fname)
     
+    # replaced by spectrograms.zarr
     if os.path.exists(spectrograms_pkl_fname):
         os.remove(spectrograms_pkl_fname)
 
-    print(f'Writing {spectrograms_pkl_fname}')
-    with open(spectrograms_pkl_fname, 'wb') as fb:
-        pickle.dump({
-            'spectrograms': spectrograms,
-            'frequencies': spectrogram_frequencies,
-            'times': spectrogram_times,
-            'spectrogram_for_gui': spectrogram_for_gui
-        }, fb)
+    print(f'Writing {spectrograms_zarr_fname}')
+    with _profile_stage('write_spectrograms_zarr'):
+        spectrograms_group = _create_spectrograms_zarr(
+            spectrograms_zarr_fname,
+            num_channels=num_channels,
+            frequencies=spectrogram_frequencies,
+            sr_spectrogram=sr_spectrogram,
+            times=spectrogram_times
+        )
+        spectrograms_group['spectrograms'][:] = spectrograms
     
     print(f'Writing {spectrogram_for_gui_zarr_fname}')
     root_group = zarr.open(spectrogram_for_gui_zarr_fname, mode="w")
-    root_group.create_dataset("spectrogram", data=spectrogram_for_gui, chunks=(10000, len(spectrogram_frequencies)))
-
-    ds_factor = 3
-    previous_spectrogram = spectrogram_for_gui
-    while ds_factor < len(spectrogram_times):
-        spectrogram_for_gui_downsampled = downsample_spectrogram_using_max(previous_spectrogram, ds_factor=3)
-        root_group.create_dataset(f"spectrogram_ds{ds_factor}", data=spectrogram_for_gui_downsampled, chunks=(10000, len(spectrogram_frequencies)))
-        previous_spectrogram = spectrogram_for_gui_downsampled
-        ds_factor *= 3
+    with _profile_stage('write_spectrogram_for_gui_zarr'):
+        _create_spectrogram_array(root_group, "spectrogram", shape=spectrogram_for_gui.shape, pyramid_opts=pyramid_opts, data=spectrogram_for_gui)
+    _build_spectrogram_pyramid(root_group, pyramid_opts=pyramid_opts, band_freq_range=_get_band_freq_range(pyramid_opts, config.get('auto_detect_freq_range', None), spectrogram_frequencies=spectrogram_frequencies))
 
     root_group.attrs['spectrogram_sr_hz'] = sr_spectrogram
     root_group.create_dataset("frequencies", data=spectrogram_frequencies)
     root_group.create_dataset("times", data=spectrogram_times)
+    stats.write(root_group, maxval=maxval, minval=minval)
+
+def _create_spectrograms_streaming(
+    session: str, *,
+    audio_path: str,
+    num_samples: int,
+    audio_sr_hz: float,
+    nfft: int,
+    noverlap: int,
+    block_num_frames: int,
+    pyramid_opts: dict,
+    auto_detect_freq_range: Union[List[float], None]
+):
+    # Reads the audio in overlapping blocks of whole STFT frames so that peak
+    # memory is bounded by block_num_frames rather than the recording length.
+    # The first pass only collects the maxima needed for scaling, the second
+    # pass recomputes the frames and writes them straight into the zarr arrays.
+    # The statistics (see _spectrogram_stats) are accumulated along the way.
+    dirname = f'./{session}'
+    spectrograms_pkl_fname = f'{dirname}/spectrograms.pkl'
+    spectrograms_zarr_fname = f'{dirname}/spectrograms.zarr'
+    spectrogram_for_gui_zarr_fname = f'{dirname}/spectrogram_for_gui.zarr'
+
+    step = nfft - noverlap
+
+    with _AudioSource(audio_path) as audio_source:
+        # crop to duration
+        num_samples = min(num_samples, audio_source.num_samples)
+        if num_samples < nfft + step:
+            raise Exception(f'Audio is too short for streaming spectrograms: {audio_path}')
+        num_frames = 1 + (num_samples - nfft) // step
+
+        def iterate_blocks():
+            # blocks of block_num_frames whole frames, overlapping by nfft - step samples
+            audio_blocks = audio_source.iterate_blocks(
+                block_num_samples=(block_num_frames - 1) * step + nfft,
+                overlap=nfft - step,
+                end=(num_frames - 1) * step + nfft
+            )
+            while True:
+                with _profile_stage('read_audio'):
+                    audio_block = next(audio_blocks, None)
+                if audio_block is None:
+                    break
+                i1, X = audio_block
+                frame_start = i1 // step
+                frame_end = min(frame_start + block_num_frames, num_frames)
+                with _profile_stage('stft'):
+                    spectrograms, spectrogram_for_gui, spectrogram_frequencies, _ = _stft_psd(X, sr_hz=audio_sr_hz, nfft=nfft, noverlap=noverlap)
+                spectrogram_times = np.arange(nfft / 2 + frame_start * step, nfft / 2 + frame_end * step, step) / audio_sr_hz
+                yield frame_start, frame_end, spectrograms, spectrogram_for_gui, spectrogram_frequencies, spectrogram_times
+
+        print('Computing spectrograms (pass 1 of 2)')
+        sr_spectrogram = None
+        stats = None
+        with _profile_stage('streaming_pass_1'):
+            for frame_start, frame_end, spectrograms, spectrogram_for_gui, spectrogram_frequencies, spectrogram_times in iterate_blocks():
+                num_channels = spectrograms.shape[0]
+                if sr_spectrogram is None:
+                    sr_spectrogram = float(1 / (spectrogram_times[1] - spectrogram_times[0]))
+                    stats = _SpectrogramStatsAccumulator(num_frames=num_frames, num_frequencies=spectrogram_for_gui.shape[1], sr_spectrogram=sr_spectrogram)
+                stats.add_block(spectrogram_for_gui, frame_start=frame_start)
+        num_frequencies = len(spectrogram_frequencies)
+        print(f'Spectrogram sampling rate (Hz): {sr_spectrogram}')
+        with _edit_session_config(session) as session_config:
+            session_config.set('spectrogram_sr_hz', sr_spectrogram)
+            session_config.set('spectrogram_num_frequencies', num_frequencies)
+            session_config.set('spectrogram_df', float(spectrogram_frequencies[1] - spectrogram_frequencies[0]))
+
+        print('Auto detecting maxval')
+        maxval = stats.get_maxval()
+        minval = 0
+        print(f'Absolute spectrogram max: {stats.get_absolute_maxval()}')
+        print(f'Auto detected spectrogram max: {maxval}')
+
+        for fname in [spectrogram_for_gui_zarr_fname, spectrograms_zarr_fname]:
+            if os.path.exists(fname):
+                shutil.rmtree(fname)
+
+        # replaced by spectrograms.zarr
+        if os.path.exists(spectrograms_pkl_fname):
+            os.remove(spectrograms_pkl_fname)
+
+        print(f'Writing {spectrograms_zarr_fname} and {spectrogram_for_gui_zarr_fname} (pass 2 of 2)')
+        spectrograms_group = _create_spectrograms_zarr(
+            spectrograms_zarr_fname,
+            num_channels=num_channels,
+            frequencies=spectrogram_frequencies,
+            sr_spectrogram=sr_spectrogram,
+            num_frames=num_frames
+        )
+        root_group = zarr.open(spectrogram_for_gui_zarr_fname, mode="w")
+        spectrogram_array = _create_spectrogram_array(root_group, "spectrogram", shape=(num_frames, num_frequencies), pyramid_opts=pyramid_opts)
+        times_array = root_group.create_dataset("times", shape=(num_frames,), dtype=np.float64)
+        with _profile_stage('streaming_pass_2'):
+            for frame_start, frame_end, spectrograms, spectrogram_for_gui, spectrogram_frequencies, spectrogram_times in iterate_blocks():
+                with _profile_stage('scaling'):
+                    spectrogram_for_gui = np.floor((spectrogram_for_gui - minval) / (maxval - minval) * 255).astype(np.uint8)
+                with _profile_stage('write_zarr'):
+                    spectrograms_group['spectrograms'][:, frame_start:frame_end] = spectrograms
+                    spectrograms_group['times'][frame_start:frame_end] = spectrogram_times
+                    spectrogram_array[frame_start:frame_end] = spectrogram_for_gui
+                    times_array[frame_start:frame_end] = spectrogram_times
+                with _profile_stage('spectrogram_stats'):
+                    stats.add_scaled_block(spectrogram_for_gui, frame_start=frame_start)
+
+    _build_spectrogram_pyramid(root_group, pyramid_opts=pyramid_opts, band_freq_range=_get_band_freq_range(pyramid_opts, auto_detect_freq_range, spectrogram_frequencies=spectrogram_frequencies))
+    root_group.attrs['spectrogram_sr_hz'] = sr_spectrogram
+    root_group.create_dataset("frequencies", data=spectrogram_frequencies)
+    stats.write(root_group, maxval=maxval, minval=minval)
+
+def _get_band_freq_range(pyramid_opts: dict, auto_detect_freq_range: Union[List[float], None], *, spectrogram_frequencies: np.ndarray):
+    # the frequency bins of the band levels of the pyramid, if any
+    if not pyramid_opts['band'] or auto_detect_freq_range is None:
+        return None
+    return _get_detection_freq_range(auto_detect_freq_range, spectrogram_df=float(spectrogram_frequencies[1] - spectrogram_frequencies[0]))
+
+def _create_spectrograms_zarr(
+    spectrograms_zarr_fname: str, *,
+    num_channels: int,
+    frequencies: np.ndarray,
+    sr_spectrogram: float,
+    times: Union[np.ndarray, None]=None,
+    num_frames: Union[int, None]=None
+):
+    # Per-channel float spectrograms (Nchannels x Nt x Nf), chunked so that
+    # readers only decompress the channels and time ranges they use
+    if times is not None:
+        num_frames = len(times)
+    num_frequencies = len(frequencies)
+    group = zarr.open(spectrograms_zarr_fname, mode="w")
+    group.create_dataset("spectrograms", shape=(num_channels, num_frames, num_frequencies), dtype=np.float64, chunks=(1, 10000, num_frequencies))
+    group.create_dataset("frequencies", data=frequencies)
+    if times is not None:
+        group.create_dataset("times", data=times)
+    else:
+        group.create_dataset("times", shape=(num_frames,), dtype=np.float64)
+    group.attrs['spectrogram_sr_hz'] = sr_spectrogram
+    return group
 
 def _auto_detect_spectrogram_maxval(spectrogram: np.array, *, sr_spectrogram: float):
-    Nt = spectrogram.shape[0]
-    Nf = spectrogram.shape[1]
-    chunk_num_samples = int(15 * sr_spectrogram)
-    chunk_maxvals: List[float] = []
-    i = 0
-    while i + chunk_num_samples < Nt:
-        chunk = spectrogram[i:i + chunk_num_samples]
-        chunk_maxvals.append(np.max(chunk))
-        i += chunk_num_samples
-    v = np.median(chunk_maxvals)
-    return v
-
-def downsample_spectrogram_using_max(spectrogram: np.ndarray, *, ds_factor: int):
-    Nt = spectrogram.shape[0]
-    Nf = spectrogram.shape[1]
-    Nt_ds = Nt // ds_factor
-    spectrogram_ds = np.zeros((Nt_ds, Nf), dtype=spectrogram.dtype)
-    spectrogram = spectrogram[:Nt_ds * ds_factor, :]
-    spectrogram_reshaped = spectrogram.reshape((Nt_ds, ds_factor, Nf))
-    spectrogram_ds = np.max(spectrogram_reshaped, axis=1)
-    return spectrogram_ds
+    stats = _SpectrogramStatsAccumulator(num_frames=spectrogram.shape[0], num_frequencies=spectrogram.shape[1], sr_spectrogram=sr_spectrogram)
+    stats.add_block(spectrogram, frame_start=0)
+    return stats.get_maxval()
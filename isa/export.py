@@ -0,0 +1,319 @@
+from typing import Union, List
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import traceback
+from dataclasses import dataclass, asdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import zarr
+from ._project_config import _get_project_config_value, _get_session_config_file
+from ._annotations_store import _get_annotations
+from .auto_detect_vocalizations import _get_detection_freq_range
+
+
+# Training data for vocalization classifiers. Every selected vocalization of
+# every session becomes one fixed-size record: a spectrogram patch of
+# patch_num_frames frames centered on the vocalization (the summed uint8
+# spectrogram_for_gui, or the float32 spectrogram of each channel), and
+# optionally the raw audio of the same time window. The records are written
+# to shards of shard_num_records records that can be memory-mapped with
+#
+# fields = json.load(open('export.json'))['layout']['fields']
+# dtype = np.dtype([(f['name'], f['dtype'], tuple(f['shape'])) for f in fields])
+# records = np.memmap('shards/<session>-00000.bin', dtype=dtype, mode='r')
+#
+# and index.jsonl has the session, vocalization and labels of each record.
+#
+# Each shard is written under a temporary name and renamed when complete,
+# so an interrupted export continues from the first missing shard. A
+# session is exported again from scratch if its vocalizations or its
+# spectrograms have changed since.
+_export_version = 1
+
+@dataclass
+class IsaExportOpts:
+    patch_num_frames: int=64
+    spectrogram: str='summed' # or 'channels'
+    freq_range: Union[List[float], None]=None # Hz, all frequencies by default
+    audio: bool=False
+    labels: Union[List[str], None]=None # by default all the vocalizations that have a label
+    include_unlabeled: bool=False
+    shard_num_records: int=4096
+
+def export(
+    output_dir: str, *,
+    opts: IsaExportOpts=IsaExportOpts(),
+    jobs: int=1,
+    overwrite: bool=False
+):
+    if opts.spectrogram not in ['summed', 'channels']:
+        raise Exception(f'Unexpected spectrogram type: {opts.spectrogram}')
+    if opts.patch_num_frames < 1 or opts.shard_num_records < 1:
+        raise Exception('patch_num_frames and shard_num_records must be positive')
+    if jobs < 1:
+        raise Exception(f'Invalid number of jobs: {jobs}')
+    session_names = _get_project_config_value('sessions') or []
+    if len(session_names) == 0:
+        raise Exception('No sessions in the project')
+
+    # all the records must have the same layout
+    layout = None
+    for session in session_names:
+        session_layout = _get_session_export_layout(session, opts=opts)
+        if layout is None:
+            layout = session_layout
+        elif session_layout != layout:
+            raise Exception(f'The data of session {session} does not have the same layout as session {session_names[0]}: {session_layout} != {layout}')
+
+    export_json_fname = f'{output_dir}/export.json'
+    params = {'version': _export_version, 'opts': asdict(opts), 'layout': layout}
+    if os.path.exists(export_json_fname):
+        with open(export_json_fname, 'r') as f:
+            previous = json.load(f)
+        if {k: previous.get(k, None) for k in params.keys()} != params:
+            if not overwrite:
+                raise Exception(f'{output_dir} contains an export with other options, use --overwrite to replace it')
+            print(f'Removing the previous export in {output_dir}')
+            for name in ['sessions', 'shards']:
+                shutil.rmtree(f'{output_dir}/{name}', ignore_errors=True)
+            for name in ['export.json', 'index.jsonl', 'labels.json']:
+                if os.path.exists(f'{output_dir}/{name}'):
+                    os.remove(f'{output_dir}/{name}')
+    os.makedirs(f'{output_dir}/sessions', exist_ok=True)
+    os.makedirs(f'{output_dir}/shards', exist_ok=True)
+    _write_json(export_json_fname, {**params, 'complete': False})
+
+    print(f'Exporting {len(session_names)} sessions to {output_dir} using {jobs} jobs')
+    results = []
+    if jobs == 1:
+        for session in session_names:
+            results.append(_export_session_with_result(session, output_dir=output_dir, opts=opts, layout=layout))
+            _print_session_result(results[-1], num_done=len(results), num_sessions=len(session_names))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_export_session_with_result, session, output_dir=output_dir, opts=opts, layout=layout) for session in session_names]
+            for future in as_completed(futures):
+                results.append(future.result())
+                _print_session_result(results[-1], num_done=len(results), num_sessions=len(session_names))
+    failed = [r for r in results if not r['success']]
+    if len(failed) > 0:
+        for r in failed:
+            print(f'FAILED: {r["session"]}: {r["error"]}')
+        raise Exception(f'Failed to export {len(failed)} sessions (run the export again to continue)')
+
+    shards = _write_export_index(output_dir, session_names=session_names)
+    _write_json(export_json_fname, {**params, 'complete': True, 'num_records': sum([s['num_records'] for s in shards]), 'shards': shards})
+    print(f'Exported {sum([s["num_records"] for s in shards])} records in {len(shards)} shards')
+
+def _print_session_result(r: dict, *, num_done: int, num_sessions: int):
+    if r['success']:
+        status = f'{r["num_records"]} records' + (' (already exported)' if r['skipped'] else '')
+    else:
+        status = 'FAILED'
+    print(f'[{num_done}/{num_sessions}] {r["session"]}: {status} ({r["elapsed_sec"]:.1f} sec)')
+
+def _get_session_export_layout(session: str, *, opts: IsaExportOpts):
+    config = _get_session_config_file(session).to_dict()
+    num_frequencies = zarr.open(f'./{session}/spectrogram_for_gui.zarr', mode='r')['spectrogram'].shape[1]
+    if opts.freq_range is not None:
+        j1, j2 = _get_detection_freq_range(opts.freq_range, spectrogram_df=config['spectrogram_df'])
+        j1, j2 = max(0, j1), min(num_frequencies, j2)
+    else:
+        j1, j2 = 0, num_frequencies
+    num_channels = zarr.open(f'./{session}/spectrograms.zarr', mode='r')['spectrograms'].shape[0]
+    if opts.spectrogram == 'summed':
+        fields = [{'name': 'spectrogram', 'dtype': '|u1', 'shape': [opts.patch_num_frames, j2 - j1]}]
+    else:
+        fields = [{'name': 'spectrogram', 'dtype': '<f4', 'shape': [num_channels, opts.patch_num_frames, j2 - j1]}]
+    if opts.audio:
+        num_samples = int(round(opts.patch_num_frames * config['audio_sr_hz'] / config['spectrogram_sr_hz']))
+        fields.append({'name': 'audio', 'dtype': '<f4', 'shape': [num_channels, num_samples]})
+    return {
+        'fields': fields,
+        'record_num_bytes': int(np.dtype([(f['name'], f['dtype'], tuple(f['shape'])) for f in fields]).itemsize),
+        'frequency_range': [j1, j2],
+        'spectrogram_sr_hz': config['spectrogram_sr_hz'],
+        'audio_sr_hz': config['audio_sr_hz']
+    }
+
+def _export_session_with_result(session: str, *, output_dir: str, opts: IsaExportOpts, layout: dict):
+    # runs in a worker process when exporting in parallel
+    timer = time.time()
+    error = None
+    r = {'num_records': 0, 'skipped': False}
+    try:
+        r = _export_session(session, output_dir=output_dir, opts=opts, layout=layout)
+    except Exception as e:
+        traceback.print_exc()
+        error = f'{type(e).__name__}: {e}'
+    return {
+        'session': session,
+        'success': error is None,
+        'error': error,
+        'elapsed_sec': time.time() - timer,
+        **r
+    }
+
+def _select_vocalizations(session: str, *, opts: IsaExportOpts):
+    annotations = _get_annotations(f'./{session}/annotations.json')
+    vocalizations = []
+    for v in annotations['vocalizations']:
+        labels = v.get('labels', [])
+        if opts.labels is not None:
+            selected = any([label in opts.labels for label in labels]) or (opts.include_unlabeled and len(labels) == 0)
+        else:
+            selected = len(labels) > 0 or opts.include_unlabeled
+        if selected:
+            vocalizations.append(v)
+    return sorted(vocalizations, key=lambda v: (v['startFrame'], v['vocalizationId']))
+
+def _export_session(session: str, *, output_dir: str, opts: IsaExportOpts, layout: dict):
+    vocalizations = _select_vocalizations(session, opts=opts)
+    spectrogram_for_gui_zarr_fname = f'./{session}/spectrogram_for_gui.zarr'
+    # what the records of the session are made from
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([[v['vocalizationId'], v['startFrame'], v['endFrame'], v.get('labels', [])] for v in vocalizations]).encode('utf-8'))
+    h.update(str(os.stat(f'{spectrogram_for_gui_zarr_fname}/spectrogram/.zarray').st_mtime_ns).encode('utf-8'))
+    key = h.hexdigest()
+
+    status_fname = f'{output_dir}/sessions/{session}.json'
+    status = _read_json(status_fname)
+    if status is not None and status['key'] == key and status['state'] == 'done':
+        return {'num_records': status['num_records'], 'skipped': True}
+    if status is None or status['key'] != key:
+        # start over
+        for fname in os.listdir(f'{output_dir}/shards'):
+            if re.match(rf'^{re.escape(session)}-\d{{5}}\.', fname):
+                os.remove(f'{output_dir}/shards/{fname}')
+    _write_json(status_fname, {'state': 'in_progress', 'key': key})
+
+    num_records = len(vocalizations)
+    num_shards = (num_records + opts.shard_num_records - 1) // opts.shard_num_records
+    dtype = np.dtype([(f['name'], f['dtype'], tuple(f['shape'])) for f in layout['fields']])
+    j1, j2 = layout['frequency_range']
+    T = opts.patch_num_frames
+    if opts.spectrogram == 'summed':
+        spectrogram_reader = _ChunkedTimeReader(zarr.open(spectrogram_for_gui_zarr_fname, mode='r')['spectrogram'], j1=j1, j2=j2)
+    else:
+        spectrogram_reader = _ChunkedTimeReader(zarr.open(f'./{session}/spectrograms.zarr', mode='r')['spectrograms'], j1=j1, j2=j2)
+    audio_file = None
+    if opts.audio:
+        from ._audio_clips import _get_audio_file
+        from ._find_singular_file_in_dir import _find_singular_file_in_dir
+        audio_file = _get_audio_file(f'./{session}/{_find_singular_file_in_dir(f"./{session}", [".h5", ".wav"])}')
+    shards = []
+    for shard_index in range(num_shards):
+        shard_name = f'{session}-{shard_index:05d}'
+        shard_fname = f'{output_dir}/shards/{shard_name}.bin'
+        shard_index_fname = f'{output_dir}/shards/{shard_name}.index.json'
+        shard_vocalizations = vocalizations[shard_index * opts.shard_num_records:(shard_index + 1) * opts.shard_num_records]
+        shards.append({'name': shard_name, 'num_records': len(shard_vocalizations)})
+        if os.path.exists(shard_fname) and os.path.exists(shard_index_fname):
+            # written before the export was interrupted
+            continue
+        index = []
+        record = np.zeros((1,), dtype=dtype)
+        with open(f'{shard_fname}.tmp', 'wb') as f:
+            for v in shard_vocalizations:
+                patch_start_frame = (v['startFrame'] + v['endFrame']) // 2 - T // 2
+                x = spectrogram_reader.read(patch_start_frame, patch_start_frame + T)
+                record['spectrogram'][0] = x
+                if audio_file is not None:
+                    num_samples = layout['fields'][1]['shape'][1]
+                    i1 = int(round(patch_start_frame * audio_file.sr_hz / layout['spectrogram_sr_hz']))
+                    record['audio'][0] = _read_audio_padded(audio_file, i1, i1 + num_samples).T
+                f.write(record.tobytes())
+                index.append({
+                    'vocalizationId': v['vocalizationId'],
+                    'labels': v.get('labels', []),
+                    'startFrame': v['startFrame'],
+                    'endFrame': v['endFrame'],
+                    'patchStartFrame': patch_start_frame
+                })
+        _write_json(shard_index_fname, index)
+        os.replace(f'{shard_fname}.tmp', shard_fname)
+    _write_json(status_fname, {'state': 'done', 'key': key, 'num_records': num_records, 'shards': shards})
+    return {'num_records': num_records, 'skipped': False}
+
+class _ChunkedTimeReader:
+    # Reads windows of frames of a (Nt x Nf) or (Nchannels x Nt x Nf) zarr
+    # array, cropped to the frequencies [j1, j2) and zero-padded outside the
+    # recording. The windows are requested in increasing order, so the last
+    # chunks that were decompressed are kept.
+    def __init__(self, array: zarr.Array, *, j1: int, j2: int):
+        self.array = array
+        self.j1 = j1
+        self.j2 = j2
+        self.time_axis = array.ndim - 2
+        self.num_frames = array.shape[self.time_axis]
+        self.chunk_num_frames = array.chunks[self.time_axis]
+        self.chunks = {}
+    def _get_chunk(self, chunk_index: int):
+        if chunk_index not in self.chunks:
+            if len(self.chunks) >= 2:
+                del self.chunks[min(self.chunks.keys())]
+            i1 = chunk_index * self.chunk_num_frames
+            i2 = i1 + self.chunk_num_frames
+            if self.time_axis == 0:
+                self.chunks[chunk_index] = self.array[i1:i2, self.j1:self.j2]
+            else:
+                self.chunks[chunk_index] = self.array[:, i1:i2, self.j1:self.j2]
+        return self.chunks[chunk_index]
+    def read(self, i1: int, i2: int):
+        shape = list(self.array.shape)
+        shape[self.time_axis] = i2 - i1
+        shape[-1] = self.j2 - self.j1
+        x = np.zeros(shape, dtype=self.array.dtype)
+        k1, k2 = max(i1, 0), min(i2, self.num_frames)
+        for chunk_index in range(k1 // self.chunk_num_frames, (k2 - 1) // self.chunk_num_frames + 1) if k2 > k1 else []:
+            offset = chunk_index * self.chunk_num_frames
+            a1, a2 = max(k1, offset), min(k2, offset + self.chunk_num_frames)
+            chunk = self._get_chunk(chunk_index)
+            if self.time_axis == 0:
+                x[a1 - i1:a2 - i1] = chunk[a1 - offset:a2 - offset]
+            else:
+                x[:, a1 - i1:a2 - i1] = chunk[:, a1 - offset:a2 - offset]
+        return x
+
+def _read_audio_padded(audio_file, i1: int, i2: int):
+    X = np.zeros((i2 - i1, audio_file.num_channels), dtype=np.float32)
+    k1, k2 = max(i1, 0), min(i2, audio_file.num_samples)
+    if k2 > k1:
+        X[k1 - i1:k2 - i1] = audio_file.read(k1, k2, list(range(audio_file.num_channels)))
+    return X
+
+def _write_export_index(output_dir: str, *, session_names: List[str]):
+    # index.jsonl with one line per record, in the order of the shards, and
+    # the number of records per label in labels.json
+    shards = []
+    label_counts = {}
+    with open(f'{output_dir}/index.jsonl.tmp', 'w') as f:
+        for session in session_names:
+            status = _read_json(f'{output_dir}/sessions/{session}.json')
+            for shard in status['shards']:
+                with open(f'{output_dir}/shards/{shard["name"]}.index.json', 'r') as g:
+                    index = json.load(g)
+                for i, e in enumerate(index):
+                    f.write(json.dumps({'shard': shard['name'], 'record': i, 'session': session, **e}) + '\n')
+                    for label in e['labels']:
+                        label_counts[label] = label_counts.get(label, 0) + 1
+                shards.append(shard)
+    os.replace(f'{output_dir}/index.jsonl.tmp', f'{output_dir}/index.jsonl')
+    _write_json(f'{output_dir}/labels.json', label_counts)
+    return shards
+
+def _read_json(fname: str) -> Union[dict, list, None]:
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+def _write_json(fname: str, x: Union[dict, list]):
+    tmp_fname = f'{fname}.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(x, f, indent=4)
+    os.replace(tmp_fname, fname)
@@ -1,13 +1,10 @@
 import os
-import h5py
 import yaml
-import json
-import cv2
-from scipy.io import wavfile
 from typing import List
-import numpy as np
 from ._find_singular_file_in_dir import _find_singular_file_in_dir
-from ._project_config import _get_project_config_value, _set_project_config_value
+from ._probe import _probe_audio, _probe_video
+from ._profile import _profile_stage
+from ._project_config import _get_project_config_value, _set_project_config_value, _get_session_config_file
 
 
 def init():
@@ -36,12 +33,8 @@ def init():
 
 def _initialize_or_update_session_dir(session: str):
     dirname = f'./{session}'
-    config_yaml_fname = f'{dirname}/isa-session.yaml'
-    if os.path.exists(config_yaml_fname):
-        with open(config_yaml_fname, 'r') as f:
-            config = yaml.safe_load(f)
-    else:
-        config = {}
+    session_config = _get_session_config_file(session)
+    config = session_config.to_dict()
     
     ##########################################
     # AUDIO
@@ -52,20 +45,11 @@ def _initialize_or_update_session_dir(session: str):
     config['audio_fname'] = audio_fname
     audio_path = f'{dirname}/{audio_fname}'
 
-    if audio_path.endswith('.h5'):
-        audio_sr_hz = _get_audio_sr_from_h5(audio_path)
-        
-        # get first channel in order to compute duration
-        with h5py.File(audio_path, 'r') as f:
-            ch1 = np.array(f['ai_channels/ai0'])
-        audio_duration_sec = len(ch1) / audio_sr_hz
-    elif audio_path.endswith('.wav'):
-        audio_sr_hz, audio = wavfile.read(audio_path)
-        n_samples = audio.shape[0]
-        # n_channels = audio.shape[1]
-        audio_duration_sec = n_samples / audio_sr_hz
-    else:
-        raise Exception('Unexpected')
+    # only the headers are read, not the sample data
+    with _profile_stage('probe_audio'):
+        audio_info = _probe_audio(audio_path)
+    audio_sr_hz = audio_info['sr_hz']
+    audio_duration_sec = audio_info['num_samples'] / audio_sr_hz
 
     print(f'Audio sampling rate (Hz): {audio_sr_hz}')
     print(f'Audio duration (sec): {audio_duration_sec}')
@@ -83,11 +67,12 @@ def _initialize_or_update_session_dir(session: str):
     config['video_fname'] = video_fname
     video_path = f'{dirname}/{video_fname}'
 
-    vid = cv2.VideoCapture(video_path)
-    width = int(vid.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = vid.get(cv2.CAP_PROP_FPS)
-    num_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+    with _profile_stage('probe_video'):
+        video_info = _probe_video(video_path)
+    width = video_info['width']
+    height = video_info['height']
+    fps = video_info['fps']
+    num_frames = video_info['num_frames']
     video_duration_sec = num_frames / fps
 
     print(f'Video width: {width}')
@@ -100,9 +85,9 @@ def _initialize_or_update_session_dir(session: str):
     config['video_num_frames'] = num_frames
 
     ##########################################
-    print(f'Writing {config_yaml_fname}')
-    with open(config_yaml_fname, 'w') as f:
-        yaml.dump(config, f)
+    print(f'Writing {session_config.fname}')
+    session_config.update(config)
+    session_config.save()
     
     view_yaml_fname = f'{dirname}/view.yaml'
     print(f'Writing {view_yaml_fname}')
@@ -112,9 +97,3 @@ def _initialize_or_update_session_dir(session: str):
             'v': 'https://scratchrealm.github.io/isa',
             'label': session
         }, f)
-
-def _get_audio_sr_from_h5(h5_file: str):
-    with h5py.File(h5_file, 'r') as f:
-        d = json.loads(f['config'][()].decode('utf-8'))
-        audio_sr_hz = d['microphone_sample_rate']
-    return audio_sr_hz
@@ -1,45 +1,81 @@
 import os
-from typing import Union
+import time
+import traceback
+from typing import Union, List
 from dataclasses import dataclass
-import yaml
-import pandas as pd
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from .create_spectrograms import create_spectrograms
 from .auto_detect_vocalizations import auto_detect_vocalizations
-from ._project_config import _get_project_config_value
+from ._spectrogram_stats import _has_spectrogram_stats, _create_spectrogram_stats_from_zarr
+from ._project_config import _get_project_config_value, _get_session_config_file
 from .init import _initialize_or_update_session_dir
+from ._migrate_spectrograms_pkl import _migrate_spectrograms_pkl
+from ._annotations_store import _compact_annotations
+from ._profile import _profile_stage, _start_profiling, _stop_profiling, _get_profile_output_fname, _print_profile_summary
+from ._video_proxy import _get_video_proxy_opts, _create_video_proxy
+from ._similarity_index import _get_similarity_index_opts, _get_fingerprint_params, _get_session_fingerprints_fname, _update_session_fingerprints
+from ._find_singular_file_in_dir import _find_singular_file_in_dir
+from ._session_manifest import _artifact_versions, _load_session_manifest, _save_session_manifest, _get_file_fingerprint, _get_session_input_fingerprint, _is_stage_up_to_date, _has_stage, _set_stage, _get_stage_outputs
 
 @dataclass
 class IsaUpdateOpts:
-    redo_spectrograms: bool=False,
-    no_vocalization_detection: bool=False,
+    redo_spectrograms: bool=False
+    no_vocalization_detection: bool=False
     redo_vocalization_detection: bool=False
+    streaming_spectrograms: bool=False
+    no_video_proxy: bool=False
+    no_similarity_index: bool=False
+    profile: Union[str, None]=None # 'jsonl' or 'chrome'
 
 def update(
     session: Union[str, None]=None,
     all: bool=False,
-    opts: IsaUpdateOpts=IsaUpdateOpts()
+    opts: IsaUpdateOpts=IsaUpdateOpts(),
+    jobs: int=1
 ):
     print(f'Updating session: {session}')
     if opts.redo_spectrograms:
         if opts.no_vocalization_detection and opts.redo_vocalization_detection:
             raise Exception('You cannot specify both redo_vocalization_detection and no_vocalization_detection')
+    if jobs < 1:
+        raise Exception(f'Invalid number of jobs: {jobs}')
     if all:
         if session:
             raise Exception('Cannot specify session with all')
         session_names = _get_project_config_value('sessions')
+        if jobs > 1:
+            _update_sessions_in_parallel(session_names, opts=opts, jobs=jobs)
+            return
+        profile_events = []
         for session_name in session_names:
-            update(
-                session=session_name,
-                opts=opts
-            )
+            print(f'Updating session: {session_name}')
+            profile_events.extend(_update_session_dir_with_profile(session_name, opts=opts))
+        if opts.profile is not None:
+            _print_profile_summary(profile_events)
         return
     if session is None:
         raise Exception('Must specify session')
     
-    _update_session_dir(
+    profile_events = _update_session_dir_with_profile(
         session,
         opts=opts
     )
+    if opts.profile is not None:
+        _print_profile_summary(profile_events)
+
+def _update_session_dir_with_profile(session: str, *, opts: IsaUpdateOpts):
+    # returns the profile events of the session (if profiling)
+    if opts.profile is None:
+        _update_session_dir(session, opts=opts)
+        return []
+    _start_profiling(session)
+    try:
+        with _profile_stage('session'):
+            _update_session_dir(session, opts=opts)
+    finally:
+        events = _stop_profiling(output_fname=_get_profile_output_fname(session, format=opts.profile), format=opts.profile)
+    return events
 
 def _update_session_dir(
     session: str,
@@ -49,28 +85,238 @@ def _update_session_dir(
     sessions_in_config = _get_project_config_value('sessions')
     if session not in sessions_in_config:
         raise Exception(f'Session {session} not found in project config. Use "isa add" to add it.')
-    
-    _initialize_or_update_session_dir(session)
-    
-    spectrograms_pkl_fname = f'./{session}/spectrograms.pkl'
+
+    # The manifest records what each derived artifact was computed from, so
+    # that only the stale stages are recomputed
+    manifest = _load_session_manifest(session)
+    with _profile_stage('fingerprint_inputs'):
+        audio_fp = _get_session_input_fingerprint(session, manifest, _find_singular_file_in_dir(dirname, ['.h5', '.wav']))
+        video_fname = _find_singular_file_in_dir(dirname, ['.mp4', '.avi'])
+        video_fp = _get_session_input_fingerprint(session, manifest, video_fname)
+
+    init_key = {
+        'version': _artifact_versions['init'],
+        'audio': audio_fp,
+        'video': video_fp
+    }
+    config_yaml_fname = f'{dirname}/isa-session.yaml'
+    if _is_stage_up_to_date(manifest, 'init', init_key) and os.path.exists(config_yaml_fname):
+        print('Session config is up to date')
+    else:
+        with _profile_stage('init'):
+            _initialize_or_update_session_dir(session)
+        _set_stage(manifest, 'init', init_key)
+        _save_session_manifest(session, manifest)
+    config = _get_session_config(session)
+
+    with _profile_stage('migrate_spectrograms_pkl'):
+        _migrate_spectrograms_pkl(session)
+    spectrograms_zarr_fname = f'./{session}/spectrograms.zarr'
     spectrogram_for_gui_zarr_fname = f'./{session}/spectrogram_for_gui.zarr'
-    if (not os.path.exists(spectrograms_pkl_fname) or not os.path.exists(spectrogram_for_gui_zarr_fname)) or (opts.redo_spectrograms):
-        create_spectrograms(session)
-    
+    spectrograms_key = {
+        'version': _artifact_versions['spectrograms'],
+        'audio': audio_fp,
+        'audio_duration_sec': config['audio_duration_sec'],
+        'nfft': config.get('spectrogram_nfft', 512),
+        'noverlap': config.get('spectrogram_noverlap', 256)
+    }
+    spectrogram_pyramid_config = _get_project_config_value('spectrogram_pyramid')
+    if spectrogram_pyramid_config is not None:
+        spectrograms_key['pyramid'] = spectrogram_pyramid_config
+        if spectrogram_pyramid_config.get('band', False):
+            # the band levels are cropped to the detection band
+            spectrograms_key['auto_detect_freq_range'] = config.get('auto_detect_freq_range', None)
+    spectrograms_exist = os.path.exists(spectrogram_for_gui_zarr_fname) and os.path.exists(spectrograms_zarr_fname)
+    if spectrograms_exist and not _has_stage(manifest, 'spectrograms'):
+        # computed before the manifest existed
+        _set_stage(manifest, 'spectrograms', spectrograms_key)
+        _save_session_manifest(session, manifest)
+    if (not spectrograms_exist) or (not _is_stage_up_to_date(manifest, 'spectrograms', spectrograms_key)) or (opts.redo_spectrograms):
+        with _profile_stage('spectrograms'):
+            create_spectrograms(session, streaming=opts.streaming_spectrograms)
+        _set_stage(manifest, 'spectrograms', spectrograms_key)
+        _save_session_manifest(session, manifest)
+    else:
+        print('Spectrograms are up to date')
+        if not _has_spectrogram_stats(spectrogram_for_gui_zarr_fname):
+            # created before the statistics existed
+            print('Computing spectrogram statistics')
+            with _profile_stage('spectrogram_stats'):
+                _create_spectrogram_stats_from_zarr(spectrogram_for_gui_zarr_fname, spectrograms_zarr_fname)
+
+    if not opts.no_video_proxy and video_fname is not None:
+        # downscaled, pre-encoded jpeg frames that are served without decoding the video
+        video_proxy_fname = f'{dirname}/video_proxy.bin'
+        video_proxy_opts = _get_video_proxy_opts(_get_project_config_value('video_proxy'))
+        video_proxy_key = {
+            'version': _artifact_versions['video_proxy'],
+            'video': video_fp,
+            'max_width': video_proxy_opts['max_width'],
+            'quality': video_proxy_opts['quality']
+        }
+        if os.path.exists(video_proxy_fname) and _is_stage_up_to_date(manifest, 'video_proxy', video_proxy_key):
+            print('Video proxy is up to date')
+        else:
+            with _profile_stage('video_proxy'):
+                _create_video_proxy(f'{dirname}/{video_fname}', video_proxy_fname, opts=video_proxy_opts)
+            _set_stage(manifest, 'video_proxy', video_proxy_key)
+            _save_session_manifest(session, manifest)
+
+    if opts.no_vocalization_detection:
+        _update_session_fingerprints_stage(session, manifest, config=config, spectrograms_key=spectrograms_key, opts=opts)
+        return
     annotations_json_fname = f'{dirname}/annotations.json'
-    do_auto_detect = (not os.path.exists(annotations_json_fname) and not opts.no_vocalization_detection) or opts.redo_vocalization_detection
+    # edits made in the viewer that are still in the journal
+    _compact_annotations(annotations_json_fname)
+    try:
+        csv_fname = _find_singular_file_in_dir(dirname, ['.csv'])
+    except Exception:
+        csv_fname = None
+    annotations_key = {
+        'version': _artifact_versions['annotations'],
+        'spectrograms': spectrograms_key,
+        'auto_detect_freq_range': config['auto_detect_freq_range'],
+        'csv': _get_session_input_fingerprint(session, manifest, csv_fname)
+    }
+    if opts.redo_vocalization_detection or not os.path.exists(annotations_json_fname):
+        do_auto_detect = True
+    elif not _has_stage(manifest, 'annotations'):
+        # computed before the manifest existed, or created by hand
+        do_auto_detect = False
+        _set_stage(manifest, 'annotations', annotations_key, outputs={'annotations.json': _get_file_fingerprint(annotations_json_fname)})
+        _save_session_manifest(session, manifest)
+    elif _is_stage_up_to_date(manifest, 'annotations', annotations_key):
+        do_auto_detect = False
+        print('Vocalizations are up to date')
+    else:
+        previous_fp = _get_stage_outputs(manifest, 'annotations').get('annotations.json', None)
+        if previous_fp is not None and _get_file_fingerprint(annotations_json_fname, previous_fp)['hash'] == previous_fp['hash']:
+            do_auto_detect = True
+        else:
+            # never overwrite annotations that were edited after detection
+            do_auto_detect = False
+            print(f'WARNING: {annotations_json_fname} is out of date but has been edited. Use --redo-vocalization-detection to overwrite it.')
     if do_auto_detect:
-        auto_detect_vocalizations(session, annotations_json_fname)
+        with _profile_stage('vocalization_detection'):
+            auto_detect_vocalizations(session, annotations_json_fname)
+        _set_stage(manifest, 'annotations', annotations_key, outputs={'annotations.json': _get_file_fingerprint(annotations_json_fname)})
+        _save_session_manifest(session, manifest)
+    _update_session_fingerprints_stage(session, manifest, config=config, spectrograms_key=spectrograms_key, opts=opts)
+
+def _update_session_fingerprints_stage(session: str, manifest: dict, *, config: dict, spectrograms_key: dict, opts: IsaUpdateOpts):
+    # the fingerprints of the vocalizations for finding similar ones across
+    # the project, see _similarity_index
+    annotations_json_fname = f'./{session}/annotations.json'
+    if opts.no_similarity_index or not os.path.exists(annotations_json_fname):
+        return
+    # the key has the hash of annotations.json, so the edits in the journal
+    # must be in it
+    _compact_annotations(annotations_json_fname)
+    similarity_index_opts = _get_similarity_index_opts(_get_project_config_value('similarity_index'))
+    fingerprint_params = _get_fingerprint_params(config, opts=similarity_index_opts, spectrograms_key=spectrograms_key, version=_artifact_versions['fingerprints'])
+    fingerprints_key = {
+        'params': fingerprint_params,
+        'annotations': _get_file_fingerprint(annotations_json_fname)['hash']
+    }
+    if os.path.exists(_get_session_fingerprints_fname(session)) and _is_stage_up_to_date(manifest, 'fingerprints', fingerprints_key):
+        print('Fingerprints are up to date')
+        return
+    with _profile_stage('fingerprints'):
+        _update_session_fingerprints(session, params=fingerprint_params)
+    _set_stage(manifest, 'fingerprints', fingerprints_key)
+    _save_session_manifest(session, manifest)
+
+def _update_sessions_in_parallel(
+    session_names: List[str], *,
+    opts: IsaUpdateOpts,
+    jobs: int
+):
+    max_jobs = _get_memory_limited_num_jobs(session_names, opts=opts)
+    if max_jobs < jobs:
+        print(f'Limiting the number of jobs to {max_jobs} based on available memory')
+        jobs = max_jobs
+    print(f'Updating {len(session_names)} sessions using {jobs} jobs')
+    results: List[dict] = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_update_session_dir_with_log, session_name, opts=opts)
+            for session_name in session_names
+        ]
+        for future in as_completed(futures):
+            r = future.result()
+            results.append(r)
+            status = 'done' if r['success'] else 'FAILED'
+            print(f'[{len(results)}/{len(session_names)}] {r["session"]}: {status} ({r["elapsed_sec"]:.1f} sec) - see {r["log_fname"]}')
+    failed = [r for r in results if not r['success']]
+    print('')
+    print(f'{len(results) - len(failed)} of {len(results)} sessions updated successfully')
+    for r in failed:
+        print(f'FAILED: {r["session"]}: {r["error"]}')
+    if opts.profile is not None:
+        _print_profile_summary([e for r in results for e in r['profile_events']])
+    if len(failed) > 0:
+        raise Exception(f'Failed to update {len(failed)} sessions')
+
+def _update_session_dir_with_log(session: str, *, opts: IsaUpdateOpts):
+    # Runs in a worker process. The output of each session goes to its own
+    # log file rather than being interleaved with the other sessions.
+    log_fname = f'./{session}/isa-update.log'
+    timer = time.time()
+    error = None
+    profile_events = []
+    with open(log_fname, 'w') as log_file:
+        with redirect_stdout(log_file), redirect_stderr(log_file):
+            try:
+                profile_events = _update_session_dir_with_profile(session, opts=opts)
+            except Exception as e:
+                traceback.print_exc()
+                error = f'{type(e).__name__}: {e}'
+    return {
+        'session': session,
+        'success': error is None,
+        'error': error,
+        'elapsed_sec': time.time() - timer,
+        'log_fname': log_fname,
+        'profile_events': profile_events
+    }
+
+def _get_memory_limited_num_jobs(session_names: List[str], *, opts: IsaUpdateOpts):
+    available_bytes = _get_available_memory_bytes()
+    if available_bytes is None:
+        return len(session_names)
+    max_session_bytes = max([_estimate_session_memory_bytes(session_name, opts=opts) for session_name in session_names] + [1])
+    return max(1, int(available_bytes * 0.8 // max_session_bytes))
+
+def _estimate_session_memory_bytes(session: str, *, opts: IsaUpdateOpts):
+    if opts.streaming_spectrograms:
+        # bounded by the block size rather than the recording
+        return 1024 * 1024 * 1024
+    dirname = f'./{session}'
+    try:
+        audio_fname = _find_singular_file_in_dir(dirname, ['.h5', '.wav'])
+    except Exception:
+        audio_fname = None
+    if audio_fname is None:
+        return 1
+    # the audio is held as float64 together with one float64 spectrogram per
+    # channel (about the same size as the audio), their sum and intermediates
+    return os.path.getsize(f'{dirname}/{audio_fname}') * 8
+
+def _get_available_memory_bytes():
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
 
 def _get_session_config(session: str):
-    config_yaml_fname = f'./{session}/isa-session.yaml'
-    if not os.path.exists(config_yaml_fname):
-        raise Exception(f'File does not exist: {config_yaml_fname}')
-    with open(config_yaml_fname, 'r') as f:
-        config = yaml.safe_load(f)
-    return config
-
-def _set_session_config(session: str, config: dict):
-    config_yaml_fname = f'./{session}/isa-session.yaml'
-    with open(config_yaml_fname, 'w') as f:
-        yaml.dump(config, f)
\ No newline at end of file
+    config = _get_session_config_file(session)
+    if not config.exists():
+        raise Exception(f'File does not exist: {config.fname}')
+    return config.to_dict()
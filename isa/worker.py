@@ -0,0 +1,230 @@
+from typing import Union
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from .update import IsaUpdateOpts, _update_session_dir_with_log
+from ._project_config import _get_project_config_value, _lock_file
+
+
+# Work queue for processing the sessions of a project from several machines
+# that share the project directory. It only uses files in .isa-queue/ (no
+# database, which is unreliable on network filesystems):
+#
+# <session>.lease        created with O_EXCL by the worker that claims the
+#                        session; its mtime is the heartbeat
+# <session>.status.json  state (done or failed), attempts and timings
+# <session>.takeover.lock  flock held while an expired lease is taken over
+#
+# A lease whose heartbeat is older than lease_sec belongs to a worker that
+# crashed (or lost its machine). Another worker takes it over by checking
+# again that it is expired and removing it while holding the takeover lock,
+# and the session counts as a failed attempt. A worker that finds that its
+# lease was taken over stops its heartbeat and does not record its result,
+# which would overwrite the status of the new owner. Leases are compared
+# with the clock of this machine, so lease_sec should be well above the
+# clock skew between the nodes.
+_queue_dirname = '.isa-queue'
+
+def worker(
+    *,
+    opts: IsaUpdateOpts=IsaUpdateOpts(),
+    lease_sec: float=300,
+    max_attempts: int=3,
+    poll_sec: float=10,
+    reset: bool=False
+):
+    os.makedirs(_queue_dirname, exist_ok=True)
+    if reset:
+        _reset_queue()
+    worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    print(f'Worker {worker_id}')
+    num_processed = 0
+    while True:
+        session_names = _get_project_config_value('sessions') or []
+        session = None
+        num_in_progress = 0
+        for s in session_names:
+            if not _is_session_pending(s, max_attempts=max_attempts):
+                continue
+            if _try_claim_session(s, worker_id=worker_id, lease_sec=lease_sec, max_attempts=max_attempts):
+                # it may have been completed between the check and the claim
+                if _is_session_pending(s, max_attempts=max_attempts):
+                    session = s
+                    break
+                _release_session(s, worker_id=worker_id)
+            else:
+                num_in_progress += 1
+        if session is None:
+            if num_in_progress == 0:
+                break
+            # wait for the other workers, or for their leases to expire
+            time.sleep(poll_sec)
+            continue
+        _process_session(session, worker_id=worker_id, opts=opts, lease_sec=lease_sec)
+        num_processed += 1
+    print(f'Worker {worker_id} processed {num_processed} sessions, no sessions left')
+    _print_queue_status(max_attempts=max_attempts)
+
+def _process_session(session: str, *, worker_id: str, opts: IsaUpdateOpts, lease_sec: float):
+    status = _load_session_status(session)
+    attempts = status.get('attempts', 0) + 1
+    print(f'Processing {session} (attempt {attempts})')
+    _save_session_status(session, {
+        **status,
+        'state': 'running',
+        'attempts': attempts,
+        'worker': worker_id,
+        'started_at': time.time()
+    }, worker_id=worker_id)
+    stop_heartbeat = threading.Event()
+    lost_lease = threading.Event()
+    def heartbeat():
+        while not stop_heartbeat.wait(lease_sec / 5):
+            # if this worker stalled past lease_sec, the session may have been
+            # taken over, and the lease now belongs to the new owner
+            if _get_lease_owner(session) != worker_id:
+                lost_lease.set()
+                return
+            try:
+                os.utime(_get_lease_fname(session))
+            except FileNotFoundError:
+                lost_lease.set()
+                return
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        r = _update_session_dir_with_log(session, opts=opts)
+    finally:
+        stop_heartbeat.set()
+        heartbeat_thread.join()
+    # the update may return before the heartbeat notices that the lease was lost
+    if _get_lease_owner(session) != worker_id:
+        lost_lease.set()
+    if lost_lease.is_set():
+        # the status belongs to the worker that took the session over
+        print(f'WARNING: the lease of {session} expired while it was being processed, not recording the result')
+        return
+    _save_session_status(session, {
+        'state': 'done' if r['success'] else 'failed',
+        'attempts': attempts,
+        'worker': worker_id,
+        'started_at': time.time() - r['elapsed_sec'],
+        'finished_at': time.time(),
+        'elapsed_sec': r['elapsed_sec'],
+        'error': r['error'],
+        'log_fname': r['log_fname']
+    }, worker_id=worker_id)
+    status_label = 'done' if r['success'] else f'FAILED: {r["error"]}'
+    print(f'{session}: {status_label} ({r["elapsed_sec"]:.1f} sec) - see {r["log_fname"]}')
+    _release_session(session, worker_id=worker_id)
+
+def _is_session_pending(session: str, *, max_attempts: int):
+    status = _load_session_status(session)
+    state = status.get('state', None)
+    if state == 'done':
+        return False
+    if status.get('attempts', 0) >= max_attempts and state != 'running':
+        return False
+    return True
+
+def _try_claim_session(session: str, *, worker_id: str, lease_sec: float, max_attempts: int):
+    lease_fname = _get_lease_fname(session)
+    try:
+        st = os.stat(lease_fname)
+    except FileNotFoundError:
+        st = None
+    if st is not None:
+        if time.time() - st.st_mtime < lease_sec:
+            return False
+        # the worker holding the lease stopped sending heartbeats. Takeovers
+        # are serialized, otherwise a worker that saw the expired lease could
+        # move away the fresh lease of another worker that took it over first
+        with _lock_file(f'{_queue_dirname}/{session}.takeover.lock'):
+            try:
+                st = os.stat(lease_fname)
+            except FileNotFoundError:
+                st = None
+            if st is not None:
+                if time.time() - st.st_mtime < lease_sec:
+                    return False
+                expired_fname = f'{lease_fname}.expired.{worker_id}'
+                os.rename(lease_fname, expired_fname)
+                try:
+                    with open(expired_fname, 'r') as f:
+                        previous_worker_id = json.load(f).get('worker', None)
+                except (OSError, ValueError):
+                    previous_worker_id = None
+                os.remove(expired_fname)
+                status = _load_session_status(session)
+                print(f'Lease of {session} held by {previous_worker_id} expired')
+                _save_session_status(session, {
+                    **status,
+                    'state': 'failed',
+                    'error': f'Lease expired (worker {previous_worker_id})'
+                }, worker_id=worker_id)
+        if not _is_session_pending(session, max_attempts=max_attempts):
+            return False
+    try:
+        fd = os.open(lease_fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'worker': worker_id, 'claimed_at': time.time()}, f)
+    return True
+
+def _release_session(session: str, *, worker_id: str):
+    if _get_lease_owner(session) == worker_id:
+        os.remove(_get_lease_fname(session))
+
+def _get_lease_owner(session: str):
+    # None if there is no lease, or if it is still being written
+    try:
+        with open(_get_lease_fname(session), 'r') as f:
+            return json.load(f).get('worker', None)
+    except (OSError, ValueError):
+        return None
+
+def _get_lease_fname(session: str):
+    return f'{_queue_dirname}/{session}.lease'
+
+def _get_status_fname(session: str):
+    return f'{_queue_dirname}/{session}.status.json'
+
+def _load_session_status(session: str) -> dict:
+    try:
+        with open(_get_status_fname(session), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_session_status(session: str, status: dict, *, worker_id: str):
+    status_fname = _get_status_fname(session)
+    tmp_fname = f'{status_fname}.{worker_id}.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(status, f, indent=4)
+    os.replace(tmp_fname, status_fname)
+
+def _reset_queue():
+    # forget the status of all sessions (leases of running workers are kept)
+    for fname in os.listdir(_queue_dirname):
+        if fname.endswith('.status.json'):
+            os.remove(f'{_queue_dirname}/{fname}')
+
+def _print_queue_status(*, max_attempts: Union[int, None]=None):
+    session_names = _get_project_config_value('sessions') or []
+    print('')
+    print(f'{"session":<30} {"state":<10} {"attempts":>8} {"elapsed (s)":>12}  worker')
+    counts = {}
+    for session in session_names:
+        status = _load_session_status(session)
+        state = status.get('state', 'pending')
+        if state == 'failed' and max_attempts is not None and status.get('attempts', 0) < max_attempts:
+            state = 'retry'
+        counts[state] = counts.get(state, 0) + 1
+        elapsed = status.get('elapsed_sec', None)
+        elapsed_label = f'{elapsed:.1f}' if elapsed is not None else ''
+        print(f'{session:<30} {state:<10} {status.get("attempts", 0):>8} {elapsed_label:>12}  {status.get("worker", "")}')
+    print(', '.join([f'{n} {state}' for state, n in counts.items()]))